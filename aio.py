@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio interface to a card, for show-control scripts.
+
+    aiface = aio.AsyncInterface(iface)
+    await aiface.set("Mix A Input 01", -600)
+    async for name, value in aiface.watch(["Mixer Input 01"]):
+        ...
+"""
+
+
+import alsaaudio
+import asyncio
+import functools
+import logging
+import typing
+
+import backend
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+Value = typing.Union[str, int]
+
+
+class AsyncInterface:
+    """Awaitable get() and set() of an Interface's controls, and watch() to
+    iterate over changes.
+
+    The event loop never touches ALSA. Every get() and set() made in one
+    iteration of the loop is collected, and the whole batch is run as one
+    job on the Interface's I/O worker, so a tick's writes reach the card
+    back to back, in one cache batch. Only the last value set for each
+    control in a tick is written. A get() of a control set in the same tick
+    returns the value being set.
+
+    Values are as StateStore.get(): the selected choice of an enum control,
+    or the volume of any other in `units`.
+    """
+    def __init__(self, iface: backend.Interface):
+        self.iface = iface
+        if iface.io_worker is None:
+            iface.start_io_worker()
+        # Set while a flush is scheduled on the event loop
+        self.flush_handle: typing.Optional[asyncio.Handle] = None
+        # control name -> (value, units, futures)
+        self.writes: typing.Dict[str, typing.Tuple[Value, int, typing.List["asyncio.Future[None]"]]] = {}
+        self.reads: typing.List[typing.Tuple[str, int, "asyncio.Future[Value]"]] = []
+
+        self.batches = 0
+        self.ops = 0
+
+    def check_name(self, name: str):
+        if name not in self.iface.mixer_elems:
+            raise KeyError(f"No such control '{name}'")
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    async def get(self, name: str, units: int = alsaaudio.VOLUME_UNITS_DB) -> Value:
+        self.check_name(name)
+        if name in self.writes and self.writes[name][1] == units:
+            return self.writes[name][0]
+        future: "asyncio.Future[Value]" = asyncio.get_running_loop().create_future()
+        self.reads.append((name, units, future))
+        self.schedule_flush()
+        return await future
+
+    async def set(self, name: str, value: Value, units: int = alsaaudio.VOLUME_UNITS_DB):
+        """Set an enum control to the choice `value`, or any other to the
+        volume `value`"""
+        self.check_name(name)
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        futures = self.writes[name][2] if name in self.writes else []
+        futures.append(future)
+        self.writes[name] = (value, units, futures)
+        self.schedule_flush()
+        await future
+
+    def flush(self):
+        self.flush_handle = None
+        writes, self.writes = self.writes, {}
+        reads, self.reads = self.reads, []
+        self.batches += 1
+        self.ops += sum(len(futures) for _, _, futures in writes.values()) + len(reads)
+        loop = asyncio.get_running_loop()
+        # submit() never waits, so the loop isn't held up however far behind
+        # the worker is
+        self.iface.io_worker.submit(functools.partial(self.run_batch, loop, writes, reads))
+
+    def run_batch(self, loop: asyncio.AbstractEventLoop,
+                  writes: typing.Dict[str, typing.Tuple[Value, int, typing.List["asyncio.Future[None]"]]],
+                  reads: typing.List[typing.Tuple[str, int, "asyncio.Future[Value]"]]):
+        """Runs on the I/O worker. Every future is resolved, whatever fails,
+        so nothing awaits it forever."""
+        results: typing.List[typing.Tuple[asyncio.Future, typing.Any, typing.Optional[Exception]]] = []
+        try:
+            with self.iface.cache.batch():
+                for name, (value, units, futures) in writes.items():
+                    error: typing.Optional[Exception] = None
+                    try:
+                        self.write(name, value, units)
+                    except Exception as e:
+                        error = e
+                    results += [(future, None, error) for future in futures]
+            for name, units, future in reads:
+                try:
+                    results.append((future, self.iface.store.get(name, units), None))
+                except Exception as e:
+                    results.append((future, None, e))
+        except Exception as e:
+            # E.g. a listener failed when the batch's changes were announced
+            logger.exception("Batch failed")
+            all_futures = [future for _, _, futures in writes.values() for future in futures] + \
+                [future for _, _, future in reads]
+            results = [(future, None, e) for future in all_futures]
+        try:
+            loop.call_soon_threadsafe(resolve, results)
+        except RuntimeError:
+            logger.debug("Event loop closed before a batch finished")
+
+    def write(self, name: str, value: Value, units: int):
+        mixer_elem = self.iface.mixer_elems[name]
+        if backend.is_enum(mixer_elem):
+            index = mixer_elem.index_of(value)
+            if index < 0:
+                raise ValueError(f"'{value}' is not a choice for {name}")
+            mixer_elem.setenum(index)
+        elif isinstance(value, int):
+            mixer_elem.setvolume(value, units=units)
+        else:
+            raise ValueError(f"{name} takes a volume, not '{value}'")
+
+    async def watch(self, controls: typing.Optional[typing.Iterable[str]] = None,
+                    units: int = alsaaudio.VOLUME_UNITS_DB) \
+            -> typing.AsyncIterator[typing.Tuple[str, Value]]:
+        """Yield the name and new value of each of `controls` (by default,
+        all of them) as it changes, whoever changed it. Changes which arrive
+        faster than they are consumed are coalesced."""
+        names = list(self.iface.mixer_elems) if controls is None else list(controls)
+        for name in names:
+            self.check_name(name)
+        loop = asyncio.get_running_loop()
+        changed: typing.List[str] = []
+        event = asyncio.Event()
+
+        def mark(name: str):
+            if name not in changed:
+                changed.append(name)
+            event.set()
+
+        def on_change(name: str):
+            # Called on whichever thread made the change
+            try:
+                loop.call_soon_threadsafe(mark, name)
+            except RuntimeError:
+                pass
+
+        store = self.iface.store
+        subscriptions = [store.subscribe(name, functools.partial(on_change, name)) for name in names]
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                batch = list(changed)
+                changed.clear()
+                values = await asyncio.gather(*(self.get(name, units) for name in batch))
+                for name, value in zip(batch, values):
+                    yield name, value
+        finally:
+            for subscription in subscriptions:
+                store.unsubscribe(subscription)
+
+    async def stop(self):
+        """Make any pending writes and stop the Interface's threads"""
+        await asyncio.get_running_loop().run_in_executor(None, self.iface.stop)
+
+    def metrics(self) -> typing.Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "ops": self.ops,
+            "ops_per_batch": self.ops / self.batches if self.batches else 0.0,
+        }
+
+
+def resolve(results: typing.List[typing.Tuple[asyncio.Future, typing.Any, typing.Optional[Exception]]]):
+    for future, result, error in results:
+        if future.cancelled():
+            continue
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
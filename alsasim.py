@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simulated ALSA cards, driven by the JSON dumps in mixer_control_dumps/.
+
+This implements the parts of the pyalsaaudio API that redmixctl uses, so it can
+stand in for the real `alsaaudio` module when no hardware is present. Call
+`install()` (or `install_from_env()`) before anything imports `alsaaudio`.
+"""
+
+
+import collections
+import json
+import logging
+import os
+import select
+import sys
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import ctypes
+
+
+logger = logging.getLogger("redmixctl." + __name__)
+
+# Colon-separated list of dumps to simulate, one card per dump
+ENV_DUMPS = "REDMIXCTL_SIMULATE"
+# Latency of each simulated control read or write, in milliseconds
+ENV_LATENCY = "REDMIXCTL_SIMULATE_LATENCY"
+
+PCM_PLAYBACK = 0
+PCM_CAPTURE = 1
+
+VOLUME_UNITS_PERCENTAGE = 0
+VOLUME_UNITS_RAW = 1
+VOLUME_UNITS_DB = 2
+
+READ_OPS = ["getenum", "getvolume", "getrange"]
+WRITE_OPS = ["setenum", "setvolume", "setmute"]
+
+# Operations which result in a USB control transfer on real hardware, and so
+# are subject to the simulated latency.
+TRANSFER_OPS = ["getenum", "getvolume", "setenum", "setvolume", "setmute"]
+
+# The dumps only contain raw volume ranges. Where we know the dB range the
+# driver reports for a raw range, use it; otherwise assume 1 dB per step up to
+# 0 dB, which is what the Scarlett line outputs do.
+KNOWN_DB_RANGES: typing.Dict[typing.Tuple[int, int], typing.Tuple[int, int]] = {
+    (0, 172): (-8000, 600),  # Scarlett gen2 mix gains: -80 dB to +6 dB in 0.5 dB steps
+}
+
+
+class ALSAAudioError(Exception):
+    pass
+
+
+def default_db_range(raw_range: typing.Tuple[int, int]) -> typing.Tuple[int, int]:
+    if raw_range in KNOWN_DB_RANGES:
+        return KNOWN_DB_RANGES[raw_range]
+    return (-100 * (raw_range[1] - raw_range[0]), 0)
+
+
+class SimulatedControl:
+    def __init__(self, name: str, desc: typing.Dict[str, typing.Any]):
+        self.name = name
+        self.switchcap: typing.List[str] = desc.get("switchcap", [])
+        self.volumecap: typing.List[str] = desc.get("volumecap", [])
+        self.enum_values: typing.Optional[typing.List[str]] = desc.get("getenum")
+        self.enum_index = 0
+
+        self.raw_range: typing.Optional[typing.Tuple[int, int]] = None
+        self.db_range: typing.Optional[typing.Tuple[int, int]] = None
+        self.volume = 0
+        self.mute = 0
+        if "getrange_playback" in desc:
+            self.raw_range = (desc["getrange_playback"][0], desc["getrange_playback"][1])
+            if "getrange_playback_db" in desc:
+                self.db_range = (desc["getrange_playback_db"][0], desc["getrange_playback_db"][1])
+            else:
+                self.db_range = default_db_range(self.raw_range)
+            self.volume = self.raw_range[0]
+
+    def to_raw(self, value: int, units: int) -> int:
+        assert self.raw_range and self.db_range
+        rmin, rmax = self.raw_range
+        if units == VOLUME_UNITS_RAW:
+            raw = value
+        elif units == VOLUME_UNITS_PERCENTAGE:
+            raw = rmin + round((rmax - rmin) * value / 100.0)
+        elif units == VOLUME_UNITS_DB:
+            dmin, dmax = self.db_range
+            raw = rmin + round((value - dmin) * (rmax - rmin) / (dmax - dmin))
+        else:
+            raise ALSAAudioError(f"Invalid volume units {units}")
+        return max(rmin, min(rmax, raw))
+
+    def from_raw(self, raw: int, units: int) -> int:
+        assert self.raw_range and self.db_range
+        rmin, rmax = self.raw_range
+        if units == VOLUME_UNITS_RAW:
+            return raw
+        elif units == VOLUME_UNITS_PERCENTAGE:
+            return round((raw - rmin) * 100.0 / (rmax - rmin))
+        elif units == VOLUME_UNITS_DB:
+            dmin, dmax = self.db_range
+            return dmin + round((raw - rmin) * (dmax - dmin) / (rmax - rmin))
+        raise ALSAAudioError(f"Invalid volume units {units}")
+
+
+_libc: typing.Optional["ctypes.PyDLL"] = None
+
+
+def wait_holding_gil(seconds: float):
+    """Wait for `seconds` without releasing the GIL.
+
+    pyalsaaudio's Mixer methods don't release the GIL during a control
+    transfer, so while one thread waits for the card, no other Python code
+    runs. time.sleep() would let other threads run, and make threads look
+    more useful than they are with real hardware. Functions called through
+    a ctypes.PyDLL keep the GIL, like pyalsaaudio's."""
+    global _libc
+    if _libc is None:
+        import ctypes
+        _libc = ctypes.PyDLL(None)
+        _libc.usleep.argtypes = [ctypes.c_uint]
+    _libc.usleep(round(seconds * 1e6))
+
+
+class SimulatedCard:
+    """A card made up of the controls in a mixer_control_dumps JSON file.
+
+    Every control access is counted in `calls`, and reads and writes which
+    would be USB control transfers on real hardware take `latency` seconds.
+    Opening a mixer element takes `open_latency` seconds. Like real
+    transfers, these hold the GIL (see wait_holding_gil()).
+    """
+    def __init__(self, name: str, controls: typing.Dict[str, typing.Dict[str, typing.Any]], *,
+                 longname: typing.Optional[str] = None,
+                 latency: float = 0.0, open_latency: float = 0.0):
+        self.name = name
+        self.longname = longname or name
+        self.controls = {n: SimulatedControl(n, desc) for n, desc in controls.items()}
+        self.latency = latency
+        self.open_latency = open_latency
+        self.calls: typing.Counter[str] = collections.Counter()
+        self.lock = threading.Lock()
+        # Open handles which have asked for poll descriptors
+        self.watchers: typing.List["Mixer"] = []
+
+    @classmethod
+    def from_dump(cls, path: str, name: typing.Optional[str] = None, **kwargs) -> "SimulatedCard":
+        with open(path, "rt") as f:
+            controls = json.load(f)
+        if name is None:
+            name = guess_card_name(controls) or os.path.splitext(os.path.basename(path))[0]
+        return cls(name, controls, **kwargs)
+
+    def call(self, op: str):
+        with self.lock:
+            self.calls[op] += 1
+        if op in TRANSFER_OPS and self.latency > 0:
+            wait_holding_gil(self.latency)
+        elif op == "open" and self.open_latency > 0:
+            wait_holding_gil(self.open_latency)
+
+    def reads(self) -> int:
+        return sum(self.calls[op] for op in READ_OPS)
+
+    def writes(self) -> int:
+        return sum(self.calls[op] for op in WRITE_OPS)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def changed(self):
+        """Queue a control change event on every handle which is polling,
+        like the kernel does when a control's value changes"""
+        with self.lock:
+            watchers = list(self.watchers)
+        for watcher in watchers:
+            watcher._queue_event()
+
+    def control(self, name: str) -> SimulatedControl:
+        if name not in self.controls:
+            raise ALSAAudioError(f"Unable to find mixer control {name},0 [{self.name}]")
+        return self.controls[name]
+
+
+def guess_card_name(controls: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+    """Dumps don't record the card name, so use the name of the first model
+    whose routing controls are all present"""
+    import models
+    for model in models.MODELS:
+        if all(c in controls for c in model.physical_outputs + model.mixer_inputs):
+            return model.name
+    return None
+
+
+_cards: typing.List[SimulatedCard] = []
+
+
+def install(cards: typing.Optional[typing.List[SimulatedCard]] = None):
+    """Make `import alsaaudio` return this module"""
+    sys.modules["alsaaudio"] = sys.modules[__name__]
+    if cards is not None:
+        set_cards(cards)
+
+
+def install_from_env(dumps: typing.Optional[typing.List[str]] = None) -> bool:
+    """Install simulated cards for the given dumps, or for the dumps listed in
+    $REDMIXCTL_SIMULATE. Returns False if there is nothing to simulate."""
+    if not dumps:
+        dumps = [d for d in os.environ.get(ENV_DUMPS, "").split(os.pathsep) if d]
+    if not dumps:
+        return False
+
+    latency = float(os.environ.get(ENV_LATENCY, "0")) / 1000.0
+    install()
+    set_cards([SimulatedCard.from_dump(d, latency=latency) for d in dumps])
+    for i, card in enumerate(_cards):
+        logger.info("Simulating card %d [%s] with %d controls, %.1f ms latency",
+                    i, card.name, len(card.controls), card.latency * 1000)
+    return True
+
+
+def set_cards(cards: typing.List[SimulatedCard]):
+    _cards[:] = cards
+
+
+def cards() -> typing.List[SimulatedCard]:
+    return list(_cards)
+
+
+def call_counts() -> typing.Counter[str]:
+    """Total calls of each operation across all simulated cards"""
+    total: typing.Counter[str] = collections.Counter()
+    for card in _cards:
+        total.update(card.calls)
+    return total
+
+
+def reset_call_counts():
+    for card in _cards:
+        card.reset_calls()
+
+
+def _get_card(cardindex: int) -> SimulatedCard:
+    if cardindex == -1:
+        cardindex = 0
+    if cardindex < 0 or cardindex >= len(_cards):
+        raise ALSAAudioError(f"No such card index {cardindex}")
+    return _cards[cardindex]
+
+
+class Mixer():
+    def __init__(self, control: str = "Master", id: int = 0, cardindex: int = -1, device: str = "default"):
+        self._event_pipe: typing.Optional[typing.Tuple[int, int]] = None
+        self._events = 0
+        self._events_lock = threading.Lock()
+        self._card = _get_card(cardindex)
+        self._card.call("open")
+        self._control = self._card.control(control)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._event_pipe:
+            with self._card.lock:
+                self._card.watchers.remove(self)
+            os.close(self._event_pipe[0])
+            os.close(self._event_pipe[1])
+            self._event_pipe = None
+
+    def polldescriptors(self) -> typing.List[typing.Tuple[int, int]]:
+        if not self._event_pipe:
+            self._event_pipe = os.pipe()
+            os.set_blocking(self._event_pipe[0], False)
+            with self._card.lock:
+                self._card.watchers.append(self)
+        return [(self._event_pipe[0], select.POLLIN)]
+
+    def handleevents(self) -> int:
+        with self._events_lock:
+            events = self._events
+            self._events = 0
+            if self._event_pipe:
+                try:
+                    while os.read(self._event_pipe[0], 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        return events
+
+    def _queue_event(self):
+        with self._events_lock:
+            self._events += 1
+            if self._event_pipe:
+                os.write(self._event_pipe[1], b"\0")
+
+    def mixer(self) -> str:
+        return self._control.name
+
+    def switchcap(self) -> typing.List[str]:
+        return list(self._control.switchcap)
+
+    def volumecap(self) -> typing.List[str]:
+        return list(self._control.volumecap)
+
+    def getenum(self):
+        self._card.call("getenum")
+        if self._control.enum_values is None:
+            return ()
+        return (self._control.enum_values[self._control.enum_index], list(self._control.enum_values))
+
+    def setenum(self, index: int):
+        self._card.call("setenum")
+        if self._control.enum_values is None:
+            raise ALSAAudioError(f"Control {self._control.name} is not an enumerated control")
+        if index < 0 or index >= len(self._control.enum_values):
+            raise ALSAAudioError(f"Enum index {index} out of range for {self._control.name}")
+        if index != self._control.enum_index:
+            self._control.enum_index = index
+            self._card.changed()
+
+    def _check_volume(self, pcmtype: int):
+        if self._control.raw_range is None or pcmtype != PCM_PLAYBACK:
+            raise ALSAAudioError(f"Control {self._control.name} has no volume")
+
+    def getrange(self, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_RAW) -> typing.Tuple[int, int]:
+        self._card.call("getrange")
+        self._check_volume(pcmtype)
+        assert self._control.raw_range
+        rmin, rmax = self._control.raw_range
+        return (self._control.from_raw(rmin, units), self._control.from_raw(rmax, units))
+
+    def getvolume(self, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE) -> typing.List[int]:
+        self._card.call("getvolume")
+        self._check_volume(pcmtype)
+        return [self._control.from_raw(self._control.volume, units)]
+
+    def setvolume(self, volume: int, channel: typing.Optional[int] = None,
+                  pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE):
+        self._card.call("setvolume")
+        self._check_volume(pcmtype)
+        raw = self._control.to_raw(volume, units)
+        if raw != self._control.volume:
+            self._control.volume = raw
+            self._card.changed()
+
+    def setmute(self, mute: int):
+        self._card.call("setmute")
+        self._control.mute = mute
+
+
+def mixers(cardindex: int = -1, device: str = "default") -> typing.List[str]:
+    card = _get_card(cardindex)
+    card.call("mixers")
+    return list(card.controls.keys())
+
+
+def card_indexes() -> typing.List[int]:
+    return list(range(len(_cards)))
+
+
+def card_name(card_index: int) -> typing.Tuple[str, str]:
+    card = _get_card(card_index)
+    card.call("card_name")
+    return (card.name, card.longname)
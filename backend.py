@@ -18,15 +18,36 @@
 
 from __future__ import print_function
 import alsaaudio
+import collections
+import collections.abc
+import contextlib
+import functools
 import logging
+import math
+import os
 import re
 import sys
+import threading
+import time
 import typing
-import typing_extensions
 
 import version
 import models
 
+if sys.version_info >= (3, 8):
+    from typing import Protocol
+else:
+    # typing_extensions is slow to import, so only where it is needed
+    from typing_extensions import Protocol
+
+if typing.TYPE_CHECKING:
+    import fingerprint
+    import instrument
+    # Imported where they are used, so that one-off commands, which don't
+    # use them, start quicker
+    import concurrent.futures
+    import multiprocessing.connection
+
 logger = logging.getLogger(version.NAME + "." + __name__)
 
 
@@ -37,16 +58,973 @@ class CardNotFoundError(Exception):
     pass
 
 
-class SupportsVolumeMixer(typing_extensions.Protocol):
+class SupportsControlNames(Protocol):
+    def control_names(self) -> typing.List[str]: ...
+
+
+class SupportsVolumeMixer(Protocol):
+    def mixer(self) -> str: ...
+    def control_names(self) -> typing.List[str]: ...
+    def getrange(self, units: int = ...) -> typing.Tuple[int, int]: ...
+    def getvolume(self, units: int = ...) -> typing.List[int]: ...
+    def setvolume(self, volume: int, units: int = ...): ...
+
+
+class SupportsEnumMixer(Protocol):
     def mixer(self) -> str: ...
-    def getrange(self, units: int) -> typing.List[int]: ...
-    def getvolume(self) -> typing.List[int]: ...
-    def setvolume(self, volume: int): ...
+    def control_names(self) -> typing.List[str]: ...
+    def getenum(self) -> typing.Tuple[str, typing.List[str]]: ...
+    def setenum(self, index: int, force: bool = False): ...
+    def index_of(self, choice: str) -> int: ...
+
+
+class IOWorker:
+    """Thread which makes all the ALSA control accesses for an Interface, so
+    that the caller (e.g. the wx event loop) never waits for a queue of slow
+    USB control transfers to finish.
+
+    pyalsaaudio's Mixer methods hold the GIL during a transfer, so every
+    other thread still stalls while one is in progress. The worker only
+    bounds that stall to a single transfer, where making the transfers on
+    the caller's thread would stall it for all of them.
+
+    Jobs run in order. submit() never waits, however many jobs are queued:
+    the caller may be an event loop, which would stall while holding up the
+    very callbacks which let it stop submitting. Instead, a warning is
+    logged each time more than `max_queue` jobs are waiting. Results and
+    errors are passed to the job's callbacks using `dispatch`, e.g.
+    wx.CallAfter to run them on the GUI thread.
+    """
+    MAX_QUEUE = 256
+
+    def __init__(self, max_queue: int = MAX_QUEUE,
+                 dispatch: typing.Optional[typing.Callable[..., None]] = None):
+        self.queue: typing.Deque[typing.Optional[IOWorker.Job]] = collections.deque()
+        self.queue_cond = threading.Condition()
+        self.max_queue = max_queue
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.thread = threading.Thread(target=self.run, name="IOWorker", daemon=True)
+        self.lock = threading.Lock()
+
+        self.jobs = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.started_at: typing.Optional[float] = None
+
+    Job = typing.Tuple[typing.Callable[[], typing.Any],
+                       typing.Optional[typing.Callable[[typing.Any], None]],
+                       typing.Optional[typing.Callable[[Exception], None]],
+                       float]
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.thread.start()
+
+    def on_worker_thread(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def submit(self, fn: typing.Callable[[], typing.Any],
+               on_done: typing.Optional[typing.Callable[[typing.Any], None]] = None,
+               on_error: typing.Optional[typing.Callable[[Exception], None]] = None):
+        """Run `fn` on the worker thread without waiting for it"""
+        depth = self.put((fn, on_done, on_error, time.monotonic()))
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+        if depth == self.max_queue + 1:
+            logger.warning("More than %d ALSA accesses are queued; the card isn't keeping up",
+                           self.max_queue)
+
+    def put(self, job: typing.Optional["IOWorker.Job"]) -> int:
+        with self.queue_cond:
+            self.queue.append(job)
+            self.queue_cond.notify()
+            return len(self.queue)
+
+    def call(self, fn: typing.Callable[[], typing.Any]) -> typing.Any:
+        """Run `fn` on the worker thread and wait for its result"""
+        if self.on_worker_thread():
+            return fn()
+        import concurrent.futures
+        future: "concurrent.futures.Future[typing.Any]" = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(run)
+        return future.result()
+
+    def run(self):
+        while True:
+            with self.queue_cond:
+                while not self.queue:
+                    self.queue_cond.wait()
+                job = self.queue.popleft()
+            if job is None:
+                return
+            fn, on_done, on_error, queued_at = job
+            try:
+                result = fn()
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                if on_error:
+                    self.dispatch(on_error, e)
+                else:
+                    logger.exception("ALSA access failed")
+            else:
+                if on_done:
+                    self.dispatch(on_done, result)
+            latency = time.monotonic() - queued_at
+            with self.lock:
+                self.jobs += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stop(self):
+        """Finish all the queued jobs, then stop the thread"""
+        self.put(None)
+        self.thread.join()
+
+    def metrics(self) -> typing.Dict[str, float]:
+        uptime = time.monotonic() - self.started_at if self.started_at else 0.0
+        with self.lock:
+            return {
+                "queue_depth": len(self.queue),
+                "max_queue_depth": self.max_depth,
+                "jobs": self.jobs,
+                "errors": self.errors,
+                "latency_mean_ms": 1000 * self.latency_total / self.jobs if self.jobs else 0.0,
+                "latency_max_ms": 1000 * self.latency_max,
+                "jobs_per_s": self.jobs / uptime if uptime else 0.0,
+            }
+
+
+class MixerStateCache:
+    """Read-through cache of the values of mixer controls.
+
+    Each control is read from the hardware the first time it is used, and
+    from then on getenum()/getvolume() are answered from memory. Writes made
+    through the cache update it; changes made by anything else must be
+    reported with invalidate() so the next read goes back to the hardware.
+    A volume written in dB or percent is read back, and the cache corrected
+    if the driver rounded it.
+
+    Writes of a value the control is already known to have are skipped
+    (and counted in `suppressed`) unless `force` is given, or
+    `suppress_writes` is turned off.
+
+    If `io_worker` is set, every hardware access is made on the worker
+    thread. Writes then update the cache immediately and are queued; reads
+    which miss the cache wait for the worker.
+    """
+    def __init__(self, mixer_elems: typing.Mapping[str, alsaaudio.Mixer]):
+        self.lock = threading.RLock()
+        self.raw_mixer_elems = mixer_elems
+        # Only the names are needed here, so a MixerElems isn't made to open
+        # anything.
+        self.mixer_elems = {name: CachedMixer(self, name) for name in mixer_elems}
+        self.io_worker: typing.Optional[IOWorker] = None
+        # Enum choices never change, so unlike the current values they are
+        # kept across invalidate().
+        self.choices: typing.Dict[str, typing.Tuple[str, ...]] = {}
+        self.choice_indexes: typing.Dict[str, typing.Dict[str, int]] = {}
+        # Nor does whether a control is an enum at all
+        self.not_enums: typing.Set[str] = set()
+        self.enums: typing.Dict[str, int] = {}
+        # Volumes are cached separately for each pcmtype and units, because
+        # converting between them depends on the driver.
+        self.volumes: typing.Dict[str, typing.Dict[typing.Tuple[int, int], typing.List[int]]] = {}
+        self.ranges: typing.Dict[typing.Tuple[str, int, int], typing.Tuple[int, int]] = {}
+        # Bumped whenever a control is written or invalidated, so a read which
+        # raced with a write doesn't overwrite the newer value.
+        self.generations: typing.Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.suppress_writes = True
+        self.suppressed = 0
+        # Read volumes back after writing them, as the driver may round them
+        # to the nearest step the control supports
+        self.read_back_volumes = True
+        self.hardware_writes = 0
+        self.listeners: typing.List[typing.Callable[[typing.Optional[str]], None]] = []
+        # Notifications held back by batch() on each thread
+        self.local = threading.local()
+
+    def add_listener(self, listener: typing.Callable[[typing.Optional[str]], None]):
+        """Call `listener` with the name of each control that is written or
+        invalidated, or with None if every control is invalidated"""
+        self.listeners.append(listener)
+
+    def notify(self, name: typing.Optional[str]):
+        held = getattr(self.local, "held", None)
+        if held is not None:
+            if name not in held:
+                held.append(name)
+            return
+        for listener in self.listeners:
+            listener(name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Hold back notifications made on this thread until the end of the
+        block, so listeners never see e.g. only one half of a stereo pair
+        changed"""
+        if getattr(self.local, "held", None) is not None:
+            yield
+            return
+        self.local.held = []
+        try:
+            yield
+        finally:
+            held, self.local.held = self.local.held, None
+            for name in held:
+                self.notify(name)
+
+    def changed(self, name: str):
+        """Must be called with the lock held"""
+        self.generations[name] = self.generations.get(name, 0) + 1
+
+    def invalidate(self, name: typing.Optional[str] = None):
+        """Forget the cached value of `name`, or of every control if None"""
+        with self.lock:
+            if name is None:
+                self.enums.clear()
+                self.volumes.clear()
+                for n in self.generations:
+                    self.changed(n)
+            else:
+                self.enums.pop(name, None)
+                self.volumes.pop(name, None)
+                self.changed(name)
+        self.notify(name)
+
+    def read(self, fn: typing.Callable[[], typing.Any]) -> typing.Any:
+        if self.io_worker:
+            return self.io_worker.call(fn)
+        return fn()
+
+    def write(self, name: str, fn: typing.Callable[[], None]):
+        with self.lock:
+            self.hardware_writes += 1
+        if self.io_worker and not self.io_worker.on_worker_thread():
+            self.io_worker.submit(fn, on_error=functools.partial(self.write_failed, name))
+            return
+        try:
+            fn()
+        except Exception:
+            self.invalidate(name)
+            raise
+
+    def write_failed(self, name: str, e: Exception):
+        logger.error("Writing %s failed: %s", name, e)
+        self.invalidate(name)
+
+    def take_hardware_writes(self) -> int:
+        """Number of writes sent to the hardware since the last call"""
+        with self.lock:
+            writes = self.hardware_writes
+            self.hardware_writes = 0
+        return writes
+
+    def refresh(self) -> typing.List[str]:
+        """Re-read every cached control from the hardware, and return the
+        names of the ones whose values had changed"""
+        with self.lock:
+            enums = {name: (index, self.generations.get(name, 0)) for name, index in self.enums.items()}
+            volumes = {name: (dict(v), self.generations.get(name, 0)) for name, v in self.volumes.items()}
+
+        changed = []
+        for name, (index, generation) in enums.items():
+            current, _ = self.read(self.raw_mixer_elems[name].getenum)
+            new_index = self.choice_indexes[name][current]
+            with self.lock:
+                if new_index != index and self.generations.get(name, 0) == generation:
+                    self.enums[name] = new_index
+                    self.changed(name)
+                    changed.append(name)
+
+        for name, (cached_volumes, generation) in volumes.items():
+            getvolume = self.raw_mixer_elems[name].getvolume
+            new_volumes = {key: self.read(functools.partial(getvolume, pcmtype=key[0], units=key[1]))
+                           for key in cached_volumes}
+            with self.lock:
+                if new_volumes != cached_volumes and self.generations.get(name, 0) == generation:
+                    self.volumes[name] = new_volumes
+                    self.changed(name)
+                    changed.append(name)
+
+        for name in changed:
+            self.notify(name)
+        return changed
+
+    def getenum(self, name: str):
+        with self.lock:
+            if name in self.enums:
+                self.hits += 1
+                choices = self.choices[name]
+                return choices[self.enums[name]], list(choices)
+            if name in self.not_enums:
+                self.hits += 1
+                return ()
+            self.misses += 1
+            generation = self.generations.get(name, 0)
+
+        enum = self.read(self.raw_mixer_elems[name].getenum)
+        with self.lock:
+            if not enum:
+                self.not_enums.add(name)
+                return enum
+            if name not in self.choices:
+                self.choices[name] = tuple(enum[1])
+                self.choice_indexes[name] = {c: i for i, c in enumerate(enum[1])}
+            if self.generations.get(name, 0) == generation:
+                self.enums[name] = self.choice_indexes[name][enum[0]]
+            return enum[0], list(self.choices[name])
+
+    def index_of(self, name: str, choice: str) -> int:
+        """Index of `choice` in the enum choices of `name`, or -1"""
+        with self.lock:
+            if name in self.choice_indexes:
+                return self.choice_indexes[name].get(choice, -1)
+        self.getenum(name)
+        return self.choice_indexes.get(name, {}).get(choice, -1)
+
+    def collecting(self) -> typing.Optional["Transaction"]:
+        """The transaction collecting this thread's writes, if any"""
+        return getattr(self.local, "transaction", None)
+
+    def setenum(self, name: str, index: int, force: bool = False):
+        transaction = self.collecting()
+        if transaction:
+            transaction.setenum(name, index, force)
+            return
+        with self.lock:
+            if self.suppress_writes and not force and self.enums.get(name) == index:
+                self.suppressed += 1
+                return
+            if name in self.choices:
+                self.enums[name] = index
+            self.changed(name)
+        self.write(name, functools.partial(self.raw_mixer_elems[name].setenum, index))
+        self.notify(name)
+
+    def getvolume(self, name: str, pcmtype: int, units: int) -> typing.List[int]:
+        with self.lock:
+            volumes = self.volumes.get(name, {})
+            if (pcmtype, units) in volumes:
+                self.hits += 1
+                return list(volumes[(pcmtype, units)])
+            self.misses += 1
+            generation = self.generations.get(name, 0)
+
+        volume = self.read(functools.partial(self.raw_mixer_elems[name].getvolume,
+                                             pcmtype=pcmtype, units=units))
+
+        with self.lock:
+            if self.generations.get(name, 0) == generation:
+                self.volumes.setdefault(name, {})[(pcmtype, units)] = volume
+            return list(volume)
+
+    def setvolume(self, name: str, volume: int, pcmtype: int, units: int, force: bool = False):
+        transaction = self.collecting()
+        if transaction:
+            transaction.setvolume(name, volume, pcmtype, units, force)
+            return
+        with self.lock:
+            if self.suppress_writes and not force and \
+                    self.volumes.get(name, {}).get((pcmtype, units)) == [volume]:
+                self.suppressed += 1
+                return
+            # The value in any other units is unknown until it is read back
+            self.volumes[name] = {(pcmtype, units): [volume]}
+            self.changed(name)
+            generation = self.generations[name]
+        self.write(name, functools.partial(self.write_volume, name, volume, pcmtype, units, generation))
+        self.notify(name)
+
+    def write_volume(self, name: str, volume: int, pcmtype: int, units: int, generation: int):
+        """Write a volume to the hardware, and correct the cached value if
+        the driver rounded it to the nearest step it supports"""
+        raw = self.raw_mixer_elems[name]
+        raw.setvolume(volume, pcmtype=pcmtype, units=units)
+        if units == alsaaudio.VOLUME_UNITS_RAW or not self.read_back_volumes:
+            return
+        with self.lock:
+            if self.generations.get(name, 0) != generation:
+                # Already written again, e.g. by a ramp
+                return
+        accepted = raw.getvolume(pcmtype=pcmtype, units=units)
+        if all(v == volume for v in accepted):
+            return
+        with self.lock:
+            if self.generations.get(name, 0) != generation:
+                return
+            self.volumes[name] = {(pcmtype, units): accepted}
+            self.changed(name)
+        self.notify(name)
+
+    def sync(self):
+        """Wait for the writes queued on the I/O worker to reach the
+        hardware"""
+        if self.io_worker and not self.io_worker.on_worker_thread():
+            self.io_worker.call(lambda: None)
+
+    def getrange(self, name: str, pcmtype: int, units: int) -> typing.Tuple[int, int]:
+        key = (name, pcmtype, units)
+        with self.lock:
+            if key in self.ranges:
+                return self.ranges[key]
+        vrange = self.read(functools.partial(self.raw_mixer_elems[name].getrange,
+                                             pcmtype=pcmtype, units=units))
+        with self.lock:
+            self.ranges[key] = vrange
+        return vrange
+
+
+class CachedMixer:
+    """Drop-in replacement for an alsaaudio.Mixer which goes through a
+    MixerStateCache"""
+    def __init__(self, cache: MixerStateCache, name: str):
+        self.cache = cache
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.cache.raw_mixer_elems[self.name], attr)
+
+    def mixer(self) -> str:
+        return self.name
+
+    def control_names(self) -> typing.List[str]:
+        return [self.name]
+
+    def getenum(self):
+        return self.cache.getenum(self.name)
+
+    def setenum(self, index: int, force: bool = False):
+        self.cache.setenum(self.name, index, force)
+
+    def index_of(self, choice: str) -> int:
+        return self.cache.index_of(self.name, choice)
+
+    def getvolume(self, pcmtype=alsaaudio.PCM_PLAYBACK,
+                  units=alsaaudio.VOLUME_UNITS_PERCENTAGE) -> typing.List[int]:
+        return self.cache.getvolume(self.name, pcmtype, units)
+
+    def setvolume(self, volume: int, pcmtype=alsaaudio.PCM_PLAYBACK,
+                  units=alsaaudio.VOLUME_UNITS_PERCENTAGE, force: bool = False):
+        self.cache.setvolume(self.name, volume, pcmtype, units, force)
+
+    def getrange(self, pcmtype=alsaaudio.PCM_PLAYBACK,
+                 units=alsaaudio.VOLUME_UNITS_RAW) -> typing.Tuple[int, int]:
+        return self.cache.getrange(self.name, pcmtype, units)
+
+
+class Subscription:
+    def __init__(self, control_names: typing.List[str], callback: typing.Callable[[], None]):
+        self.control_names = control_names
+        self.callback = callback
+        # Set while a call is waiting to be dispatched, so a burst of changes
+        # (e.g. from a fader drag) only queues one
+        self.queued = False
+
+
+class StateStore:
+    """The current value of every control, with subscriptions to changes of
+    particular controls.
+
+    Values come from a MixerStateCache, so reading them rarely touches the
+    hardware. Subscribers give the names of the controls they show, or an
+    object with control_names() such as a StereoVolumeMixer, and are called
+    with no arguments when any of them is written, invalidated or changed
+    outside redmixctl. Only subscribers to the controls which changed are
+    called.
+
+    Changes happen on whichever thread made them, so if `dispatch` is set
+    (e.g. to wx.CallAfter) callbacks are run through it, and a subscriber
+    which is already waiting to be called isn't queued again.
+    """
+    def __init__(self, cache: MixerStateCache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.subscriptions: typing.Dict[str, typing.List[Subscription]] = {}
+        self.dispatch: typing.Optional[typing.Callable[..., None]] = None
+        cache.add_listener(self.on_changed)
+
+    def subscribe(self, controls: typing.Union[str, typing.Iterable[str], SupportsControlNames],
+                  callback: typing.Callable[[], None]) -> Subscription:
+        if isinstance(controls, str):
+            names = [controls]
+        elif hasattr(controls, "control_names"):
+            names = typing.cast(SupportsControlNames, controls).control_names()
+        else:
+            names = list(typing.cast(typing.Iterable[str], controls))
+        subscription = Subscription(names, callback)
+        with self.lock:
+            for name in names:
+                self.subscriptions.setdefault(name, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for name in subscription.control_names:
+                self.subscriptions[name].remove(subscription)
+
+    def get(self, name: str, units: int = alsaaudio.VOLUME_UNITS_DB) -> typing.Union[str, int]:
+        """The selected choice of an enum control, or the volume of any other"""
+        mixer_elem = self.cache.mixer_elems[name]
+        enum = mixer_elem.getenum()
+        if enum:
+            return enum[0]
+        return mixer_elem.getvolume(units=units)[0]
+
+    def on_changed(self, name: typing.Optional[str]):
+        with self.lock:
+            if name is None:
+                unique = {id(s): s for subs in self.subscriptions.values() for s in subs}
+                subscriptions = list(unique.values())
+            else:
+                subscriptions = list(self.subscriptions.get(name, []))
+            if self.dispatch:
+                subscriptions = [s for s in subscriptions if not s.queued]
+                for subscription in subscriptions:
+                    subscription.queued = True
+
+        for subscription in subscriptions:
+            if self.dispatch:
+                self.dispatch(self.run_callback, subscription)
+            else:
+                subscription.callback()
+
+    def run_callback(self, subscription: Subscription):
+        with self.lock:
+            subscription.queued = False
+        subscription.callback()
+
+
+class WriteScheduler:
+    """Coalesces rapid writes to the same control, e.g. from a fader drag.
+
+    Only the latest pending write for each key is kept, and each key is
+    written at most `max_rate` times a second from a background thread.
+    Intermediate values are dropped, but the last value submitted for a key
+    is always written. Writes are made by passing them to `execute`, which
+    by default calls them straight away.
+    """
+    def __init__(self, max_rate: float = 60.0,
+                 execute: typing.Optional[typing.Callable[[typing.Callable[[], None]], None]] = None):
+        self.min_interval = 1.0 / max_rate
+        self.execute = execute or (lambda write: write())
+        self.cond = threading.Condition()
+        # key -> (write, time the oldest unwritten value was submitted)
+        self.pending: typing.Dict[str, typing.Tuple[typing.Callable[[], None], float]] = {}
+        self.last_write: typing.Dict[str, float] = {}
+        self.thread: typing.Optional[threading.Thread] = None
+        self.stopping = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flush_latency_total = 0.0
+        self.flush_latency_max = 0.0
+
+    def is_pending(self, key: str) -> bool:
+        """Whether a value submitted for `key` hasn't been written yet"""
+        with self.cond:
+            return key in self.pending
+
+    def submit(self, key: str, write: typing.Callable[[], None]):
+        with self.cond:
+            self.submitted += 1
+            submitted_at = time.monotonic()
+            if key in self.pending:
+                self.coalesced += 1
+                submitted_at = self.pending[key][1]
+            self.pending[key] = (write, submitted_at)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="WriteScheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def take_due(self, now: float, flush_all: bool = False) \
+            -> typing.Tuple[typing.List[typing.Tuple[str, typing.Callable[[], None], float]],
+                            typing.Optional[float]]:
+        """Remove and return the pending writes which may be made now, and
+        how long until the next one is due"""
+        due = []
+        wait: typing.Optional[float] = None
+        for key, (write, submitted_at) in list(self.pending.items()):
+            next_allowed = self.last_write.get(key, 0.0) + self.min_interval
+            if flush_all or next_allowed <= now:
+                due.append((key, write, submitted_at))
+                del self.pending[key]
+                self.last_write[key] = now
+            elif wait is None or next_allowed - now < wait:
+                wait = next_allowed - now
+        return due, wait
+
+    def write(self, key: str, write: typing.Callable[[], None], submitted_at: float):
+        try:
+            write()
+        except Exception:
+            logger.exception("Write to %s failed", key)
+        latency = time.monotonic() - submitted_at
+        with self.cond:
+            self.written += 1
+            self.flush_latency_total += latency
+            self.flush_latency_max = max(self.flush_latency_max, latency)
+
+    def run(self):
+        while True:
+            with self.cond:
+                due, wait = self.take_due(time.monotonic())
+                while not due and not self.stopping:
+                    self.cond.wait(wait)
+                    due, wait = self.take_due(time.monotonic())
+                if not due and self.stopping:
+                    return
+            for key, write, submitted_at in due:
+                self.execute(functools.partial(self.write, key, write, submitted_at))
+
+    def flush(self):
+        """Make all pending writes now"""
+        with self.cond:
+            due, _ = self.take_due(time.monotonic(), flush_all=True)
+        for key, write, submitted_at in due:
+            self.execute(functools.partial(self.write, key, write, submitted_at))
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def metrics(self) -> typing.Dict[str, float]:
+        with self.cond:
+            mean_latency = self.flush_latency_total / self.written if self.written else 0.0
+            return {
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "pending": len(self.pending),
+                "flush_latency_mean_ms": 1000 * mean_latency,
+                "flush_latency_max_ms": 1000 * self.flush_latency_max,
+            }
+
+
+# Ramp curves, giving the volume (in hundredths of a dB) a fraction `t` of
+# the way from `start` to `target`
+def linear_db(start: int, target: int, t: float) -> float:
+    return start + (target - start) * t
+
+
+def equal_power(start: int, target: int, t: float) -> float:
+    """The amplitudes of the start and target are crossfaded so that their
+    total power stays the same, as in a DJ mixer's crossfader"""
+    amp_start = 10 ** (start / 2000.0) * math.cos(t * math.pi / 2)
+    amp_target = 10 ** (target / 2000.0) * math.sin(t * math.pi / 2)
+    return 1000 * math.log10(amp_start ** 2 + amp_target ** 2)
+
+
+LINEAR_DB = "linear-db"
+EQUAL_POWER = "equal-power"
+CURVES: typing.Dict[str, typing.Callable[[int, int, float], float]] = {
+    LINEAR_DB: linear_db,
+    EQUAL_POWER: equal_power,
+}
+
+
+class Ramp:
+    """One gain moving to a target over time, in dB"""
+    def __init__(self, mixer_elem: SupportsVolumeMixer, target: int, start_time: float,
+                 duration: float, curve: str):
+        self.mixer_elem = mixer_elem
+        self.name = mixer_elem.mixer()
+        self.vmin, self.vmax = mixer_elem.getrange(units=alsaaudio.VOLUME_UNITS_DB)
+        self.start = mixer_elem.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0]
+        self.target = max(self.vmin, min(self.vmax, target))
+        self.start_time = start_time
+        self.duration = duration
+        self.curve = CURVES[curve]
+        # The last value written, to notice anything else writing the gain
+        self.written: typing.Optional[int] = None
+        self.writes = 0
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def value_at(self, now: float) -> int:
+        t = min(1.0, (now - self.start_time) / self.duration) if self.duration > 0 else 1.0
+        return max(self.vmin, min(self.vmax, round(self.curve(self.start, self.target, t))))
+
+    def finished_at(self, now: float) -> bool:
+        return now >= self.start_time + self.duration
+
+
+class Fade:
+    """The ramps started by one RampEngine.fade()"""
+    def __init__(self, engine: "RampEngine", ramps: typing.List[Ramp]):
+        self.engine = engine
+        self.ramps = ramps
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """Wait for every ramp to finish or be cancelled. Returns False on
+        timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for ramp in self.ramps:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not ramp.done.wait(remaining):
+                return False
+        return True
+
+    def cancel(self):
+        self.engine.cancel(*[ramp.name for ramp in self.ramps])
+
+    def cancelled(self) -> typing.List[str]:
+        """Names of the gains whose ramps were cancelled"""
+        return [ramp.name for ramp in self.ramps if ramp.cancelled]
+
+
+class RampEngine:
+    """Moves gains smoothly to target values over time.
+
+    All the active ramps are advanced together by one thread, at a fixed
+    tick rate, and each tick's values are written in one batch: one job on
+    the I/O worker if there is one. If the worker hasn't finished the last
+    tick's batch, the tick is skipped rather than queueing writes behind it,
+    so a slow card makes a fade coarser rather than longer. Values come
+    from the time since the ramp started, not from counting ticks.
+
+    A ramp is cancelled, leaving the gain where it is, if anything else
+    writes the gain while it runs (e.g. the user grabs the fader), or if
+    cancel() is called with its name.
+    """
+    TICK_RATE = 50.0
+
+    def __init__(self, cache: MixerStateCache, tick_rate: float = TICK_RATE):
+        self.cache = cache
+        self.interval = 1.0 / tick_rate
+        self.cond = threading.Condition()
+        self.ramps: typing.Dict[str, Ramp] = {}
+        self.thread: typing.Optional[threading.Thread] = None
+        self.stopping = False
+        # Set while a tick's batch is waiting for the I/O worker
+        self.in_flight = threading.Event()
+
+        self.ticks = 0
+        self.skipped = 0
+        self.writes = 0
+        self.cancelled = 0
+        self.lateness_max = 0.0
+
+    def fade(self, targets: typing.Iterable[typing.Tuple[SupportsVolumeMixer, int]],
+             duration: float, curve: str = LINEAR_DB) -> Fade:
+        """Ramp each mixer element to its target volume (in hundredths of a
+        dB) over `duration` seconds. A ramp already running on one of them
+        is replaced. Mixer elements already at their target are left alone."""
+        now = time.monotonic()
+        ramps = [Ramp(mixer_elem, target, now, duration, curve) for mixer_elem, target in targets]
+        with self.cond:
+            for ramp in ramps:
+                if ramp.start == ramp.target:
+                    ramp.done.set()
+                    continue
+                replaced = self.ramps.pop(ramp.name, None)
+                if replaced:
+                    replaced.done.set()
+                self.ramps[ramp.name] = ramp
+            if self.thread is None and self.ramps:
+                self.thread = threading.Thread(target=self.run, name="RampEngine", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        return Fade(self, ramps)
+
+    def cancel(self, *names: str):
+        """Stop ramping each of `names` which is being ramped"""
+        with self.cond:
+            for name in names:
+                ramp = self.ramps.pop(name, None)
+                if ramp:
+                    self.cancel_ramp(ramp)
+
+    def cancel_ramp(self, ramp: Ramp):
+        """Must be called with the lock held"""
+        logger.debug("Cancelled ramp of %s", ramp.name)
+        ramp.cancelled = True
+        ramp.done.set()
+        self.cancelled += 1
+
+    def is_ramping(self, name: str) -> bool:
+        with self.cond:
+            return name in self.ramps
+
+    def run(self):
+        next_tick = time.monotonic()
+        while True:
+            with self.cond:
+                while not self.ramps and not self.stopping:
+                    self.cond.wait()
+                    next_tick = time.monotonic()
+                if self.stopping:
+                    return
+                now = time.monotonic()
+                if now < next_tick:
+                    self.cond.wait(next_tick - now)
+                    continue
+                self.lateness_max = max(self.lateness_max, now - next_tick)
+                # Don't try to catch up on missed ticks
+                next_tick = max(next_tick + self.interval, now)
+            self.tick(now)
+
+    def tick(self, now: float):
+        if self.in_flight.is_set():
+            with self.cond:
+                self.skipped += 1
+            return
+
+        writes: typing.List[typing.Tuple[Ramp, int]] = []
+        finished: typing.List[Ramp] = []
+        with self.cond:
+            self.ticks += 1
+            for name, ramp in list(self.ramps.items()):
+                if ramp.written is not None and \
+                        ramp.mixer_elem.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] != ramp.written:
+                    del self.ramps[name]
+                    self.cancel_ramp(ramp)
+                    continue
+                ramp.written = ramp.value_at(now)
+                ramp.writes += 1
+                writes.append((ramp, ramp.written))
+                if ramp.finished_at(now):
+                    del self.ramps[name]
+                    finished.append(ramp)
+            self.writes += len(writes)
+
+        if self.cache.io_worker:
+            self.in_flight.set()
+            self.cache.io_worker.submit(functools.partial(self.write, writes, finished))
+        else:
+            self.write(writes, finished)
+
+    def write(self, writes: typing.List[typing.Tuple[Ramp, int]], finished: typing.List[Ramp]):
+        try:
+            with self.cache.batch():
+                for ramp, volume in writes:
+                    ramp.mixer_elem.setvolume(volume, units=alsaaudio.VOLUME_UNITS_DB)
+                    # The driver may have rounded it. The next tick waits for
+                    # this one's writes, so it sees the update.
+                    ramp.written = ramp.mixer_elem.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0]
+        finally:
+            self.in_flight.clear()
+            # Only once their final values have been written
+            for ramp in finished:
+                ramp.done.set()
+
+    def stop(self):
+        """Cancel every ramp and stop the thread"""
+        with self.cond:
+            for ramp in self.ramps.values():
+                self.cancel_ramp(ramp)
+            self.ramps.clear()
+            self.stopping = True
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+
+    def metrics(self) -> typing.Dict[str, float]:
+        with self.cond:
+            return {
+                "active": len(self.ramps),
+                "ticks": self.ticks,
+                "skipped_ticks": self.skipped,
+                "writes": self.writes,
+                "cancelled": self.cancelled,
+                "tick_lateness_max_ms": 1000 * self.lateness_max,
+            }
+
+
+class ChangeMonitor:
+    """Watches for changes to a card's controls made outside redmixctl (e.g.
+    by alsamixer, or a hardware knob), using ALSA's control change events.
+
+    pyalsaaudio only says how many events happened on a handle, not which
+    control they were for. Our own writes generate events too, so these are
+    counted off against the writes the cache has made. When there are more
+    events than that, the cached controls are re-read and `on_change` is
+    called from the monitor thread with the names of the ones that changed.
+    """
+    SETTLE_TIME = 0.02  # Wait for bursts of events to finish before handling them
+    IDLE_TIMEOUT_MS = 1000
+
+    def __init__(self, card_index: int, cache: MixerStateCache,
+                 on_change: typing.Optional[typing.Callable[[typing.List[str]], None]] = None):
+        self.card_index = card_index
+        self.cache = cache
+        self.on_change = on_change
+        self.stop_pipe = os.pipe()
+        self.thread = threading.Thread(target=self.run, name="ChangeMonitor", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_pipe[1], b"\0")
+        self.thread.join()
+        os.close(self.stop_pipe[0])
+        os.close(self.stop_pipe[1])
+
+    def run(self):
+        control = next(iter(self.cache.raw_mixer_elems), None)
+        if control is None:
+            logger.warning("Card %d has no controls to monitor", self.card_index)
+            return
+        # The monitor has its own handle, so it never touches the IOWorker's
+        handle = alsaaudio.Mixer(control=control, cardindex=self.card_index)
+        try:
+            self.monitor(handle)
+        finally:
+            handle.close()
+
+    def monitor(self, handle: alsaaudio.Mixer):
+        import select
+        poller = select.poll()
+        for fd, eventmask in handle.polldescriptors():
+            poller.register(fd, eventmask)
+        poller.register(self.stop_pipe[0], select.POLLIN)
+
+        # Events expected from our own writes which haven't arrived yet
+        # (negative), or events not explained by our own writes (positive).
+        balance = 0
+        self.cache.take_hardware_writes()
+        while True:
+            ready = poller.poll(self.IDLE_TIMEOUT_MS)
+            if any(fd == self.stop_pipe[0] for fd, _ in ready):
+                break
+            if not ready:
+                # A write of an unchanged value generates no event, so don't
+                # keep waiting for one forever.
+                balance = 0
+                continue
+
+            time.sleep(self.SETTLE_TIME)
+            balance += handle.handleevents() - self.cache.take_hardware_writes()
+            if balance > 0:
+                balance = 0
+                changed = self.cache.refresh()
+                logger.debug("External changes to %s", ", ".join(changed) or "nothing")
+                if changed and self.on_change:
+                    self.on_change(changed)
 
 
 class StereoVolumeMixer:
-    def __init__(self, mixer_elem_L: alsaaudio.Mixer, mixer_elem_R: alsaaudio.Mixer,
-                 zero: typing.List[alsaaudio.Mixer]):
+    def __init__(self, mixer_elem_L: CachedMixer, mixer_elem_R: CachedMixer,
+                 zero: typing.List[CachedMixer]):
         self.L = mixer_elem_L
         self.R = mixer_elem_R
         self.zero = zero
@@ -54,6 +1032,9 @@ class StereoVolumeMixer:
     def mixer(self) -> str:
         return CHANNEL_SEPARATOR.join([self.L.mixer(), self.R.mixer()])
 
+    def control_names(self) -> typing.List[str]:
+        return [self.L.mixer(), self.R.mixer()] + [z.mixer() for z in self.zero]
+
     def getrange(self, units=alsaaudio.VOLUME_UNITS_RAW):
         lmin, lmax = self.L.getrange(units=units)
         rmin, rmax = self.R.getrange(units=units)
@@ -66,15 +1047,16 @@ class StereoVolumeMixer:
         volume_R = self.R.getvolume(units=units)[0]
         return [int((volume_L + volume_R) / 2)]
 
-    def setvolume(self, volume: int, units=alsaaudio.VOLUME_UNITS_PERCENTAGE):
-        self.L.setvolume(volume, units=units)
-        self.R.setvolume(volume, units=units)
-        for z in self.zero:
-            z.setvolume(0)
+    def setvolume(self, volume: int, units=alsaaudio.VOLUME_UNITS_PERCENTAGE, force: bool = False):
+        with self.L.cache.batch():
+            self.L.setvolume(volume, units=units, force=force)
+            self.R.setvolume(volume, units=units, force=force)
+            for z in self.zero:
+                z.setvolume(0, force=force)
 
 
 class StereoEnumMixer:
-    def __init__(self, mixer_elem_L: alsaaudio.Mixer, mixer_elem_R: alsaaudio.Mixer,
+    def __init__(self, mixer_elem_L: CachedMixer, mixer_elem_R: CachedMixer,
                  linked_sources: typing.List[typing.Tuple[str, str]]):
         self.L = mixer_elem_L
         self.R = mixer_elem_R
@@ -91,9 +1073,22 @@ class StereoEnumMixer:
             self.choices.remove(choice_R)
             self.choices.append(CHANNEL_SEPARATOR.join([choice_L, choice_R]))
 
+        # For each choice, the index of the choice to write to each channel
+        self.choice_indexes = {c: i for i, c in enumerate(self.choices)}
+        self.channel_indexes: typing.List[typing.Tuple[int, int]] = []
+        for choice_str in self.choices:
+            channels = choice_str.split(CHANNEL_SEPARATOR)
+            if len(channels) == 1:
+                channels = [channels[0], channels[0]]
+            assert len(channels) == 2, f"More than 2 channels in '{choice_str}'"
+            self.channel_indexes.append((self.L.index_of(channels[0]), self.R.index_of(channels[1])))
+
     def mixer(self) -> str:
         return CHANNEL_SEPARATOR.join([self.L.mixer(), self.R.mixer()])
 
+    def control_names(self) -> typing.List[str]:
+        return [self.L.mixer(), self.R.mixer()]
+
     def getenum(self) -> typing.Tuple[str, typing.List[str]]:
         current_L, choices_L = self.L.getenum()
         current_R, choices_R = self.R.getenum()
@@ -118,17 +1113,15 @@ class StereoEnumMixer:
         set_enum_value(self.R, "Off")
         return "Off", self.choices
 
-    def setenum(self, choice: int):
-        choice_str = self.choices[choice]
-        channels = choice_str.split(CHANNEL_SEPARATOR)
-        if len(channels) == 1:
-            set_enum_value(self.L, channels[0])
-            set_enum_value(self.R, channels[0])
-        elif len(channels) == 2:
-            set_enum_value(self.L, channels[0])
-            set_enum_value(self.R, channels[1])
-        else:
-            assert False, f"More than 2 channels in '{choice_str}'"
+    def index_of(self, choice: str) -> int:
+        return self.choice_indexes.get(choice, -1)
+
+    def setenum(self, choice: int, force: bool = False):
+        index_L, index_R = self.channel_indexes[choice]
+        logger.debug("Setting %s to %s", self.mixer(), self.choices[choice])
+        with self.L.cache.batch():
+            self.L.setenum(index_L, force)
+            self.R.setenum(index_R, force)
 
 
 class Source:
@@ -136,33 +1129,28 @@ class Source:
         self.interface = interface
         self.name = name
 
-        # At init, try and detect if this input is already set as a mixer input
-        self.mixer_input = None
-        for mixer_input in self.interface.model.mixer_inputs:
-            mixer_elem = self.interface.mixer_elems[mixer_input]
-            current_value, _ = mixer_elem.getenum()
-            if current_value == self.name:
-                self.mixer_input = mixer_input
-
-
-def set_enum_value(mixer_elem: alsaaudio.Mixer, enum_value):
-    current, enum_values = mixer_elem.getenum()
-    current_index = -1
-    target_index = -1
-    for index in range(0, len(enum_values)):
-        if enum_values[index] == current:
-            current_index = index
-        if enum_values[index] == enum_value:
-            target_index = index
-
-    if target_index < 0 or target_index >= len(enum_values):
+    @property
+    def mixer_input(self) -> typing.Optional[str]:
+        """The mixer input this source is routed to, if any"""
+        mixer_inputs = self.interface.source_mixer_inputs.get(self.name)
+        return mixer_inputs[-1] if mixer_inputs else None
+
+
+def set_enum_value(mixer_elem: SupportsEnumMixer, enum_value: str, force: bool = False):
+    target_index = mixer_elem.index_of(enum_value)
+
+    if target_index < 0:
         logger.error("Couldn't set enum value for %s to '%s' (choices: %s)"
-                     % (mixer_elem.mixer(), enum_value, str(enum_values)))
+                     % (mixer_elem.mixer(), enum_value, str(mixer_elem.getenum()[1])))
         return
 
-    logger.debug("Setting %s from %s [%d] to %s [%d]" %
-                 (mixer_elem.mixer(), current, current_index, enum_value, target_index))
-    mixer_elem.setenum(target_index)
+    logger.debug("Setting %s to %s [%d]" % (mixer_elem.mixer(), enum_value, target_index))
+    mixer_elem.setenum(target_index, force)
+
+
+def is_enum(mixer_elem) -> bool:
+    # getenum() returns an empty tuple for controls which aren't enums
+    return bool(mixer_elem.getenum())
 
 
 class Output:
@@ -182,6 +1170,40 @@ class MixerInput:
         return self.mixer_elem.getenum()[0]
 
 
+class MixerInputRouting:
+    """The source selected for each mixer input. Every mix uses the same
+    mixer inputs, so this is shared by all the widgets which show or change
+    them: a change is one write, and observers are told the new value
+    rather than each re-reading it."""
+    def __init__(self, mixer_inputs: typing.List[MixerInput], store: StateStore):
+        self.mixer_inputs = mixer_inputs
+        self.observers: typing.List[typing.Callable[[int, str], None]] = []
+        for index, mixer_input in enumerate(mixer_inputs):
+            store.subscribe(mixer_input.mixer_elem, functools.partial(self.notify, index))
+
+    def add_observer(self, observer: typing.Callable[[int, str], None]):
+        """Call `observer` with the index of the mixer input and its new
+        source whenever the source changes"""
+        self.observers.append(observer)
+
+    def remove_observer(self, observer: typing.Callable[[int, str], None]):
+        self.observers.remove(observer)
+
+    def choices(self, index: int) -> typing.List[str]:
+        return list(self.mixer_inputs[index].mixer_elem.getenum()[1])
+
+    def get(self, index: int) -> str:
+        return self.mixer_inputs[index].get_value()
+
+    def select(self, index: int, choice: int):
+        self.mixer_inputs[index].mixer_elem.setenum(choice)
+
+    def notify(self, index: int):
+        value = self.get(index)
+        for observer in self.observers:
+            observer(index, value)
+
+
 class Mix:
     def __init__(self, interface, name_L, name_R,
                  input_volume_control_names_L, input_volume_control_names_R,
@@ -217,54 +1239,495 @@ class Mix:
                                                       zero=[interface.mixer_elems[i] for i in zero]))
 
 
-def get_mixer_elems(card_index: int) -> typing.Dict[str, alsaaudio.Mixer]:
-    # Get the mixer element for each available mixer control
-    mixer_elems: typing.Dict[str, alsaaudio.Mixer] = {}
-    for mixer_elem_name in alsaaudio.mixers(cardindex=card_index):
-        elem = alsaaudio.Mixer(control=mixer_elem_name, cardindex=card_index)
-        assert mixer_elem_name not in mixer_elems
-        mixer_elems[mixer_elem_name] = elem
-    return mixer_elems
+class MixerElems(collections.abc.Mapping):
+    """The mixer elements of a card, by control name.
+
+    Listing a card's controls is cheap, but opening each one is an
+    snd_mixer open and element lookup, and most of them are never used
+    (e.g. the mix gains of tabs which are never shown). So an element is
+    only opened the first time it is looked up, and the handle is kept.
+    """
+    def __init__(self, card_index: int, stats: typing.Optional["instrument.CallStats"] = None,
+                 names: typing.Optional[typing.List[str]] = None):
+        self.card_index = card_index
+        self.stats = stats
+        # `names` lets a card listed by a probe process skip listing it again
+        self.names = list(alsaaudio.mixers(cardindex=card_index)) if names is None else names
+        self.name_set = frozenset(self.names)
+        assert len(self.name_set) == len(self.names)
+        self.lock = threading.Lock()
+        self.opened: typing.Dict[str, alsaaudio.Mixer] = {}
+
+    def __getitem__(self, name: str) -> alsaaudio.Mixer:
+        elem = self.opened.get(name)
+        if elem is not None:
+            return elem
+        if name not in self.name_set:
+            raise KeyError(name)
+        with self.lock:
+            if name not in self.opened:
+                elem = alsaaudio.Mixer(control=name, cardindex=self.card_index)
+                if self.stats:
+                    import instrument
+                    elem = typing.cast(alsaaudio.Mixer, instrument.InstrumentedMixer(elem, self.stats))
+                self.opened[name] = elem
+            return self.opened[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.name_set
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+def get_mixer_elems(card_index: int, stats: typing.Optional["instrument.CallStats"] = None) \
+        -> MixerElems:
+    return MixerElems(card_index, stats)
+
+
+class SupportedCard:
+    """A card which matched one of the models"""
+    def __init__(self, card_index: int, name: str, model: models.Model,
+                 mixer_elems: MixerElems, probe_time: float):
+        self.card_index = card_index
+        self.name = name
+        self.model = model
+        self.mixer_elems = mixer_elems
+        # Seconds taken to open and validate the card
+        self.probe_time = probe_time
+
+
+def warn_validation_failed(card_index: int, name: str, model: models.Model):
+    logger.warning("Card %d [%s] does not match the %s model",
+                   card_index, name, model.canonical_name)
+    logger.warning("Are controls enabled in the kernel driver? " +
+                   "You may need to run something like the following:")
+    logger.warning("  echo 'options snd_usb_audio device_setup=1' " +
+                   "| sudo tee /etc/modprobe.d/scarlett-internal-mixer.conf")
+
+
+def probe_card(card_index: int, name: str, longname: str, candidates: typing.List[models.Model],
+               stats: typing.Optional["instrument.CallStats"] = None,
+               validation_cache: typing.Optional["fingerprint.ValidationCache"] = None) \
+        -> typing.Optional[SupportedCard]:
+    """Open a card once and validate it against each model with its name"""
+    start = time.perf_counter()
+    mixer_elems = get_mixer_elems(card_index, stats)
+    for model in candidates:
+        logger.debug("Card %d matches model name %s [%s]",
+                     card_index, model.canonical_name, model.name)
+        if validation_cache:
+            valid = validation_cache.validate(model, longname, mixer_elems)
+        else:
+            valid = model.validate_mixer_elems(mixer_elems)
+        if valid:
+            return SupportedCard(card_index, name, model, mixer_elems, time.perf_counter() - start)
+        warn_validation_failed(card_index, name, model)
+    return None
+
+
+# Seconds to wait for the cards to be probed before giving up on any which
+# haven't finished
+PROBE_TIMEOUT = 10.0
+
+# What a probe process sends back: the canonical name of the model the card
+# matched (or None), the names of the controls it validated, the probe time,
+# the validation cache's updates, and an error message if the probe failed
+ProbeResult = typing.Tuple[typing.Optional[str], typing.List[str], float,
+                           typing.Dict[str, typing.Optional[typing.Dict[str, typing.Any]]],
+                           typing.Optional[str]]
+
+
+def run_probe(sender: "multiprocessing.connection.Connection", card_index: int, name: str, longname: str,
+              candidates: typing.List[models.Model],
+              validation_cache: typing.Optional["fingerprint.ValidationCache"]):
+    """Body of a probe process"""
+    result: ProbeResult
+    start = time.perf_counter()
+    try:
+        if validation_cache:
+            # The parent merges the updates of every probe, and saves once
+            validation_cache.autosave = False
+            validation_cache.updates.clear()
+        card = probe_card(card_index, name, longname, candidates, None, validation_cache)
+        result = (card.model.canonical_name if card else None, card.mixer_elems.names if card else [],
+                  time.perf_counter() - start, validation_cache.updates if validation_cache else {}, None)
+    except Exception as e:
+        result = (None, [], time.perf_counter() - start, {}, f"{type(e).__name__}: {e}")
+    sender.send(result)
+    sender.close()
+
+
+def probe_in_processes(candidates: typing.Dict[int, typing.Tuple[str, str, typing.List[models.Model]]],
+                       stats: typing.Optional["instrument.CallStats"],
+                       validation_cache: typing.Optional["fingerprint.ValidationCache"],
+                       timeout: float) \
+        -> typing.Dict[int, typing.Tuple[typing.Optional[SupportedCard], float]]:
+    """Probe each of `candidates` (name, longname and candidate models, by
+    card index) in its own process, giving each `timeout` seconds. Returns
+    the card each probe found, or None if the card didn't match, and its
+    probe time, for the cards whose probe finished."""
+    import multiprocessing
+    import multiprocessing.connection
+    context = multiprocessing.get_context("fork")
+    probes = {}
+    for card_index, (name, longname, models_for_name) in candidates.items():
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_probe, name=f"Probe card {card_index}", daemon=True,
+                                  args=(sender, card_index, name, longname, models_for_name,
+                                        validation_cache))
+        process.start()
+        sender.close()
+        probes[receiver] = (card_index, process, time.monotonic() + timeout)
+
+    results: typing.Dict[int, ProbeResult] = {}
+    while probes:
+        now = time.monotonic()
+        for receiver, (card_index, process, deadline) in list(probes.items()):
+            if deadline <= now and not receiver.poll():
+                logger.warning("Card %d didn't respond within %.1f s, skipping it", card_index, timeout)
+                # A process stuck in the driver can't be waited for
+                process.kill()
+                process.join()
+                receiver.close()
+                del probes[receiver]
+        if not probes:
+            break
+        ready = multiprocessing.connection.wait(
+            list(probes), max(0.0, min(deadline for _, _, deadline in probes.values()) - now))
+        for ready_receiver in ready:
+            receiver = typing.cast(multiprocessing.connection.Connection, ready_receiver)
+            card_index, process, _ = probes.pop(receiver)
+            try:
+                results[card_index] = receiver.recv()
+            except Exception as e:
+                # e.g. EOFError if the process died
+                logger.warning("Couldn't probe card %d: %s", card_index, e)
+            finally:
+                receiver.close()
+                process.join()
+
+    matched: typing.Dict[int, typing.Tuple[typing.Optional[SupportedCard], float]] = {}
+    for card_index, (canonical_name, names, probe_time, updates, error) in sorted(results.items()):
+        if error:
+            logger.warning("Couldn't probe card %d: %s", card_index, error)
+            continue
+        if validation_cache and updates:
+            validation_cache.apply(updates)
+        name, _, models_for_name = candidates[card_index]
+        model = next((model for model in models_for_name if model.canonical_name == canonical_name), None)
+        # The probe has listed and validated the controls, so they're only
+        # opened here, as they're used
+        matched[card_index] = (SupportedCard(card_index, name, model, MixerElems(card_index, stats, names),
+                                             probe_time) if model else None, probe_time)
+
+    if validation_cache and validation_cache.updates:
+        validation_cache.save()
+    return matched
+
+
+def log_probe(card_index: int, name: str, model: typing.Optional[models.Model], probe_time: float):
+    logger.info("Card %d [%s] %s, probed in %.1f ms", card_index, name,
+                f"is a {model.canonical_name}" if model else "is not supported", probe_time * 1000)
+
+
+def discover_cards(model_list: typing.Optional[typing.List[models.Model]] = None,
+                   stats: typing.Optional["instrument.CallStats"] = None,
+                   validation_cache: typing.Optional["fingerprint.ValidationCache"] = None,
+                   timeout: float = PROBE_TIMEOUT, isolate: bool = True) \
+        -> typing.List[SupportedCard]:
+    """Find every card which matches a model in `model_list` (by default, all
+    models). Cards are enumerated once and looked up by name, and only cards
+    whose name matches a model are opened.
+
+    pyalsaaudio holds the GIL during every control access, so threads can't
+    probe cards in parallel. Unless `isolate` is False, each card whose name
+    matches is probed in its own process instead, so startup takes as long
+    as the slowest card rather than all of them. A card which hasn't been
+    probed within `timeout` seconds of its process starting is skipped with
+    a warning, and its process killed, even if it is stuck in a single call.
+    The probe sends back the controls it listed and validated, so this
+    process only opens the ones it uses; calls made while probing aren't
+    seen by `stats`.
+
+    With `isolate` False, cards are probed one after another in this
+    process, and `timeout` is ignored.
+
+    Either way, a card whose probe fails is skipped with a warning."""
+    models_by_name = models.by_card_name(model_list)
+    start = time.perf_counter()
+
+    candidates: typing.Dict[int, typing.Tuple[str, str, typing.List[models.Model]]] = {}
+    for i in alsaaudio.card_indexes():
+        (name, longname) = alsaaudio.card_name(i)
+        if name not in models_by_name:
+            logger.debug("Card %d [%s] is not a supported model", i, name)
+            continue
+        candidates[i] = (name, longname, models_by_name[name])
+
+    supported = []
+    if isolate:
+        probed = probe_in_processes(candidates, stats, validation_cache, timeout)
+        for i, (card, probe_time) in probed.items():
+            log_probe(i, candidates[i][0], card.model if card else None, probe_time)
+            if card:
+                supported.append(card)
+    else:
+        for i, (name, longname, models_for_name) in candidates.items():
+            probe_start = time.perf_counter()
+            try:
+                card = probe_card(i, name, longname, models_for_name, stats, validation_cache)
+            except Exception as e:
+                logger.warning("Couldn't probe card %d: %s", i, e)
+                continue
+            log_probe(i, name, card.model if card else None, time.perf_counter() - probe_start)
+            if card:
+                supported.append(card)
+
+    logger.debug("Probed %d cards in %.1f ms", len(candidates), (time.perf_counter() - start) * 1000)
+    return supported
+
+
+def find_card_index(model: models.Model, stats: typing.Optional["instrument.CallStats"] = None) \
+        -> typing.Tuple[int, MixerElems]:
+    """Find the first card which matches `model`. Cards are probed in this
+    process, so `stats` sees every call."""
+    for card in discover_cards([model], stats, isolate=False):
+        return card.card_index, card.mixer_elems
+    raise CardNotFoundError()
+
 
+# (control, choice or volume, pcmtype, units), with units None for enums
+PlannedWrite = typing.Tuple[str, typing.Union[str, int], int, typing.Optional[int]]
 
-def find_card_index(model: models.Model) \
-        -> typing.Tuple[int, typing.Dict[str, alsaaudio.Mixer]]:
 
-    card_indexes = alsaaudio.card_indexes()
+class Transaction:
+    """Writes collected by Interface.transaction(), to be made together.
 
-    for i in card_indexes:
-        (name, _) = alsaaudio.card_name(i)
-        if name == model.name:
-            logger.debug("Card %d matches model name %s [%s]",
-                         i, model.canonical_name, model.name)
-            mixer_elems = get_mixer_elems(i)
+    Repeated writes to a control are reduced to the last one, and writes of
+    the value a control already has are dropped. The rest are made in an
+    order which avoids audible glitches: gains being turned down first,
+    along with the gains of any mixer input whose source is changing; then
+    the source selections; then gains being turned up or restored.
 
-            if model.validate_mixer_elems(mixer_elems):
-                return i, mixer_elems
-            else:
-                logger.warning("Card %d [%s] does not match the %s model",
-                               i, name, model.canonical_name)
-                logger.warning("Are controls enabled in the kernel driver? " +
-                               "You may need to run something like the following:")
-                logger.warning("  echo 'options snd_usb_audio device_setup=1' " +
-                               "| sudo tee /etc/modprobe.d/scarlett-internal-mixer.conf")
+    Reads made while collecting see the values from before the transaction.
+    """
+    # Units in which gains are cut around a change of source
+    MUTE_UNITS = alsaaudio.VOLUME_UNITS_DB
 
-    raise CardNotFoundError()
+    def __init__(self, cache: MixerStateCache, model: models.Model):
+        self.cache = cache
+        self.model = model
+        self.enums: typing.Dict[str, int] = {}
+        self.volumes: typing.Dict[str, typing.Tuple[int, int, int]] = {}
+        self.forced: typing.Set[str] = set()
+
+        # Writes asked for, writes made, and the controls they changed
+        self.requested = 0
+        self.writes = 0
+        self.changed: typing.List[str] = []
+        # Seconds taken to plan and make the writes
+        self.elapsed = 0.0
+
+    @contextlib.contextmanager
+    def collect(self):
+        """Collect this thread's writes to the cache for the duration of the
+        block, instead of making them"""
+        assert self.cache.collecting() is None
+        self.cache.local.transaction = self
+        try:
+            yield self
+        finally:
+            self.cache.local.transaction = None
+
+    def setenum(self, name: str, index: int, force: bool = False):
+        self.requested += 1
+        self.enums[name] = index
+        if force:
+            self.forced.add(name)
+
+    def setvolume(self, name: str, volume: int, pcmtype: int, units: int, force: bool = False):
+        self.requested += 1
+        self.volumes[name] = (volume, pcmtype, units)
+        if force:
+            self.forced.add(name)
+
+    def plan(self) -> typing.List[PlannedWrite]:
+        cache = self.cache
+        switch: typing.List[PlannedWrite] = []
+        rerouted = set()
+        for name, index in self.enums.items():
+            current, choices = cache.getenum(name)
+            if choices[index] != current or name in self.forced:
+                switch.append((name, choices[index], alsaaudio.PCM_PLAYBACK, None))
+                rerouted.add(name)
+
+        cut: typing.List[PlannedWrite] = []
+        restore: typing.List[PlannedWrite] = []
+        # Gains cut to silence, with their values from before the transaction
+        muted: typing.Dict[str, int] = {}
+        for mixer_input, gains in self.model.mixer_input_gains().items():
+            if mixer_input not in rerouted:
+                continue
+            for gain in gains:
+                silent = cache.getrange(gain, alsaaudio.PCM_PLAYBACK, self.MUTE_UNITS)[0]
+                current = cache.getvolume(gain, alsaaudio.PCM_PLAYBACK, self.MUTE_UNITS)[0]
+                if current > silent:
+                    cut.append((gain, silent, alsaaudio.PCM_PLAYBACK, self.MUTE_UNITS))
+                    muted[gain] = current
+
+        for name, (volume, pcmtype, units) in self.volumes.items():
+            if name in muted:
+                if volume > cache.getrange(name, pcmtype, units)[0]:
+                    restore.append((name, volume, pcmtype, units))
+                del muted[name]
+                continue
+            current = cache.getvolume(name, pcmtype, units)[0]
+            if volume < current:
+                cut.append((name, volume, pcmtype, units))
+            elif volume > current or name in self.forced:
+                restore.append((name, volume, pcmtype, units))
+
+        # Gains which were only cut for the change of source go back to
+        # where they were
+        restore += [(gain, volume, alsaaudio.PCM_PLAYBACK, self.MUTE_UNITS)
+                    for gain, volume in muted.items()]
+        return cut + switch + restore
+
+    def commit(self):
+        """Make the planned writes. If there is an I/O worker, this waits for
+        them to reach the hardware, so `elapsed` is the real time taken."""
+        start = time.perf_counter()
+        plan = self.plan()
+        cache = self.cache
+        with cache.batch():
+            for name, value, pcmtype, units in plan:
+                force = name in self.forced
+                if units is None:
+                    cache.setenum(name, cache.index_of(name, typing.cast(str, value)), force)
+                else:
+                    cache.setvolume(name, typing.cast(int, value), pcmtype, units, force)
+                if name not in self.changed:
+                    self.changed.append(name)
+        cache.sync()
+        self.writes = len(plan)
+        self.elapsed = time.perf_counter() - start
+        logger.debug("Transaction of %d writes made %d to %d controls in %.1f ms",
+                     self.requested, self.writes, len(self.changed), self.elapsed * 1000)
 
 
 class Interface:
+    """A supported card, with its controls grouped into sources, mixes,
+    mixer inputs and outputs.
+
+    Until start_io_worker() is called, ALSA is accessed synchronously from
+    whichever thread uses the Interface. After it, the rules are:
+
+    - Only the IOWorker thread touches the alsaaudio.Mixer handles
+      (`cache.raw_mixer_elems`).
+    - Any thread may read and write through `mixer_elems` and the objects
+      built on them. Reads come from the cache, only waiting for the worker
+      on a miss. Writes update the cache and are queued to the worker.
+    - Listeners added to the cache run on the thread that made the change,
+      or on the `dispatch` thread for failed writes, so GUI listeners must
+      not assume they are on the GUI thread.
+    - Subscribers to `store` are called through `dispatch`, so they may be
+      GUI callbacks.
+    """
     NUM_STEREO_CHANNELS = 2  # TODO: Make this user-configurable
+    MAX_WRITE_RATE = 60.0  # Maximum writes per second to each fader
 
-    def __init__(self, card_index, mixer_elems, model):
+    def __init__(self, card_index, mixer_elems, model,
+                 stats: typing.Optional["instrument.CallStats"] = None,
+                 max_write_rate: float = MAX_WRITE_RATE,
+                 apply_forced_values: bool = True):
         self.card_index = card_index
-        self.mixer_elems = mixer_elems
+        self.write_scheduler = WriteScheduler(max_write_rate)
+        self.io_worker: typing.Optional[IOWorker] = None
+        self.change_monitor: typing.Optional[ChangeMonitor] = None
+        self.stopped = False
+        self.cache = MixerStateCache(mixer_elems)
+        self.mixer_elems: typing.Dict[str, typing.Any] = self.cache.mixer_elems
+        self.store = StateStore(self.cache)
+        self.ramps = RampEngine(self.cache)
         self.model = model
+        # Set if mixer_elems are instrumented, so the GUI can show statistics
+        self.stats = stats
 
         self.init_monitorable_sources()
         self.init_mixer_inputs(self.NUM_STEREO_CHANNELS)
         self.init_mixes(self.NUM_STEREO_CHANNELS)
         self.init_outputs()
-        self.init_forced_values()
+        if apply_forced_values:
+            self.init_forced_values()
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[Transaction]:
+        """Collect the writes this thread makes in the block, through any of
+        the Interface's mixer elements, and make them together at the end
+        (see Transaction). Nothing is written if the block raises. A nested
+        transaction joins the outer one."""
+        outer = self.cache.collecting()
+        if outer:
+            yield outer
+            return
+        transaction = Transaction(self.cache, self.model)
+        with transaction.collect():
+            yield transaction
+        transaction.commit()
+
+    def start_io_worker(self, dispatch: typing.Optional[typing.Callable[..., None]] = None,
+                        max_queue: int = IOWorker.MAX_QUEUE):
+        """Move all ALSA access onto a background thread. `dispatch` is used to
+        run callbacks, e.g. wx.CallAfter."""
+        assert self.io_worker is None
+        self.io_worker = IOWorker(max_queue, dispatch)
+        self.io_worker.start()
+        self.store.dispatch = dispatch
+        self.cache.io_worker = self.io_worker
+        self.write_scheduler.execute = self.io_worker.submit
+
+    def start_change_monitor(self,
+                             on_change: typing.Optional[typing.Callable[[typing.List[str]], None]] = None):
+        """Watch for controls changed outside redmixctl, and tell the store's
+        subscribers. `on_change` is also called with the names of the changed
+        controls, from the monitor thread."""
+        assert self.change_monitor is None
+        self.change_monitor = ChangeMonitor(self.card_index, self.cache, on_change)
+        self.change_monitor.start()
+
+    def stop(self):
+        """Make any pending writes and stop the background threads. Does
+        nothing if they have already been stopped."""
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.change_monitor:
+            self.change_monitor.stop()
+        self.ramps.stop()
+        self.write_scheduler.stop()
+        if self.io_worker:
+            self.io_worker.stop()
+            # Anything else is done on the caller's thread from now on
+            self.cache.io_worker = None
+
+    def metrics(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Statistics of the background threads and the cache"""
+        metrics: typing.Dict[str, typing.Dict[str, float]] = {
+            "writes": self.write_scheduler.metrics(),
+            "ramps": self.ramps.metrics(),
+            "cache": {
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+                "suppressed": self.cache.suppressed,
+            },
+        }
+        if self.io_worker:
+            metrics["io"] = self.io_worker.metrics()
+        return metrics
 
     def get_inputs(self):
         return self.sources
@@ -281,9 +1744,40 @@ class Interface:
     def get_global_settings(self):
         return [self.mixer_elems[i] for i in self.model.global_settings]
 
+    def init_routing_index(self):
+        """Read the source selected for each mixer input once, and index the
+        mixer inputs by source. The cache keeps the index up to date when
+        routing changes."""
+        self.mixer_input_sources: typing.Dict[str, str] = {}
+        self.source_mixer_inputs: typing.Dict[str, typing.List[str]] = {}
+        for name in self.model.mixer_inputs:
+            self.update_routing_index(name)
+        self.cache.add_listener(self.on_control_changed)
+
+    def update_routing_index(self, mixer_input: str):
+        source, _ = self.mixer_elems[mixer_input].getenum()
+        old_source = self.mixer_input_sources.get(mixer_input)
+        if source == old_source:
+            return
+        if old_source is not None:
+            self.source_mixer_inputs[old_source].remove(mixer_input)
+        self.mixer_input_sources[mixer_input] = source
+        # Keep each list in model order
+        mixer_inputs = self.source_mixer_inputs.setdefault(source, [])
+        mixer_inputs.append(mixer_input)
+        mixer_inputs.sort(key=self.model.mixer_inputs.index)
+
+    def on_control_changed(self, name: typing.Optional[str]):
+        if name is None:
+            for mixer_input in self.model.mixer_inputs:
+                self.update_routing_index(mixer_input)
+        elif name in self.mixer_input_sources:
+            self.update_routing_index(name)
+
     def init_monitorable_sources(self):
         """Initialise objects representing the physical inputs and PCM outputs that
         can be included in the mix"""
+        self.init_routing_index()
         self.sources = []
 
         for name in self.model.physical_inputs:
@@ -332,6 +1826,8 @@ class Interface:
             mixer_input: MixerInput = MixerInput(self, name, mixer_elem)
             self.mixer_inputs.append(mixer_input)
 
+        self.mixer_input_routing = MixerInputRouting(self.mixer_inputs, self.store)
+
     def init_mixes(self, num_stereo_channels: int):
         self.mixes = []
         self.stereo_mixes: typing.List[typing.Tuple[str, str]] = []
@@ -347,12 +1843,27 @@ class Interface:
                                   input_volume_control_names_R,
                                   num_stereo_channels))
 
-    def init_forced_values(self):
+    def init_forced_values(self, force: bool = False):
+        """Apply the model's fixed control values. Unless `force` is set, only
+        controls which don't already have the right value are written."""
+        suppressed = self.cache.suppressed
+
         for name in self.model.force_enum_values:
             mixer_elem = self.mixer_elems[name]
-            set_enum_value(mixer_elem, self.model.force_enum_values[name])
+            set_enum_value(mixer_elem, self.model.force_enum_values[name], force)
 
         for name in self.model.force_volumes:
             mixer_elem = self.mixer_elems[name]
             volume = self.model.force_volumes[name]
-            mixer_elem.setvolume(volume)
+            # Read the volume first so an unnecessary write can be skipped
+            mixer_elem.getvolume()
+            mixer_elem.setvolume(volume, force=force)
+
+        logger.debug("Skipped %d writes of forced values which were already set",
+                     self.cache.suppressed - suppressed)
+
+    def resync(self):
+        """Re-read every control, and rewrite the forced values even if the
+        hardware appears to have them already"""
+        self.cache.invalidate()
+        self.init_forced_values(force=True)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time card discovery, Interface construction and common operations against a
+simulated card, counting the ALSA control reads and writes each one makes."""
+
+
+try:
+    import argcomplete  # type: ignore
+except ImportError:
+    argcomplete = None
+
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+import alsasim
+import models
+import version
+
+logger = logging.getLogger(version.NAME + ".benchmark")
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DUMP = os.path.join(SRC_DIR, "mixer_control_dumps", "18i20_gen2.json")
+
+INTERFACE_INIT_PHASES = [
+    "init_monitorable_sources",
+    "init_mixer_inputs",
+    "init_mixes",
+    "init_outputs",
+    "init_forced_values",
+]
+
+
+class Measurement:
+    def __init__(self, name: str):
+        self.name = name
+        self.wall_times: typing.List[float] = []
+        self.calls: typing.Dict[str, int] = {}
+
+    def add(self, wall_time: float, calls: typing.Dict[str, int]):
+        self.wall_times.append(wall_time)
+        self.calls = calls
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "wall_time_min": min(self.wall_times),
+            "wall_time_median": statistics.median(self.wall_times),
+            "runs": len(self.wall_times),
+            "reads": sum(self.calls.get(op, 0) for op in alsasim.READ_OPS),
+            "writes": sum(self.calls.get(op, 0) for op in alsasim.WRITE_OPS),
+            "opens": self.calls.get("open", 0),
+            "calls": self.calls,
+        }
+
+
+class Benchmark:
+    def __init__(self, dump: str, latency: float, open_latency: float = 0.0):
+        self.dump = dump
+        self.latency = latency
+        self.open_latency = open_latency
+        self.results: typing.Dict[str, Measurement] = {}
+
+    def reset_card(self) -> alsasim.SimulatedCard:
+        card = alsasim.SimulatedCard.from_dump(self.dump, latency=self.latency,
+                                               open_latency=self.open_latency)
+        alsasim.set_cards([card])
+        return card
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        if name not in self.results:
+            self.results[name] = Measurement(name)
+        calls_before = alsasim.call_counts()
+        start = time.perf_counter()
+        yield
+        wall_time = time.perf_counter() - start
+        calls = alsasim.call_counts()
+        calls.subtract(calls_before)
+        self.results[name].add(wall_time, {op: n for op, n in sorted(calls.items()) if n})
+
+    @contextlib.contextmanager
+    def measure_methods(self, cls, method_names: typing.List[str], prefix: str):
+        """Measure every call to the named methods of `cls` for the duration of
+        the context"""
+        originals = {name: getattr(cls, name) for name in method_names}
+
+        def wrap(name, method):
+            def timed(*args, **kwargs):
+                with self.measure(prefix + name):
+                    return method(*args, **kwargs)
+            return timed
+
+        for name, method in originals.items():
+            setattr(cls, name, wrap(name, method))
+        try:
+            yield
+        finally:
+            for name, method in originals.items():
+                setattr(cls, name, method)
+
+    def make_interface(self, model: models.Model):
+        import backend
+        card_index, mixer_elems = backend.find_card_index(model)
+        return backend.Interface(card_index, mixer_elems, model)
+
+    def run_startup(self, model: models.Model):
+        import backend
+        self.reset_card()
+        # In this process, so the probe's calls are counted
+        with self.measure("discover_cards"):
+            card = backend.discover_cards([model], isolate=False)[0]
+        card_index, mixer_elems = card.card_index, card.mixer_elems
+
+        with self.measure_methods(backend.Interface, INTERFACE_INIT_PHASES, "Interface."):
+            with self.measure("Interface.__init__"):
+                iface = backend.Interface(card_index, mixer_elems, model)
+        iface.stop()
+
+    def run_fader_sweep(self, model: models.Model):
+        """Move every fader in the first mix through its whole range in 1 dB
+        steps, as a slider drag would"""
+        self.reset_card()
+        iface = self.make_interface(model)
+        try:
+            mix = iface.get_mixes()[0]
+            with self.measure("fader_sweep"):
+                for level_mixer_elem in mix.mixer_elems:
+                    vmin, vmax = level_mixer_elem.getrange(units=alsasim.VOLUME_UNITS_DB)
+                    for vol in range(vmin, vmax + 1, 100):
+                        level_mixer_elem.setvolume(vol, units=alsasim.VOLUME_UNITS_DB)
+        finally:
+            iface.stop()
+
+    def run_fader_drag(self, model: models.Model):
+        """The same sweep as run_fader_sweep, but submitted through the
+        interface's WriteScheduler as the GUI does"""
+        self.reset_card()
+        iface = self.make_interface(model)
+        try:
+            mix = iface.get_mixes()[0]
+            with self.measure("fader_drag_coalesced"):
+                for level_mixer_elem in mix.mixer_elems:
+                    vmin, vmax = level_mixer_elem.getrange(units=alsasim.VOLUME_UNITS_DB)
+                    for vol in range(vmin, vmax + 1, 100):
+                        iface.write_scheduler.submit(level_mixer_elem.mixer(),
+                                                     functools.partial(level_mixer_elem.setvolume, vol,
+                                                                       units=alsasim.VOLUME_UNITS_DB))
+                iface.write_scheduler.stop()
+        finally:
+            iface.stop()
+
+    def run_routing_change(self, model: models.Model):
+        """Route every possible source to the first stereo mixer input in turn"""
+        import backend
+        self.reset_card()
+        iface = self.make_interface(model)
+        try:
+            stereo_inputs = [mi.mixer_elem for mi in iface.get_mixer_inputs()
+                             if isinstance(mi.mixer_elem, backend.StereoEnumMixer)]
+            mixer_elem = stereo_inputs[0]
+            with self.measure("routing_change"):
+                for choice in range(len(mixer_elem.choices)):
+                    mixer_elem.setenum(choice)
+        finally:
+            iface.stop()
+
+    def run_scene_recall(self, model: models.Model):
+        """Recall a scene which differs from the current state in one mix and
+        one mixer input"""
+        import scenes
+        self.reset_card()
+        iface = self.make_interface(model)
+        try:
+            scene = scenes.Scene.capture(iface, "benchmark")
+            for level_mixer_elem in iface.get_mixes()[0].mixer_elems:
+                level_mixer_elem.setvolume(0, units=alsasim.VOLUME_UNITS_DB)
+            mixer_input = iface.get_mixer_inputs()[0].mixer_elem
+            mixer_input.setenum(mixer_input.index_of("Off"))
+            with self.measure("scene_recall"):
+                scenes.recall(iface, scene)
+        finally:
+            iface.stop()
+
+    def run_command(self, args: typing.List[str]):
+        """Run a headless redmixctl command, as a script would, timing the
+        whole process from start to exit"""
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, XDG_CONFIG_HOME=tmp, XDG_CACHE_HOME=tmp, XDG_RUNTIME_DIR=tmp)
+            env[alsasim.ENV_LATENCY] = str(self.latency * 1000)
+            # Compiled modules are cached once redmixctl is installed
+            env.pop("PYTHONDONTWRITEBYTECODE", None)
+            cmd = [sys.executable, os.path.join(SRC_DIR, "redmixctl"), "--logfile", os.path.join(tmp, "log"),
+                   "--simulate", self.dump, "--no-daemon"] + args
+            # Likewise, only the first run validates the card in full
+            subprocess.run(cmd, env=env, check=True, capture_output=True)
+            with self.measure("command_" + args[0]):
+                subprocess.run(cmd, env=env, check=True, capture_output=True)
+
+    def run(self, model: models.Model, repeat: int):
+        for _ in range(repeat):
+            self.run_startup(model)
+            self.run_fader_sweep(model)
+            self.run_fader_drag(model)
+            self.run_routing_change(model)
+            self.run_scene_recall(model)
+            self.run_command(["get", "Mixer Input 01"])
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "version": version.VERSION,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "dump": os.path.basename(self.dump),
+            "latency_ms": self.latency * 1000,
+            "open_latency_ms": self.open_latency * 1000,
+            "results": {name: m.to_json() for name, m in self.results.items()},
+        }
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SRC_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results: typing.Dict[str, typing.Any],
+                  baseline: typing.Optional[typing.Dict[str, typing.Any]] = None):
+    fmt = "%-36s %20s %12s %12s %12s"
+    logger.info(fmt, "case", "ms", "reads", "writes", "opens")
+    for name, r in results["results"].items():
+        ms = "%.2f" % (r["wall_time_min"] * 1000)
+        reads = str(r["reads"])
+        writes = str(r["writes"])
+        opens = str(r.get("opens", 0))
+        if baseline and name in baseline["results"]:
+            b = baseline["results"][name]
+            ms += " (%+.2f)" % ((r["wall_time_min"] - b["wall_time_min"]) * 1000)
+            reads += " (%+d)" % (r["reads"] - b["reads"])
+            writes += " (%+d)" % (r["writes"] - b["writes"])
+            opens += " (%+d)" % (r.get("opens", 0) - b.get("opens", 0))
+        logger.info(fmt, name, ms, reads, writes, opens)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__)
+
+    ap.add_argument("--dump", "-d", default=DEFAULT_DUMP,
+                    help="Mixer control dump of the card to simulate")
+    ap.add_argument("--latency", type=float, default=1.0,
+                    help="Simulated latency of each control read or write, in milliseconds")
+    ap.add_argument("--open-latency", type=float, default=0.2,
+                    help="Simulated latency of opening each mixer element, in milliseconds")
+    ap.add_argument("--repeat", "-r", type=int, default=3)
+    ap.add_argument("--output", "-o", type=argparse.FileType("wt"),
+                    help="Write results as JSON to this file")
+    ap.add_argument("--compare", type=argparse.FileType("rt"),
+                    help="Show differences against results from a previous run")
+
+    if argcomplete:
+        argcomplete.autocomplete(ap)
+
+    return ap.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger(version.NAME).setLevel(logging.INFO)
+    args = parse_args()
+
+    alsasim.install()
+    bench = Benchmark(args.dump, args.latency / 1000.0, args.open_latency / 1000.0)
+    model = next(m for m in models.MODELS if m.name == bench.reset_card().name)
+    bench.run(model, args.repeat)
+
+    results = bench.to_json()
+    baseline = json.load(args.compare) if args.compare else None
+    print_summary(results, baseline)
+
+    if args.output:
+        json.dump(results, args.output, sort_keys=True, indent=4)
+
+
+if __name__ == "__main__":
+    main()
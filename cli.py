@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless subcommands, for scripts. Nothing here may import wx."""
+
+
+import alsaaudio
+import argparse
+import io
+import json
+import sys
+import typing
+
+import backend
+import scenes
+
+# Volumes are given and shown in dB, as the faders show them
+VOLUME_UNITS = alsaaudio.VOLUME_UNITS_DB
+
+# Subcommands which never write to the card, so needn't apply the model's
+# forced values
+READ_ONLY_COMMANDS = ["get"]
+
+
+class CommandError(Exception):
+    pass
+
+
+def control_value(iface: backend.Interface, name: str) -> typing.Union[str, float]:
+    if name not in iface.mixer_elems:
+        raise CommandError(f"No such control '{name}'")
+    mixer_elem = iface.mixer_elems[name]
+    if backend.is_enum(mixer_elem):
+        return mixer_elem.getenum()[0]
+    return mixer_elem.getvolume(units=VOLUME_UNITS)[0] / 100.0
+
+
+def get(iface: backend.Interface, names: typing.List[str]) -> typing.Dict[str, typing.Any]:
+    if not names:
+        names = iface.model.routing_controls() + iface.model.global_settings
+    return {name: control_value(iface, name) for name in names}
+
+
+def set_control(iface: backend.Interface, name: str, value: str) -> typing.Dict[str, typing.Any]:
+    if name not in iface.mixer_elems:
+        raise CommandError(f"No such control '{name}'")
+    mixer_elem = iface.mixer_elems[name]
+    if backend.is_enum(mixer_elem):
+        set_choice(mixer_elem, value)
+    else:
+        try:
+            volume = round(float(value) * 100)
+        except ValueError:
+            raise CommandError(f"'{value}' is not a volume in dB")
+        vmin, vmax = mixer_elem.getrange(units=VOLUME_UNITS)
+        if not vmin <= volume <= vmax:
+            raise CommandError(f"{value} dB is outside the range of {name} "
+                               f"({vmin / 100.0} to {vmax / 100.0})")
+        mixer_elem.setvolume(volume, units=VOLUME_UNITS)
+        # So the reply has the volume the driver rounded it to
+        iface.cache.sync()
+    return {name: control_value(iface, name)}
+
+
+def set_choice(mixer_elem: backend.SupportsEnumMixer, choice: str):
+    if mixer_elem.index_of(choice) < 0:
+        raise CommandError("'%s' is not a choice for %s (choices: %s)"
+                           % (choice, mixer_elem.mixer(), ", ".join(mixer_elem.getenum()[1])))
+    backend.set_enum_value(mixer_elem, choice)
+
+
+def sinks(iface: backend.Interface) -> typing.Dict[str, backend.SupportsEnumMixer]:
+    """Everything with a selectable source, including the stereo pairs"""
+    by_name = {name: iface.mixer_elems[name] for name in iface.model.routing_controls()}
+    for sink in iface.get_outputs() + iface.get_mixer_inputs():
+        by_name[sink.name] = sink.mixer_elem
+    return by_name
+
+
+def route(iface: backend.Interface, sink: str, source: str) -> typing.Dict[str, typing.Any]:
+    all_sinks = sinks(iface)
+    if sink not in all_sinks:
+        raise CommandError("No output or mixer input '%s' (choices: %s)" % (sink, ", ".join(all_sinks)))
+    # So the mixer input's gains are cut while its source changes
+    with iface.transaction():
+        set_choice(all_sinks[sink], source)
+    return {sink: all_sinks[sink].getenum()[0]}
+
+
+def apply(iface: backend.Interface, name: str, fade: typing.Optional[float] = None,
+          curve: str = backend.EQUAL_POWER) -> typing.Dict[str, typing.Any]:
+    try:
+        scene = scenes.Scene.load(name)
+    except (OSError, ValueError, KeyError) as e:
+        raise CommandError(f"Couldn't load scene {name}: {e}")
+    try:
+        if fade:
+            result = scenes.crossfade(iface, scene, fade, curve)
+        else:
+            result = scenes.recall(iface, scene)
+    except ValueError as e:
+        raise CommandError(str(e))
+    return {
+        "scene": scene.name,
+        "writes": result.writes,
+        "elapsed_ms": result.elapsed * 1000,
+        "changed": result.changed,
+    }
+
+
+def run(args: argparse.Namespace, iface: backend.Interface) -> typing.Dict[str, typing.Any]:
+    if args.command == "get":
+        return get(iface, args.controls)
+    elif args.command == "set":
+        return set_control(iface, args.control, args.value)
+    elif args.command == "route":
+        return route(iface, args.sink, args.source)
+    elif args.command == "apply":
+        return apply(iface, args.scene, getattr(args, "fade", None),
+                     getattr(args, "curve", backend.EQUAL_POWER))
+    raise CommandError(f"Unknown command {args.command}")
+
+
+def print_result(result: typing.Dict[str, typing.Any], as_json: bool, file=sys.stdout):
+    if as_json:
+        json.dump(result, file, sort_keys=True)
+        file.write("\n")
+    elif "scene" in result:
+        print("Recalled scene %s: %d writes in %.1f ms"
+              % (result["scene"], result["writes"], result["elapsed_ms"]), file=file)
+    else:
+        for name, value in result.items():
+            print(f"{name}: {value}", file=file)
+
+
+def print_results(results: typing.Dict[int, typing.Dict[str, typing.Any]], as_json: bool, file=sys.stdout):
+    """Print the result of a command run on each of several cards"""
+    if as_json:
+        json.dump({str(card_index): result for card_index, result in results.items()}, file, sort_keys=True)
+        file.write("\n")
+        return
+    for card_index, result in sorted(results.items()):
+        output = io.StringIO()
+        print_result(result, as_json, file=output)
+        print(f"Card {card_index}:", file=file)
+        for line in output.getvalue().splitlines():
+            print("    " + line, file=file)
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A daemon which keeps a card's Interface open, and serves it to clients
+over a Unix socket.
+
+The protocol is one JSON object per line in each direction. Requests have
+an "op" and an "id", which is copied into the response along with either
+"result" or "error". After a "subscribe" request the daemon also sends
+{"event": "changed", "controls": [...]} whenever any of the subscribed
+controls changes, except by the client's own setenum or setvolume.
+
+The ops are:
+- info: the model, card index and control names
+- getenum, setenum, getvolume, setvolume, getrange: the alsaaudio.Mixer
+  method of the same name on "control", through the daemon's cache
+- get, set, route, apply: the cli commands of the same name
+- subscribe: "controls" to watch, or null for all of them
+"""
+
+
+import alsaaudio
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import typing
+
+import backend
+import cli
+import models
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+
+class DaemonError(Exception):
+    pass
+
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, version.NAME + ".sock")
+    return os.path.join("/tmp", "%s-%d.sock" % (version.NAME, os.getuid()))
+
+
+def check_owner(path: str):
+    """Refuse a socket which belongs to another user. Anyone can create the
+    /tmp fallback path first, and a socket there could be anyone's daemon,
+    or not a daemon at all."""
+    try:
+        owner = os.lstat(path).st_uid
+    except FileNotFoundError:
+        return
+    if owner != os.getuid():
+        raise DaemonError(f"{path} belongs to another user")
+
+
+MIXER_OPS = ["getenum", "setenum", "getvolume", "setvolume", "getrange"]
+
+
+class Connection(socketserver.StreamRequestHandler):
+    """One client. Requests are handled in order on the connection's thread;
+    change events are sent from a separate thread, so a slow client never
+    holds up whoever made the change."""
+    server: "Server"
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.changed_cond = threading.Condition()
+        # Controls changed since the last event was sent
+        self.changed: typing.List[str] = []
+        self.subscriptions: typing.List[backend.Subscription] = []
+        self.closed = False
+        self.event_thread: typing.Optional[threading.Thread] = None
+        # Control being written by this client's current request, on the
+        # thread which handles its requests
+        self.own_write: typing.Optional[str] = None
+        self.thread = threading.current_thread()
+
+    def send(self, message: typing.Dict[str, typing.Any]):
+        data = (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.send_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                self.send({"error": "Malformed request"})
+                continue
+            response: typing.Dict[str, typing.Any] = {"id": request.get("id")}
+            try:
+                response["result"] = self.server.handle_request_op(self, request)
+            except (DaemonError, cli.CommandError, alsaaudio.ALSAAudioError, KeyError, TypeError) as e:
+                response["error"] = "%s: %s" % (type(e).__name__, e)
+            except Exception as e:
+                # Still reply, or the client would wait for its timeout
+                logger.exception("Request %s failed", request.get("op"))
+                response["error"] = "%s: %s" % (type(e).__name__, e)
+            try:
+                self.send(response)
+            except OSError:
+                break
+
+    def finish(self):
+        for subscription in self.subscriptions:
+            self.server.iface.store.unsubscribe(subscription)
+        with self.changed_cond:
+            self.closed = True
+            self.changed_cond.notify()
+        if self.event_thread:
+            self.event_thread.join()
+        super().finish()
+
+    def subscribe(self, controls: typing.Optional[typing.List[str]]):
+        store = self.server.iface.store
+        names = list(store.cache.mixer_elems) if controls is None else controls
+        for name in names:
+            if name not in store.cache.mixer_elems:
+                raise DaemonError(f"No such control '{name}'")
+        # One subscription per control, so events can say which ones changed
+        for name in names:
+            self.subscriptions.append(store.subscribe(name, functools.partial(self.on_changed, name)))
+        if not self.event_thread:
+            self.event_thread = threading.Thread(target=self.send_events, name="DaemonEvents", daemon=True)
+            self.event_thread.start()
+
+    @contextlib.contextmanager
+    def writing(self, name: str):
+        """Don't tell the client about its own write of `name` in the block,
+        which its cache already has"""
+        self.own_write = name
+        try:
+            yield
+        finally:
+            self.own_write = None
+
+    def on_changed(self, name: str):
+        # Subscribers are called on the thread which made the change
+        if name == self.own_write and threading.current_thread() is self.thread:
+            return
+        with self.changed_cond:
+            if name not in self.changed:
+                self.changed.append(name)
+            self.changed_cond.notify()
+
+    def send_events(self):
+        while True:
+            with self.changed_cond:
+                while not self.changed and not self.closed:
+                    self.changed_cond.wait()
+                if self.closed:
+                    return
+                changed, self.changed = self.changed, []
+            try:
+                self.send({"event": "changed", "controls": changed})
+            except OSError:
+                return
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, iface: backend.Interface):
+        self.iface = iface
+        self.path = path
+        check_owner(path)
+        if os.path.exists(path):
+            if ping(path):
+                raise DaemonError(f"A daemon is already listening on {path}")
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, Connection)
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def handle_request_op(self, connection: Connection, request: typing.Dict[str, typing.Any]) -> typing.Any:
+        op = request.get("op")
+        iface = self.iface
+        if op == "info":
+            return {
+                "model": iface.model.canonical_name,
+                "card_index": iface.card_index,
+                "controls": list(iface.mixer_elems),
+            }
+        elif op in MIXER_OPS:
+            mixer_elem = iface.mixer_elems[request["control"]]
+            args = {k: v for k, v in request.items() if k in ["pcmtype", "units"]}
+            if op == "getenum":
+                return mixer_elem.getenum()
+            elif op == "setenum":
+                with connection.writing(request["control"]):
+                    return mixer_elem.setenum(request["index"])
+            elif op == "getvolume":
+                return mixer_elem.getvolume(**args)
+            elif op == "setvolume":
+                with connection.writing(request["control"]):
+                    return mixer_elem.setvolume(request["volume"], **args)
+            return mixer_elem.getrange(**args)
+        elif op in ["get", "set", "route", "apply"]:
+            return cli.run(argparse.Namespace(command=op, **request.get("args", {})), iface)
+        elif op == "subscribe":
+            connection.subscribe(request.get("controls"))
+            return None
+        raise DaemonError(f"Unknown op {op}")
+
+
+def serve(iface: backend.Interface, path: typing.Optional[str] = None):
+    """Serve `iface` until interrupted"""
+    path = path or default_socket_path()
+    iface.start_io_worker()
+    iface.start_change_monitor()
+    server = Server(path, iface)
+    logger.info("Serving %s on %s", iface.model.canonical_name, path)
+    # shutdown() waits for serve_forever() to return, so can't be called
+    # from the signal handler on the same thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        iface.stop()
+
+
+class Client:
+    """Connection to a daemon. Requests may be made from any thread. Events
+    are passed to subscribers on a thread of their own, so subscribers may
+    make requests."""
+    TIMEOUT = 10.0
+
+    def __init__(self, path: typing.Optional[str] = None):
+        self.path = path or default_socket_path()
+        check_owner(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile("rb")
+        self.send_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pending: typing.Dict[int, "concurrent.futures.Future[typing.Any]"] = {}
+        self.subscribers: typing.List[typing.Callable[[typing.List[str]], None]] = []
+        self.events: "queue.Queue[typing.Optional[typing.List[str]]]" = queue.Queue()
+        self.reader = threading.Thread(target=self.read, name="DaemonClient", daemon=True)
+        self.reader.start()
+        self.event_thread = threading.Thread(target=self.handle_events, name="DaemonClientEvents",
+                                             daemon=True)
+        self.event_thread.start()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.join()
+        self.event_thread.join()
+        self.rfile.close()
+        self.sock.close()
+
+    def handle_events(self):
+        while True:
+            controls = self.events.get()
+            if controls is None:
+                return
+            for subscriber in list(self.subscribers):
+                subscriber(controls)
+
+    def read(self):
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        raise ValueError(f"Expected an object, got {line!r}")
+                except ValueError as e:
+                    # Nothing after it can be trusted either
+                    logger.error("Invalid message from daemon, disconnecting: %s", e)
+                    with contextlib.suppress(OSError):
+                        self.sock.shutdown(socket.SHUT_RDWR)
+                    break
+                if "event" in message:
+                    self.events.put(message["controls"])
+                    continue
+                with self.lock:
+                    future = self.pending.pop(message.get("id"), None)
+                if future is None:
+                    logger.warning("Unexpected message from daemon: %s", message)
+                elif "error" in message:
+                    future.set_exception(DaemonError(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        finally:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(DaemonError("Connection to daemon closed"))
+            self.events.put(None)
+
+    def request(self, op: str, timeout: typing.Optional[float] = None, **kwargs) -> typing.Any:
+        """Make a request and wait for its result, for up to `timeout` seconds
+        (by default, TIMEOUT). The fields of the request are `kwargs`."""
+        request_id = next(self.ids)
+        future: "concurrent.futures.Future[typing.Any]" = concurrent.futures.Future()
+        with self.lock:
+            self.pending[request_id] = future
+        data = (json.dumps(dict(kwargs, op=op, id=request_id), separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self.send_lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise DaemonError(f"Couldn't send {op} to the daemon: {e}")
+        timeout = self.TIMEOUT if timeout is None else timeout
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise DaemonError(f"No reply from the daemon to {op} within {timeout:.1f} s")
+
+    def subscribe(self, controls: typing.Optional[typing.List[str]],
+                  subscriber: typing.Callable[[typing.List[str]], None]):
+        """Call `subscriber` with the names of changed controls, from the
+        client's event thread"""
+        self.subscribers.append(subscriber)
+        self.request("subscribe", controls=controls)
+
+
+def ping(path: typing.Optional[str] = None) -> bool:
+    """Whether a daemon is listening on `path`"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path or default_socket_path())
+        return True
+    except OSError:
+        return False
+
+
+def connect(path: typing.Optional[str] = None) -> typing.Optional[Client]:
+    """A Client, or None if no daemon is running"""
+    try:
+        return Client(path)
+    except OSError:
+        return None
+    except DaemonError as e:
+        logger.warning("Not using the daemon: %s", e)
+        return None
+
+
+class RemoteMixer:
+    """Stand-in for an alsaaudio.Mixer which forwards to a daemon"""
+    def __init__(self, client: Client, name: str):
+        self.client = client
+        self.name = name
+
+    def request(self, op: str, **kwargs) -> typing.Any:
+        try:
+            return self.client.request(op, control=self.name, **kwargs)
+        except DaemonError as e:
+            raise alsaaudio.ALSAAudioError(str(e))
+
+    def mixer(self) -> str:
+        return self.name
+
+    def getenum(self):
+        enum = self.request("getenum")
+        return (enum[0], enum[1]) if enum else ()
+
+    def setenum(self, index: int):
+        self.request("setenum", index=index)
+
+    def getvolume(self, pcmtype=alsaaudio.PCM_PLAYBACK, units=alsaaudio.VOLUME_UNITS_PERCENTAGE):
+        return self.request("getvolume", pcmtype=pcmtype, units=units)
+
+    def setvolume(self, volume: int, pcmtype=alsaaudio.PCM_PLAYBACK,
+                  units=alsaaudio.VOLUME_UNITS_PERCENTAGE):
+        self.request("setvolume", volume=volume, pcmtype=pcmtype, units=units)
+
+    def getrange(self, pcmtype=alsaaudio.PCM_PLAYBACK, units=alsaaudio.VOLUME_UNITS_RAW):
+        return tuple(self.request("getrange", pcmtype=pcmtype, units=units))
+
+
+class RemoteInterface(backend.Interface):
+    """An Interface whose controls are those of a daemon's card. It has its
+    own cache, kept up to date by the daemon's change events, so the GUI can
+    use it unchanged."""
+    def __init__(self, client: Client, **kwargs):
+        self.client = client
+        info = client.request("info")
+        model = models.find(info["model"])
+        mixer_elems = {name: RemoteMixer(client, name) for name in info["controls"]}
+        # The daemon has already applied the forced values
+        super().__init__(info["card_index"], mixer_elems, model, apply_forced_values=False, **kwargs)
+        # The daemon reads back its own writes, and sends a change event if
+        # the driver rounded one
+        self.cache.read_back_volumes = False
+
+    def start_change_monitor(self,
+                             on_change: typing.Optional[typing.Callable[[typing.List[str]], None]] = None):
+        def on_remote_change(control_names: typing.List[str]):
+            for name in control_names:
+                self.cache.invalidate(name)
+            if on_change:
+                on_change(control_names)
+
+        self.client.subscribe(None, on_remote_change)
+
+    def stop(self):
+        super().stop()
+        self.client.close()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import typing
+
+import models
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+
+def default_path() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, version.NAME, "validated_cards.json")
+
+
+def digest(value: typing.Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ValidationCache:
+    """Remembers cards which have passed Model.validate_mixer_elems().
+
+    Validation reads the choices of every routing control, which takes tens
+    of USB transfers. Instead, a card which has been validated before is
+    recognised by its long name and a hash of its list of controls, which
+    cost nothing to read. Then only a couple of routing controls are read,
+    to check their choices still have the hashes recorded at validation. If
+    the driver exposes a different set of controls, the card is validated
+    in full again.
+    """
+    SPOT_CHECKS = 2  # Number of routing controls read on a fingerprint match
+
+    def __init__(self, path: typing.Optional[str] = None):
+        self.path = path or default_path()
+        self.lock = threading.Lock()
+        self.entries: typing.Dict[str, typing.Dict[str, typing.Any]] = self.load()
+        # Entries changed by validate() since loading, or None if removed,
+        # for a probe process to pass back with
+        self.updates: typing.Dict[str, typing.Optional[typing.Dict[str, typing.Any]]] = {}
+        # Whether validate() saves its changes straight away
+        self.autosave = True
+
+    def load(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        try:
+            with open(self.path, "rt") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict) and entries.get("version") == version.VERSION:
+                return entries["cards"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable validation cache %s: %s", self.path, e)
+        return {}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"version": version.VERSION, "cards": self.entries},
+                              sort_keys=True, indent=4)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "wt") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Couldn't write validation cache %s: %s", self.path, e)
+
+    @staticmethod
+    def spot_check_controls(model: models.Model) -> typing.List[str]:
+        # Spread the checks over the routing controls
+        controls = model.routing_controls()
+        step = max(1, len(controls) // ValidationCache.SPOT_CHECKS)
+        return controls[::step][:ValidationCache.SPOT_CHECKS]
+
+    def spot_check(self, entry: typing.Dict[str, typing.Any], model: models.Model,
+                   mixer_elems: typing.Mapping[str, typing.Any]) -> bool:
+        for name in self.spot_check_controls(model):
+            _, choices = mixer_elems[name].getenum()
+            if digest(list(choices)) != entry["choices"].get(name):
+                logger.info("Choices of %s have changed since the card was last validated", name)
+                return False
+        return True
+
+    def validate(self, model: models.Model, longname: str,
+                 mixer_elems: typing.Mapping[str, typing.Any]) -> bool:
+        """Equivalent to model.validate_mixer_elems(mixer_elems), but skips
+        most of the work for a card which has been validated before"""
+        key = "%s [%s]" % (model.canonical_name, longname)
+        controls = digest(sorted(mixer_elems))
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            if entry["controls"] != controls:
+                logger.info("Controls of [%s] have changed since it was last validated", longname)
+            elif self.spot_check(entry, model, mixer_elems):
+                logger.debug("Card [%s] matches cached %s fingerprint", longname, model.canonical_name)
+                return True
+
+        enum_choices: typing.Dict[str, typing.List[str]] = {}
+        valid = model.validate_mixer_elems(mixer_elems, enum_choices)
+        if valid:
+            self.apply({key: {
+                "controls": controls,
+                "choices": {name: digest(choices) for name, choices in enum_choices.items()},
+                "validated": time.time(),
+            }})
+        elif entry is not None:
+            self.apply({key: None})
+        if (valid or entry is not None) and self.autosave:
+            self.save()
+        return valid
+
+    def apply(self, updates: typing.Dict[str, typing.Optional[typing.Dict[str, typing.Any]]]):
+        """Set or (for None) remove the given entries, e.g. the `updates` of
+        another process's cache"""
+        with self.lock:
+            for key, entry in updates.items():
+                if entry is None:
+                    self.entries.pop(key, None)
+                else:
+                    self.entries[key] = entry
+                self.updates[key] = entry
@@ -18,13 +18,21 @@
 
 from __future__ import print_function
 import alsaaudio
+import functools
 import logging
+import threading
+import time
 import typing
 import wx  # type: ignore
 
 import backend
+import scenes
+import session
 import version
 
+if typing.TYPE_CHECKING:
+    import instrument
+
 logger = logging.getLogger(version.NAME + "." + __name__)
 
 
@@ -57,35 +65,53 @@ def test_table_dimensions():
 class EnumMixerElemChoice(wx.Choice):
     """wx.Choice which automatically displays and updates the value of an enum
     mixer element"""
-    def __init__(self, parent, mixer_elem: alsaaudio.Mixer, on_change: typing.Callable[[], None] = None):
+    def __init__(self, parent, mixer_elem: backend.SupportsEnumMixer):
         self.name = mixer_elem.mixer()
         self.mixer_elem = mixer_elem
-        self.extra_on_change = on_change
         _, choices = mixer_elem.getenum()
 
         wx.Choice.__init__(self, parent, choices=choices)
         self.Bind(wx.EVT_CHOICE, self.on_change)
         self.refresh_from_alsa()
+        wx.GetTopLevelParent(self).subscribe(self, mixer_elem)
 
     def refresh_from_alsa(self):
         current, _ = self.mixer_elem.getenum()
-        index_of_current_value = self.FindString(current)
-        self.SetSelection(index_of_current_value)
+        self.SetSelection(self.mixer_elem.index_of(current))
 
     def on_change(self, event):
-        value = event.GetString()
-        logger.debug("%s selection changed to %s", self.name, value)
-        backend.set_enum_value(self.mixer_elem, value)
+        logger.debug("%s selection changed to %s", self.name, event.GetString())
+        self.mixer_elem.setenum(event.GetSelection())
+
 
-        if self.extra_on_change:
-            self.extra_on_change()
+class MixerInputChoice(wx.Choice):
+    """wx.Choice showing the source of a mixer input. All the tabs have one
+    for each mixer input, and they share a backend.MixerInputRouting, so
+    they are updated by MixerTabs rather than reading ALSA themselves."""
+    def __init__(self, parent, routing: backend.MixerInputRouting, index: int):
+        self.routing = routing
+        self.index = index
+
+        wx.Choice.__init__(self, parent, choices=routing.choices(index))
+        self.Bind(wx.EVT_CHOICE, self.on_change)
+        self.show_source(routing.get(index))
+
+    def show_source(self, source: str):
+        self.SetStringSelection(source)
+
+    def on_change(self, event):
+        logger.debug("Mixer input %d selection changed to %s", self.index, event.GetString())
+        self.routing.select(self.index, event.GetSelection())
 
 
 class Fader(wx.Window):
-    def __init__(self, parent, level_mixer_elem: backend.SupportsVolumeMixer):
+    def __init__(self, parent, level_mixer_elem: backend.SupportsVolumeMixer,
+                 write_scheduler: backend.WriteScheduler, ramps: backend.RampEngine):
         wx.Window.__init__(self, parent)
 
         self.level_mixer_elem = level_mixer_elem
+        self.write_scheduler = write_scheduler
+        self.ramps = ramps
         self.parent = parent
 
         sizer = wx.GridBagSizer()
@@ -102,11 +128,15 @@ class Fader(wx.Window):
         sizer.Add(self.slider, (1, 1), span=(10, 1), flag=wx.EXPAND)
 
         self.refresh_from_alsa()
+        wx.GetTopLevelParent(self).subscribe(self, level_mixer_elem)
 
         self.SetSizerAndFit(sizer)
         self.Show(True)
 
     def refresh_from_alsa(self):
+        if self.write_scheduler.is_pending(self.level_mixer_elem.mixer()):
+            # Being dragged; the newer value hasn't been written yet
+            return
         vol = self.level_mixer_elem.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0]
 
         self.slider.SetValue(vol / 100.0)
@@ -114,19 +144,32 @@ class Fader(wx.Window):
     def update(self, event):
         vol = event.GetInt()
         logger.debug("%s changed to %d", self.level_mixer_elem.mixer(), event.GetInt())
-        self.level_mixer_elem.setvolume(int(vol * 100.0), units=alsaaudio.VOLUME_UNITS_DB)
+        # The user has grabbed the fader, so stop any fade moving it
+        self.ramps.cancel(self.level_mixer_elem.mixer(), *self.level_mixer_elem.control_names())
+        # Slider drags generate lots of events, so only write the latest value
+        self.write_scheduler.submit(self.level_mixer_elem.mixer(),
+                                    functools.partial(self.level_mixer_elem.setvolume, int(vol * 100.0),
+                                                      units=alsaaudio.VOLUME_UNITS_DB))
 
 
 class MixerTab(wx.Window):
+    """The faders of one mix. The widgets are only created by build(), when
+    the tab is first shown."""
     def __init__(self, parent, iface: backend.Interface, mix: backend.Mix):
         wx.Window.__init__(self, parent)
 
         self.iface = iface
         self.mix = mix
         self.parent = parent
+        self.built = False
+        # Set when controls shown in the tab changed while it was hidden
+        self.dirty = False
 
         assert len(mix.mixer_elems) == len(iface.get_mixer_inputs())
 
+    def build(self):
+        start = time.perf_counter()
+
         # Don't have more than 10 faders in a row to avoid super long thin
         # windows going off the sides of the screen.
         _, num_cols = table_dimensions(len(self.mix.mixer_elems), 10)
@@ -140,14 +183,12 @@ class MixerTab(wx.Window):
             num_faders_on_row = min(num_cols, len(self.mix.mixer_elems) - i)
             for j in range(i, i + num_faders_on_row):
                 level_mixer_elem = self.mix.mixer_elems[j]
-                fader = Fader(self, level_mixer_elem)
+                fader = Fader(self, level_mixer_elem, self.iface.write_scheduler, self.iface.ramps)
                 self.faders.append(fader)
                 self.faders_sizer.Add(fader, flag=wx.ALIGN_CENTRE)
 
             for j in range(i, i + num_faders_on_row):
-                input_select_mixer_elem: alsaaudio.Mixer = self.iface.get_mixer_inputs()[j].mixer_elem
-                input_select = EnumMixerElemChoice(self, input_select_mixer_elem,
-                                                   on_change=self.input_settings_changed)
+                input_select = MixerInputChoice(self, self.iface.mixer_input_routing, j)
                 self.input_selectors.append(input_select)
 
                 self.faders_sizer.Add(input_select, flag=wx.ALIGN_CENTRE | wx.ALL | wx.EXPAND, border=2)
@@ -160,33 +201,71 @@ class MixerTab(wx.Window):
         self.sizer.AddSpacer(10)
         self.SetSizerAndFit(self.sizer)
         self.Show(True)
+        self.built = True
+        self.dirty = False
+        logger.debug("Built tab %s in %.1f ms", self.mix.name, (time.perf_counter() - start) * 1000)
 
-    def refresh_input_settings(self):
-        """All mixes use the same mapping of physical inputs to mixer inputs.
-        So when they are changed in one tab, this is called to update the
-        selections in all other mix tabs.
-        """
-        for input_select in self.input_selectors:
-            input_select.refresh_from_alsa()
-
-    def input_settings_changed(self):
-        mixertabs = self.parent
-        mixertabs.refresh_input_settings()
+    def refresh_from_alsa(self):
+        for fader in self.faders:
+            fader.refresh_from_alsa()
+        self.dirty = False
 
 
 class MixerTabs(wx.Notebook):
+    """One tab per mix. Building a tab creates dozens of native widgets and
+    reads every control in it, so tabs are built when first selected. Only
+    the visible tab is kept up to date; hidden tabs are marked dirty and
+    refreshed when they are next selected."""
     def __init__(self, parent, iface):
         wx.Notebook.__init__(self, parent)
 
+        self.iface = iface
         self.mix_tabs = []
         for mix in iface.get_mixes():
             mix_tab = MixerTab(self, iface, mix)
             self.mix_tabs += [mix_tab]
             self.AddPage(mix_tab, mix.name)
 
-    def refresh_input_settings(self):
+        self.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.on_page_changed)
+        iface.mixer_input_routing.add_observer(self.on_mixer_input_changed)
+        # Every tab has the same layout, so the first one is enough to size
+        # the notebook
+        if self.mix_tabs:
+            self.show_tab(self.mix_tabs[0])
+
+    def current_tab(self) -> typing.Optional[MixerTab]:
+        selection = self.GetSelection()
+        return self.mix_tabs[selection] if selection != wx.NOT_FOUND else None
+
+    def show_tab(self, mix_tab: MixerTab):
+        if not mix_tab.built:
+            mix_tab.build()
+        elif mix_tab.dirty:
+            mix_tab.refresh_from_alsa()
+
+    def on_page_changed(self, event):
+        event.Skip()
+        if event.GetEventObject() is self:
+            self.show_tab(self.mix_tabs[event.GetSelection()])
+
+    def defer_refresh(self, widget: wx.Window) -> bool:
+        """If `widget` is in a hidden tab, mark the tab dirty instead of
+        refreshing the widget, and return True"""
+        mix_tab = widget.GetParent()
+        if not isinstance(mix_tab, MixerTab) or mix_tab is self.current_tab():
+            return False
+        mix_tab.dirty = True
+        return True
+
+    def close(self):
+        self.iface.mixer_input_routing.remove_observer(self.on_mixer_input_changed)
+
+    def on_mixer_input_changed(self, index: int, source: str):
+        # Setting a selection is cheap and needs no ALSA reads, so hidden
+        # tabs are updated too.
         for mix_tab in self.mix_tabs:
-            mix_tab.refresh_input_settings()
+            if mix_tab.built:
+                mix_tab.input_selectors[index].show_source(source)
 
 
 class OutputSettingsPanel(wx.Panel):
@@ -241,9 +320,80 @@ class GlobalSettingsPanel(wx.Panel):
         self.Show()
 
 
+class CallStatsDialog(wx.Dialog):
+    """Live view of the ALSA call statistics recorded by instrument.CallStats"""
+    COLUMNS = ["Control", "Operation", "Calls", "Total (ms)", "Mean (ms)", "p50 (ms)", "p99 (ms)",
+               "Max (ms)"]
+    REFRESH_INTERVAL_MS = 1000
+
+    def __init__(self, parent, stats: "instrument.CallStats"):
+        wx.Dialog.__init__(self, parent, wx.ID_ANY, "ALSA call statistics",
+                           style=wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        self.stats = stats
+
+        self.totals = wx.StaticText(self, wx.ID_ANY)
+        self.list = wx.ListCtrl(self, wx.ID_ANY, size=(800, 400), style=wx.LC_REPORT)
+        for i, column in enumerate(self.COLUMNS):
+            self.list.InsertColumn(i, column)
+
+        reset_button = wx.Button(self, wx.ID_ANY, "Reset")
+        reset_button.Bind(wx.EVT_BUTTON, self.on_reset)
+        close_button = wx.Button(self, wx.ID_CLOSE)
+        close_button.Bind(wx.EVT_BUTTON, lambda event: self.Destroy())
+
+        buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        buttons_sizer.Add(reset_button, flag=wx.ALL, border=5)
+        buttons_sizer.Add(close_button, flag=wx.ALL, border=5)
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(self.totals, flag=wx.ALL, border=5)
+        sizer.Add(self.list, proportion=1, flag=wx.EXPAND | wx.ALL, border=5)
+        sizer.Add(buttons_sizer, flag=wx.ALIGN_RIGHT)
+        self.SetSizerAndFit(sizer)
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, lambda event: self.refresh(), self.timer)
+        self.timer.Start(self.REFRESH_INTERVAL_MS)
+        self.Bind(wx.EVT_WINDOW_DESTROY, lambda event: self.timer.Stop())
+
+        self.refresh()
+
+    def refresh(self):
+        totals = self.stats.totals()
+        label = "   ".join(f"{op}: {t.count}" for op, t in totals.items())
+        io_worker = self.GetParent().iface.io_worker
+        if io_worker:
+            metrics = io_worker.metrics()
+            label += "\nI/O queue depth: %d (max %d)   latency: %.2f ms mean, %.2f ms max" % (
+                metrics["queue_depth"], metrics["max_queue_depth"],
+                metrics["latency_mean_ms"], metrics["latency_max_ms"])
+        self.totals.SetLabel(label)
+
+        self.list.DeleteAllItems()
+        for control, op, stats in self.stats.rows():
+            self.list.Append([control, op, str(stats.count)] +
+                             ["%.2f" % (v * 1000) for v in [stats.total, stats.total / stats.count,
+                                                            stats.percentile(50), stats.percentile(99),
+                                                            stats.max]])
+
+    def on_reset(self, event):
+        self.stats.reset()
+        self.refresh()
+
+
 class MainWindow(wx.Frame):
+    CROSSFADE_TIME = 5  # Default, in seconds
+
     def __init__(self, app, iface):
-        wx.Frame.__init__(self, None, wx.ID_ANY, f"redmixctl - {iface.model.name}")
+        title = f"redmixctl - {iface.model.name}"
+        if len(app.cards) > 1:
+            title += f" (card {iface.card_index})"
+        wx.Frame.__init__(self, None, wx.ID_ANY, title)
+
+        self.app = app
+        self.iface = iface
+        self.subscriptions: typing.List[backend.Subscription] = []
+        self.init_menus()
 
         self.tabs = MixerTabs(self, iface)
         self.output_settings = OutputSettingsPanel(self, app, iface)
@@ -258,19 +408,170 @@ class MainWindow(wx.Frame):
 
         sizer.Add(settings_sizer, proportion=0, flag=wx.ALL)
         self.SetSizerAndFit(sizer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
 
         self.Show(True)
 
+    def subscribe(self, widget: wx.Window, controls: backend.SupportsControlNames):
+        """Refresh `widget` whenever any of `controls` changes"""
+        self.subscriptions.append(
+            self.iface.store.subscribe(controls, functools.partial(self.refresh_widget, widget)))
+
+    def refresh_widget(self, widget: wx.Window):
+        if not widget:
+            # Destroyed while the refresh was waiting to be dispatched
+            return
+        if not self.tabs.defer_refresh(widget):
+            widget.refresh_from_alsa()
+
+    def on_close(self, event):
+        """Detach the widgets from the card, and stop its threads once any
+        pending writes are made"""
+        for subscription in self.subscriptions:
+            self.iface.store.unsubscribe(subscription)
+        self.subscriptions.clear()
+        self.tabs.close()
+        self.iface.stop()
+        self.app.frames.remove(self)
+        event.Skip()
+
+    def init_menus(self):
+        menu_bar = wx.MenuBar()
+
+        scene_menu = wx.Menu()
+        item = scene_menu.Append(wx.ID_ANY, "&Save scene...\tCtrl+S")
+        self.Bind(wx.EVT_MENU, self.save_scene, item)
+        item = scene_menu.Append(wx.ID_ANY, "&Recall scene...\tCtrl+R")
+        self.Bind(wx.EVT_MENU, self.recall_scene, item)
+        item = scene_menu.Append(wx.ID_ANY, "&Crossfade to scene...\tCtrl+Shift+R")
+        self.Bind(wx.EVT_MENU, self.crossfade_to_scene, item)
+        if len(self.app.cards) > 1:
+            item = scene_menu.Append(wx.ID_ANY, "Recall scene on &all cards...\tCtrl+Alt+R")
+            self.Bind(wx.EVT_MENU, self.recall_scene_on_all_cards, item)
+        menu_bar.Append(scene_menu, "&Scenes")
+
+        if self.iface.stats:
+            debug_menu = wx.Menu()
+            item = debug_menu.Append(wx.ID_ANY, "ALSA call statistics...\tCtrl+Shift+D")
+            self.Bind(wx.EVT_MENU, self.show_call_stats, item)
+            menu_bar.Append(debug_menu, "&Debug")
+
+        self.SetMenuBar(menu_bar)
+
+    def save_scene(self, event):
+        name = wx.GetTextFromUser("Scene name:", "Save scene", parent=self)
+        if not name:
+            return
+        try:
+            scenes.Scene.capture(self.iface, name).save()
+        except (OSError, ValueError) as e:
+            wx.MessageBox(str(e), "Couldn't save scene", wx.OK | wx.ICON_ERROR, self)
+
+    def choose_scene(self, title: str) -> typing.Optional[scenes.Scene]:
+        names = scenes.list_scenes()
+        if not names:
+            wx.MessageBox("No scenes have been saved", title, wx.OK, self)
+            return None
+        with wx.SingleChoiceDialog(self, "Scene:", title, names) as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return None
+            name = dialog.GetStringSelection()
+        try:
+            return scenes.Scene.load(name)
+        except (OSError, ValueError, KeyError) as e:
+            wx.MessageBox(str(e), "Couldn't load scene", wx.OK | wx.ICON_ERROR, self)
+            return None
+
+    def recall_scene(self, event):
+        scene = self.choose_scene("Recall scene")
+        if not scene:
+            return
+
+        # Waits for the writes to reach the card, so keep it off the event
+        # loop
+        def run():
+            try:
+                scenes.recall(self.iface, scene)
+            except ValueError as e:
+                wx.CallAfter(wx.MessageBox, str(e), "Couldn't recall scene", wx.OK | wx.ICON_ERROR, self)
+
+        threading.Thread(target=run, name="Recall", daemon=True).start()
+
+    def recall_scene_on_all_cards(self, event):
+        """Recall the same scene on every card which has the scene's model"""
+        scene = self.choose_scene("Recall scene on all cards")
+        if not scene:
+            return
+        # Cards whose windows have been closed are left alone
+        scenes_by_card = {frame.iface.card_index: scene for frame in self.app.frames
+                          if frame.iface.model.canonical_name == scene.model}
+
+        # The cards are written in parallel, each waiting for its own worker
+        def run():
+            try:
+                self.app.cards.recall(scenes_by_card)
+            except session.SessionError as e:
+                wx.CallAfter(wx.MessageBox, str(e), "Couldn't recall scene", wx.OK | wx.ICON_ERROR, self)
+
+        threading.Thread(target=run, name="Recall", daemon=True).start()
+
+    def crossfade_to_scene(self, event):
+        scene = self.choose_scene("Crossfade to scene")
+        if not scene:
+            return
+        duration = wx.GetNumberFromUser("Fade time in seconds:", "", "Crossfade to scene",
+                                        self.CROSSFADE_TIME, 0, 600, self)
+        if duration < 0:
+            return
+
+        # The fade runs on the RampEngine; this thread just waits for the
+        # midpoint to switch the sources, so the event loop carries on
+        def run():
+            try:
+                scenes.crossfade(self.iface, scene, duration)
+            except ValueError as e:
+                wx.CallAfter(wx.MessageBox, str(e), "Couldn't crossfade", wx.OK | wx.ICON_ERROR, self)
+
+        threading.Thread(target=run, name="Crossfade", daemon=True).start()
+
+    def show_call_stats(self, event):
+        CallStatsDialog(self, self.iface.stats).Show()
+
 
 class MixerApp(wx.App):
-    def __init__(self, iface):
-        self.iface = iface
+    """A main window for each card in `cards`. The app exits when the last
+    one is closed."""
+    def __init__(self, cards: session.Session):
+        self.cards = cards
 
         wx.App.__init__(self)
 
+    def OnExit(self):
+        # Make sure the final position of any fader being moved is written
+        self.cards.stop()
+        for card_index, metrics in self.cards.metrics().items():
+            logger.debug("Card %d fader writes: %s", card_index, metrics["writes"])
+            # Only an Interface with an I/O worker has its metrics
+            if metrics.get("io"):
+                logger.debug("Card %d ALSA I/O: %s", card_index, metrics["io"])
+        return 0
+
     def OnInit(self):
-        self.frame = MainWindow(self, self.iface)
-        self.frame.Show(True)
-        self.SetTopWindow(self.frame)
+        # Keep slow USB transfers off the event loop. Each card has its own
+        # worker, so one slow card doesn't hold up the others' windows.
+        self.cards.start_io_workers(dispatch=wx.CallAfter)
+
+        self.frames = []
+        for iface in self.cards:
+            start = time.perf_counter()
+            frame = MainWindow(self, iface)
+            logger.debug("Created main window for card %d in %.1f ms",
+                         iface.card_index, (time.perf_counter() - start) * 1000)
+            frame.Show(True)
+            self.frames.append(frame)
+        self.SetTopWindow(self.frames[0])
+
+        # Changes are passed to widgets by each interface's store
+        self.cards.start_change_monitors()
 
         return True
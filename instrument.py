@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import alsaaudio
+import atexit
+import bisect
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import typing
+
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+
+OPERATIONS = ["getenum", "setenum", "getvolume", "setvolume", "getrange"]
+
+# Upper bounds of the latency histogram buckets, in microseconds. Anything
+# slower goes in a final overflow bucket.
+BUCKET_BOUNDS_US = [50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+
+class OpStats:
+    """Call count and latency histogram for one operation on one control"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_US) + 1)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_US, seconds * 1e6)] += 1
+
+    def percentile(self, p: float) -> float:
+        """Estimate a percentile from the histogram, as the upper bound of the
+        bucket containing it (in seconds)"""
+        if self.count == 0:
+            return 0.0
+        threshold = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= threshold:
+                break
+        if i >= len(BUCKET_BOUNDS_US):
+            return self.max
+        return min(BUCKET_BOUNDS_US[i] / 1e6, self.max)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "histogram_us": dict(zip([str(b) for b in BUCKET_BOUNDS_US] + ["inf"], self.buckets)),
+        }
+
+
+class CallStats:
+    """Thread-safe collection of OpStats, keyed by control name and operation"""
+    def __init__(self):
+        # Reentrant, as the SIGUSR1 handler dumps the statistics on the main
+        # thread, which may be recording a call at the time
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.ops: typing.Dict[typing.Tuple[str, str], OpStats] = {}
+            self.started = time.time()
+
+    def record(self, control: str, op: str, seconds: float):
+        with self.lock:
+            key = (control, op)
+            if key not in self.ops:
+                self.ops[key] = OpStats()
+            self.ops[key].record(seconds)
+
+    def rows(self) -> typing.List[typing.Tuple[str, str, OpStats]]:
+        """All (control, operation, stats) entries, hottest first"""
+        with self.lock:
+            rows = [(control, op, stats) for (control, op), stats in self.ops.items()]
+        return sorted(rows, key=lambda r: (-r[2].total, r[0], r[1]))
+
+    def totals(self) -> typing.Dict[str, OpStats]:
+        """Stats for each operation summed over all controls"""
+        totals = {op: OpStats() for op in OPERATIONS}
+        for _, op, stats in self.rows():
+            t = totals[op]
+            t.count += stats.count
+            t.total += stats.total
+            t.max = max(t.max, stats.max)
+            t.buckets = [a + b for a, b in zip(t.buckets, stats.buckets)]
+        return totals
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        controls: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for control, op, stats in self.rows():
+            controls.setdefault(control, {})[op] = stats.to_json()
+        return {
+            "since": self.started,
+            "duration_s": time.time() - self.started,
+            "totals": {op: stats.to_json() for op, stats in self.totals().items()},
+            "controls": controls,
+        }
+
+    def dump(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wt") as f:
+            json.dump(self.to_json(), f, sort_keys=True, indent=4)
+        logger.info("Wrote ALSA call statistics to %s", path)
+
+
+class InstrumentedMixer:
+    """Proxy for an alsaaudio.Mixer which records the latency of every control
+    access in a CallStats"""
+    def __init__(self, mixer_elem: alsaaudio.Mixer, stats: CallStats):
+        self.mixer_elem = mixer_elem
+        self.stats = stats
+        self.name = mixer_elem.mixer()
+
+    def __getattr__(self, attr):
+        return getattr(self.mixer_elem, attr)
+
+    def _timed(self, op: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return getattr(self.mixer_elem, op)(*args, **kwargs)
+        finally:
+            self.stats.record(self.name, op, time.perf_counter() - start)
+
+    def mixer(self) -> str:
+        return self.name
+
+    def getenum(self):
+        return self._timed("getenum")
+
+    def setenum(self, index: int):
+        return self._timed("setenum", index)
+
+    def getvolume(self, *args, **kwargs) -> typing.List[int]:
+        return self._timed("getvolume", *args, **kwargs)
+
+    def setvolume(self, *args, **kwargs):
+        return self._timed("setvolume", *args, **kwargs)
+
+    def getrange(self, *args, **kwargs) -> typing.Tuple[int, int]:
+        return self._timed("getrange", *args, **kwargs)
+
+
+def install_dump_handlers(stats: CallStats, path: str):
+    """Write the statistics to `path` on SIGUSR1 and at exit"""
+    def on_signal(signum, frame):
+        stats.dump(path)
+
+    signal.signal(signal.SIGUSR1, on_signal)
+    atexit.register(stats.dump, path)
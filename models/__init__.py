@@ -30,3 +30,20 @@ MODELS: typing.List[Model] = [
 
 def all_canonical_names() -> typing.List[str]:
     return [m.canonical_name for m in MODELS]
+
+
+def find(canonical_name: str) -> Model:
+    for model in MODELS:
+        if model.canonical_name == canonical_name:
+            return model
+    raise KeyError(canonical_name)
+
+
+def by_card_name(model_list: typing.Optional[typing.List[Model]] = None) \
+        -> typing.Dict[str, typing.List[Model]]:
+    """Index models by the ALSA card name they match. More than one model may
+    share a card name, e.g. if a driver update changes the control set."""
+    index: typing.Dict[str, typing.List[Model]] = {}
+    for model in MODELS if model_list is None else model_list:
+        index.setdefault(model.name, []).append(model)
+    return index
@@ -14,7 +14,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import alsaaudio
 import itertools
 import logging
 import typing
@@ -60,20 +59,40 @@ class Model:
         self.stereo_sources = stereo_sources
         self.stereo_sinks = stereo_sinks
 
-    def validate_mixer_elems(self, mixer_elems):
-        """Verify that all the mixer elements specified in the model actually exist"""
+    def routing_controls(self) -> typing.List[str]:
+        """Names of the enum controls which select the source of a sink"""
+        return self.physical_outputs + self.mixer_inputs
+
+    def mixer_input_gains(self) -> typing.Dict[str, typing.List[str]]:
+        """The gain controls which set the level of each mixer input, one
+        in each mix"""
+        gains: typing.Dict[str, typing.List[str]] = {mixer_input: [] for mixer_input in self.mixer_inputs}
+        for controls in self.mixes.values():
+            for control, mixer_input in zip(controls, self.mixer_inputs):
+                gains[mixer_input].append(control)
+        return gains
+
+    def source_enum_values(self) -> typing.Set[str]:
+        return set(["Off"] + self.physical_inputs + list(self.mixes.keys()) + self.pcm_outputs)
+
+    def validate_mixer_elems(self, mixer_elems,
+                             enum_choices: typing.Optional[typing.Dict[str, typing.List[str]]] = None):
+        """Verify that all the mixer elements specified in the model actually exist.
+        The choices read from each routing control are stored in `enum_choices`
+        if it is given."""
         passed = True
         # Every sink (physical output or mixer input) should be an enum, and should
         # have every physical input, mix, and output PCM as a possible value.
-        source_enum_values = set(["Off"] + self.physical_inputs +
-                                 list(self.mixes.keys()) + self.pcm_outputs)
-        for output in self.physical_outputs + self.mixer_inputs:
+        source_enum_values = self.source_enum_values()
+        for output in self.routing_controls():
             if output not in mixer_elems:
                 logger.info("Missing mixer element %s", output)
                 return False
 
             elem = mixer_elems[output]
             current, enum_values = elem.getenum()
+            if enum_choices is not None:
+                enum_choices[output] = list(enum_values)
             if set(enum_values) != source_enum_values:
                 logger.info("Source selections for output %s do not match expected values from model",
                             output)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An Open Sound Control (UDP) server, so mixes can be controlled from
+tablets and control surfaces.
+
+Addresses are numbered from 1, in the order the GUI shows them:
+- /mix/<m>/fader/<f> <dB>: the fader of mixer input <f> in mix <m>
+- /mixer_input/<n>/source <name or index>: the source of mixer input <n>
+- /output/<n>/source <name or index>: the source of output <n>
+
+A message with no arguments is a query, answered with a message to the
+sender with the same address and the current value. All the messages in a
+bundle are applied together, or not at all if any of them is invalid.
+Bundle time tags are ignored: everything is applied as soon as it arrives.
+"""
+
+
+import alsaaudio
+import functools
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+import typing
+
+import backend
+import instrument
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+DEFAULT_PORT = 7770
+
+# Faders are set in dB, as the GUI shows them
+VOLUME_UNITS = alsaaudio.VOLUME_UNITS_DB
+
+BUNDLE_TAG = b"#bundle\0"
+# Time tag meaning "immediately"
+IMMEDIATELY = 1
+
+
+class OSCError(Exception):
+    pass
+
+
+class Message:
+    def __init__(self, address: str, args: typing.List[typing.Any]):
+        self.address = address
+        self.args = args
+
+    def __repr__(self):
+        return "Message(%r, %r)" % (self.address, self.args)
+
+
+def pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+def encode_string(s: str) -> bytes:
+    return pad(s.encode("utf-8") + b"\0")
+
+
+def encode_message(address: str, *args: typing.Any) -> bytes:
+    tags = ","
+    data = b""
+    for arg in args:
+        if isinstance(arg, bool):
+            tags += "T" if arg else "F"
+        elif isinstance(arg, int):
+            tags += "i"
+            data += struct.pack(">i", arg)
+        elif isinstance(arg, float):
+            tags += "f"
+            data += struct.pack(">f", arg)
+        elif isinstance(arg, str):
+            tags += "s"
+            data += encode_string(arg)
+        elif isinstance(arg, bytes):
+            tags += "b"
+            data += struct.pack(">i", len(arg)) + pad(arg)
+        else:
+            raise OSCError(f"Can't encode {arg!r}")
+    return encode_string(address) + encode_string(tags) + data
+
+
+def encode_bundle(elements: typing.List[bytes], timetag: int = IMMEDIATELY) -> bytes:
+    return BUNDLE_TAG + struct.pack(">Q", timetag) + b"".join(
+        struct.pack(">i", len(element)) + element for element in elements)
+
+
+def decode_string(data: bytes, offset: int) -> typing.Tuple[str, int]:
+    end = data.find(b"\0", offset)
+    if end < 0:
+        raise OSCError("Unterminated string")
+    return data[offset:end].decode("utf-8", errors="replace"), end + 1 + (-(end + 1) % 4)
+
+
+def decode_message(data: bytes) -> Message:
+    try:
+        address, offset = decode_string(data, 0)
+        if offset >= len(data):
+            return Message(address, [])
+        tags, offset = decode_string(data, offset)
+        if not tags.startswith(","):
+            raise OSCError(f"Bad type tags '{tags}'")
+        args: typing.List[typing.Any] = []
+        for tag in tags[1:]:
+            if tag == "i":
+                args.append(struct.unpack_from(">i", data, offset)[0])
+                offset += 4
+            elif tag == "f":
+                args.append(struct.unpack_from(">f", data, offset)[0])
+                offset += 4
+            elif tag == "h":
+                args.append(struct.unpack_from(">q", data, offset)[0])
+                offset += 8
+            elif tag == "d":
+                args.append(struct.unpack_from(">d", data, offset)[0])
+                offset += 8
+            elif tag == "s":
+                s, offset = decode_string(data, offset)
+                args.append(s)
+            elif tag == "b":
+                size = struct.unpack_from(">i", data, offset)[0]
+                args.append(data[offset + 4:offset + 4 + size])
+                offset += 4 + size + (-size % 4)
+            elif tag in "TF":
+                args.append(tag == "T")
+            elif tag == "N":
+                args.append(None)
+            else:
+                raise OSCError(f"Unsupported type tag '{tag}'")
+    except struct.error as e:
+        raise OSCError(f"Truncated message: {e}")
+    return Message(address, args)
+
+
+def decode_packet(data: bytes) -> typing.List[Message]:
+    """The messages in a packet, with those of nested bundles flattened"""
+    if not data.startswith(BUNDLE_TAG):
+        return [decode_message(data)]
+    messages = []
+    offset = len(BUNDLE_TAG) + 8
+    while offset < len(data):
+        try:
+            size = struct.unpack_from(">i", data, offset)[0]
+        except struct.error as e:
+            raise OSCError(f"Truncated bundle: {e}")
+        element = data[offset + 4:offset + 4 + size]
+        if size < 0 or len(element) != size:
+            raise OSCError("Truncated bundle element")
+        messages += decode_packet(element)
+        offset += 4 + size
+    return messages
+
+
+class Fader:
+    def __init__(self, mixer_elem: backend.StereoVolumeMixer):
+        self.mixer_elem = mixer_elem
+
+    def parse(self, args: typing.List[typing.Any]) -> int:
+        if len(args) != 1 or not isinstance(args[0], (int, float)) or isinstance(args[0], bool):
+            raise OSCError(f"{self.mixer_elem.mixer()} takes one number, in dB")
+        vmin, vmax = self.mixer_elem.getrange(units=VOLUME_UNITS)
+        return max(vmin, min(vmax, round(args[0] * 100)))
+
+    def write(self, volume: int):
+        self.mixer_elem.setvolume(volume, units=VOLUME_UNITS)
+
+    def value(self) -> float:
+        return self.mixer_elem.getvolume(units=VOLUME_UNITS)[0] / 100.0
+
+
+class SourceSelect:
+    def __init__(self, mixer_elem: backend.SupportsEnumMixer):
+        self.mixer_elem = mixer_elem
+
+    def parse(self, args: typing.List[typing.Any]) -> int:
+        if len(args) == 1 and isinstance(args[0], str):
+            index = self.mixer_elem.index_of(args[0])
+        elif len(args) == 1 and isinstance(args[0], int) and not isinstance(args[0], bool):
+            index = args[0] if 0 <= args[0] < len(self.mixer_elem.getenum()[1]) else -1
+        else:
+            raise OSCError(f"{self.mixer_elem.mixer()} takes one source name or index")
+        if index < 0:
+            raise OSCError(f"{args[0]!r} is not a source for {self.mixer_elem.mixer()}")
+        return index
+
+    def write(self, index: int):
+        self.mixer_elem.setenum(index)
+
+    def value(self) -> str:
+        return self.mixer_elem.getenum()[0]
+
+
+Target = typing.Union[Fader, SourceSelect]
+
+# A datagram, its sender, and when it was received
+Packet = typing.Tuple[bytes, typing.Any, float]
+
+
+def addresses(iface: backend.Interface) -> typing.Dict[str, Target]:
+    targets: typing.Dict[str, Target] = {}
+    for m, mix in enumerate(iface.get_mixes(), 1):
+        for f, mixer_elem in enumerate(mix.mixer_elems, 1):
+            targets[f"/mix/{m}/fader/{f}"] = Fader(mixer_elem)
+    for n, mixer_input in enumerate(iface.get_mixer_inputs(), 1):
+        targets[f"/mixer_input/{n}/source"] = SourceSelect(mixer_input.mixer_elem)
+    for n, output in enumerate(iface.get_outputs(), 1):
+        targets[f"/output/{n}/source"] = SourceSelect(output.mixer_elem)
+    return targets
+
+
+class Server:
+    """Applies OSC messages to an Interface.
+
+    Values are written by a flush job on the Interface's I/O worker. Only
+    one flush is queued at a time, and only the latest value for each
+    control is kept until it runs, so however fast messages arrive, a fader
+    costs at most one write per flush and the queue never backs up. The
+    messages of a bundle always land in the same flush, which is made in
+    one cache batch.
+    """
+    # Most datagrams to read before applying them
+    MAX_BURST = 1024
+    MAX_DATAGRAM = 65536
+
+    def __init__(self, iface: backend.Interface, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self.iface = iface
+        self.targets = addresses(iface)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.stop_pipe = os.pipe()
+        self.thread: typing.Optional[threading.Thread] = None
+
+        self.lock = threading.Lock()
+        # Messages in valid packets, and packets ignored as invalid
+        self.messages = 0
+        self.invalid = 0
+        self.coalesced = 0
+        self.writes = 0
+        # Latest value for each control which hasn't been written yet, and
+        # when the packets which set them were received
+        self.pending: typing.Dict[str, typing.Tuple[Target, int]] = {}
+        self.pending_received: typing.List[float] = []
+        self.flush_queued = False
+        # From a packet being received to its write being made
+        self.latency = instrument.OpStats()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="OSCServer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.stop_pipe[1], b"\0")
+        if self.thread:
+            self.thread.join()
+        self.sock.close()
+        os.close(self.stop_pipe[0])
+        os.close(self.stop_pipe[1])
+
+    def serve_forever(self):
+        logger.info("Listening for OSC on %s:%d", *self.address)
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        poller.register(self.stop_pipe[0], select.POLLIN)
+        while True:
+            ready = poller.poll()
+            if any(fd == self.stop_pipe[0] for fd, _ in ready):
+                return
+            self.handle_packets(self.receive())
+
+    def receive(self) -> typing.List[Packet]:
+        packets: typing.List[Packet] = []
+        while len(packets) < self.MAX_BURST:
+            try:
+                data, sender = self.sock.recvfrom(self.MAX_DATAGRAM)
+            except BlockingIOError:
+                break
+            packets.append((data, sender, time.monotonic()))
+        return packets
+
+    def resolve(self, message: Message) -> Target:
+        target = self.targets.get(message.address)
+        if target is None:
+            raise OSCError(f"No such address {message.address}")
+        return target
+
+    def handle_packets(self, packets: typing.List[Packet]):
+        # control name -> (target, value), in the order they were first set
+        writes: typing.Dict[str, typing.Tuple[Target, int]] = {}
+        queries: typing.List[typing.Tuple[typing.Any, str, Target]] = []
+        received: typing.List[float] = []
+        messages = invalid = updated = 0
+        for data, sender, received_at in packets:
+            try:
+                packet = [(message, self.resolve(message)) for message in decode_packet(data)]
+                updates = [(target, target.parse(message.args))
+                           for message, target in packet if message.args]
+            except OSCError as e:
+                logger.warning("Ignoring OSC packet from %s: %s", sender, e)
+                invalid += 1
+                continue
+
+            messages += len(packet)
+            queries += [(sender, message.address, target) for message, target in packet if not message.args]
+            updated += len(updates)
+            for target, value in updates:
+                writes[target.mixer_elem.mixer()] = (target, value)
+            if updates:
+                received.append(received_at)
+
+        with self.lock:
+            self.messages += messages
+            self.invalid += invalid
+            # Every update which doesn't add a control to `pending` replaces
+            # one which will now never be written
+            self.coalesced += updated - len(writes.keys() - self.pending.keys())
+            self.pending.update(writes)
+            self.pending_received += received
+            queue_flush = bool(writes) and not self.flush_queued
+            self.flush_queued = self.flush_queued or queue_flush
+
+        io_worker = self.iface.io_worker
+        if queue_flush:
+            if io_worker:
+                io_worker.submit(self.flush)
+            else:
+                self.flush()
+        if queries:
+            # After the flush, so a query answers with any value set before it
+            if io_worker:
+                io_worker.submit(functools.partial(self.answer, queries))
+            else:
+                self.answer(queries)
+
+    def flush(self):
+        """Make the pending writes. With an I/O worker this runs on the
+        worker thread, and values which arrive while earlier writes are
+        being made replace each other in `pending` rather than queueing."""
+        with self.lock:
+            writes, self.pending = self.pending, {}
+            received, self.pending_received = self.pending_received, []
+            self.flush_queued = False
+        with self.iface.cache.batch():
+            for key, (target, value) in writes.items():
+                try:
+                    target.write(value)
+                except alsaaudio.ALSAAudioError as e:
+                    logger.error("Writing %s failed: %s", key, e)
+        now = time.monotonic()
+        with self.lock:
+            self.writes += len(writes)
+            for received_at in received:
+                self.latency.record(now - received_at)
+
+    def answer(self, queries: typing.List[typing.Tuple[typing.Any, str, Target]]):
+        for sender, address, target in queries:
+            self.reply(sender, address, target.value())
+
+    def reply(self, sender: typing.Any, address: str, value: typing.Any):
+        try:
+            self.sock.sendto(encode_message(address, value), sender)
+        except OSError as e:
+            logger.warning("Couldn't reply to %s: %s", sender, e)
+
+    def metrics(self) -> typing.Dict[str, typing.Any]:
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "invalid": self.invalid,
+                "coalesced": self.coalesced,
+                "writes": self.writes,
+                "latency": self.latency.to_json(),
+            }
+
+
+def serve(iface: backend.Interface, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+    """Serve `iface` until interrupted"""
+    iface.start_io_worker()
+    server = Server(iface, host, port)
+    server.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: os.write(server.stop_pipe[1], b"\0"))
+    try:
+        while server.thread and server.thread.is_alive():
+            server.thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        iface.stop()
+        logger.info("OSC metrics: %s", server.metrics())
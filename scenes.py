@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import alsaaudio
+import json
+import logging
+import os
+import time
+import typing
+
+import backend
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+# Mix gains are stored in the units the faders use
+GAIN_UNITS = alsaaudio.VOLUME_UNITS_DB
+
+
+def scene_dir() -> str:
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, version.NAME, "scenes")
+
+
+def scene_path(name: str) -> str:
+    if not name or os.sep in name or name.startswith("."):
+        raise ValueError(f"Invalid scene name '{name}'")
+    return os.path.join(scene_dir(), name + ".json")
+
+
+def list_scenes() -> typing.List[str]:
+    try:
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(scene_dir()) if f.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+
+class Scene:
+    """The complete state of a card's mixer: every mix gain, the source of
+    every mixer input and output, and the global settings"""
+    def __init__(self, name: str, model: str,
+                 enums: typing.Dict[str, str], volumes: typing.Dict[str, int]):
+        self.name = name
+        self.model = model
+        # Choice selected for each enum control
+        self.enums = enums
+        # Volume of each gain control, in GAIN_UNITS
+        self.volumes = volumes
+
+    @classmethod
+    def capture(cls, iface: backend.Interface, name: str) -> "Scene":
+        model = iface.model
+        enums: typing.Dict[str, str] = {}
+        volumes: typing.Dict[str, int] = {}
+        for control in model.routing_controls():
+            enums[control] = iface.mixer_elems[control].getenum()[0]
+        for control in gain_controls(iface):
+            volumes[control] = iface.mixer_elems[control].getvolume(units=GAIN_UNITS)[0]
+        for control in model.global_settings:
+            mixer_elem = iface.mixer_elems[control]
+            if backend.is_enum(mixer_elem):
+                enums[control] = mixer_elem.getenum()[0]
+            else:
+                volumes[control] = mixer_elem.getvolume(units=GAIN_UNITS)[0]
+        return cls(name, model.canonical_name, enums, volumes)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "enums": self.enums,
+            "volumes": self.volumes,
+        }
+
+    @classmethod
+    def from_json(cls, data: typing.Dict[str, typing.Any]) -> "Scene":
+        return cls(data["name"], data["model"], data["enums"], data["volumes"])
+
+    def save(self, path: typing.Optional[str] = None):
+        path = path or scene_path(self.name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wt") as f:
+            json.dump(self.to_json(), f, sort_keys=True, indent=4)
+        logger.info("Saved scene %s to %s", self.name, path)
+
+    @classmethod
+    def load(cls, name_or_path: str) -> "Scene":
+        path = name_or_path if name_or_path.endswith(".json") else scene_path(name_or_path)
+        with open(path, "rt") as f:
+            return cls.from_json(json.load(f))
+
+
+def gain_controls(iface: backend.Interface) -> typing.List[str]:
+    return [control for mix in sorted(iface.model.mixes) for control in iface.model.mixes[mix]]
+
+
+class RecallResult:
+    def __init__(self, scene: Scene):
+        self.scene = scene
+        self.writes = 0
+        self.elapsed = 0.0
+        # Controls whose value the recall changed
+        self.changed: typing.List[str] = []
+
+
+def stage(iface: backend.Interface, scene: Scene):
+    """Write every control in `scene`, for a transaction to collect"""
+    if scene.model != iface.model.canonical_name:
+        raise ValueError(f"Scene {scene.name} is for a {scene.model}, not a {iface.model.canonical_name}")
+    for control, value in scene.enums.items():
+        backend.set_enum_value(iface.mixer_elems[control], value)
+    for control, volume in scene.volumes.items():
+        iface.mixer_elems[control].setvolume(volume, units=GAIN_UNITS)
+
+
+def plan_recall(iface: backend.Interface, scene: Scene) -> typing.List[typing.Tuple[str, typing.Any]]:
+    """The (control, value) writes needed to get from the current state to
+    `scene`, in the order Transaction makes them"""
+    transaction = backend.Transaction(iface.cache, iface.model)
+    with transaction.collect():
+        stage(iface, scene)
+    return [(control, value) for control, value, _, _ in transaction.plan()]
+
+
+def recall(iface: backend.Interface, scene: Scene) -> RecallResult:
+    """Write only the controls which differ from `scene`, in one
+    transaction"""
+    result = RecallResult(scene)
+    with iface.transaction() as transaction:
+        stage(iface, scene)
+    result.writes = transaction.writes
+    result.elapsed = transaction.elapsed
+    result.changed = transaction.changed
+    logger.info("Recalled scene %s: %d writes to %d controls in %.1f ms",
+                scene.name, result.writes, len(result.changed), result.elapsed * 1000)
+    return result
+
+
+def crossfade(iface: backend.Interface, scene: Scene, duration: float,
+              curve: str = backend.EQUAL_POWER) -> RecallResult:
+    """Fade from the current state to `scene` over `duration` seconds, using
+    the Interface's RampEngine, and wait for it to finish.
+
+    Sources can't be faded, so the gains of mixer inputs whose source
+    changes are faded out over the first half, and faded in to their
+    targets over the second half. The sources and every other enum are
+    switched at the midpoint. Gains the user grabs during the fade are
+    left where they are put."""
+    if scene.model != iface.model.canonical_name:
+        raise ValueError(f"Scene {scene.name} is for a {scene.model}, not a {iface.model.canonical_name}")
+    result = RecallResult(scene)
+    start = time.perf_counter()
+    midpoint = time.monotonic() + duration / 2
+
+    switched = [control for control, value in scene.enums.items()
+                if iface.mixer_elems[control].getenum()[0] != value]
+    mixer_input_gains = iface.model.mixer_input_gains()
+    muted = {gain for control in switched for gain in mixer_input_gains.get(control, [])}
+
+    gains = {control: iface.mixer_elems[control] for control in scene.volumes}
+    fades = [iface.ramps.fade([(gains[control], volume) for control, volume in scene.volumes.items()
+                               if control not in muted], duration, curve)]
+
+    if switched:
+        fade_out = iface.ramps.fade([(gains[gain], gains[gain].getrange(units=GAIN_UNITS)[0])
+                                     for gain in sorted(muted) if gain in gains], duration / 2, curve)
+        fade_out.wait()
+        time.sleep(max(0.0, midpoint - time.monotonic()))
+        with iface.transaction() as transaction:
+            for control in switched:
+                backend.set_enum_value(iface.mixer_elems[control], scene.enums[control])
+        result.writes += transaction.writes
+        grabbed = fade_out.cancelled()
+        fades += [fade_out, iface.ramps.fade([(gains[gain], scene.volumes[gain])
+                                              for gain in sorted(muted)
+                                              if gain in gains and gain not in grabbed],
+                                             duration / 2, curve)]
+
+    for fade in fades:
+        fade.wait()
+        result.writes += sum(ramp.writes for ramp in fade.ramps)
+        for ramp in fade.ramps:
+            if ramp.writes and ramp.name not in result.changed:
+                result.changed.append(ramp.name)
+    result.changed += [control for control in switched if control not in result.changed]
+    result.elapsed = time.perf_counter() - start
+    logger.info("Crossfaded to scene %s: %d writes to %d controls in %.1f ms",
+                scene.name, result.writes, len(result.changed), result.elapsed * 1000)
+    return result
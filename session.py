@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Several cards open in one process, e.g. a rack of identical interfaces.
+
+    session = session.Session.open(backend.discover_cards())
+    session.start_io_workers()
+    session.each(lambda iface: scenes.recall(iface, scene))
+"""
+
+
+import concurrent.futures
+import logging
+import time
+import typing
+
+import backend
+import scenes
+import version
+
+logger = logging.getLogger(version.NAME + "." + __name__)
+
+T = typing.TypeVar("T")
+
+
+class SessionError(Exception):
+    """An operation run on every card failed on some of them"""
+    def __init__(self, errors: typing.Dict[int, Exception], results: typing.Dict[int, typing.Any]):
+        super().__init__("; ".join(f"card {card_index}: {e}" for card_index, e in sorted(errors.items())))
+        self.errors = errors
+        # Results of the cards which succeeded
+        self.results = results
+
+
+class Session:
+    """An Interface for each of several cards.
+
+    Each Interface has its own I/O worker, so one card's queue of slow
+    transfers never holds up another card's. each() runs an operation on
+    every card at once, on a thread per card.
+
+    pyalsaaudio holds the GIL during a transfer, so transfers to different
+    cards take turns rather than overlapping. An operation on several cards
+    takes as long as the sum of their transfers, but a fast card finishes
+    without waiting for a slow one's whole operation.
+    """
+    def __init__(self, ifaces: typing.List[backend.Interface]):
+        self.ifaces = {iface.card_index: iface for iface in ifaces}
+
+    @classmethod
+    def open(cls, cards: typing.List[backend.SupportedCard], **kwargs) -> "Session":
+        """Make an Interface for each card. `kwargs` are passed to every
+        Interface."""
+        return cls([backend.Interface(card.card_index, card.mixer_elems, card.model, **kwargs)
+                    for card in cards])
+
+    def __len__(self) -> int:
+        return len(self.ifaces)
+
+    def __iter__(self) -> typing.Iterator[backend.Interface]:
+        return iter(self.ifaces.values())
+
+    def __getitem__(self, card_index: int) -> backend.Interface:
+        return self.ifaces[card_index]
+
+    def each(self, fn: typing.Callable[[backend.Interface], T]) -> typing.Dict[int, T]:
+        """Call `fn` with every card's Interface in parallel, and return the
+        results by card index. If it raises for any card, the others still
+        finish, then SessionError is raised."""
+        if len(self.ifaces) == 1:
+            # Not worth a thread
+            card_index, iface = next(iter(self.ifaces.items()))
+            try:
+                return {card_index: fn(iface)}
+            except Exception as e:
+                raise SessionError({card_index: e}, {})
+
+        results: typing.Dict[int, T] = {}
+        errors: typing.Dict[int, Exception] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.ifaces),
+                                                   thread_name_prefix="Card") as executor:
+            futures = {card_index: executor.submit(fn, iface) for card_index, iface in self.ifaces.items()}
+            for card_index, future in futures.items():
+                try:
+                    results[card_index] = future.result()
+                except Exception as e:
+                    errors[card_index] = e
+        if errors:
+            raise SessionError(errors, results)
+        return results
+
+    def start_io_workers(self, dispatch: typing.Optional[typing.Callable[..., None]] = None):
+        for iface in self:
+            iface.start_io_worker(dispatch)
+
+    def start_change_monitors(self):
+        for iface in self:
+            iface.start_change_monitor()
+
+    def stop(self):
+        """Make every card's pending writes and stop its threads"""
+        self.each(lambda iface: iface.stop())
+
+    def recall(self, scenes_by_card: typing.Dict[int, scenes.Scene], fade: typing.Optional[float] = None,
+               curve: str = backend.EQUAL_POWER) -> typing.Dict[int, scenes.RecallResult]:
+        """Recall a scene on each of the cards in `scenes_by_card` at once,
+        crossfading over `fade` seconds if it is given"""
+        def run(iface: backend.Interface) -> typing.Optional[scenes.RecallResult]:
+            scene = scenes_by_card.get(iface.card_index)
+            if scene is None:
+                return None
+            if fade:
+                return scenes.crossfade(iface, scene, fade, curve)
+            return scenes.recall(iface, scene)
+
+        start = time.perf_counter()
+        results = {card_index: result for card_index, result in self.each(run).items() if result}
+        logger.info("Recalled scenes on %d cards in %.1f ms",
+                    len(results), (time.perf_counter() - start) * 1000)
+        return results
+
+    def metrics(self) -> typing.Dict[int, typing.Dict[str, typing.Dict[str, float]]]:
+        """Each card's Interface.metrics()"""
+        return {card_index: iface.metrics() for card_index, iface in self.ifaces.items()}
@@ -37,6 +37,11 @@ class Mixer():
     def getvolume(self, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE) -> typing.List[int]: ...
     def setenum(self, int): ...
     def setmute(self, mute: int): ...
+    def polldescriptors(self) -> typing.List[typing.Tuple[int, int]]:
+        return []
+    def handleevents(self) -> int:
+        return 0
+    def close(self): ...
     def setvolume(self, volume: int, channel: int=None, pcmtype=PCM_PLAYBACK, units=VOLUME_UNITS_PERCENTAGE): ...
 
 
@@ -8,8 +8,18 @@ cd "${SRC_DIR}"
 
 SRCS=(
     redmixctl
+    aio.py
+    alsasim.py
+    benchmark.py
+    cli.py
+    daemon.py
+    fingerprint.py
     backend.py
     gui.py
+    instrument.py
+    osc.py
+    scenes.py
+    session.py
     models/*.py
     mixer_control_dumps/detect_controls.py
 )
@@ -41,6 +51,9 @@ check_result "mypy" $?
 run_cmd pycodestyle --max-line-length 109 "${SRCS[@]}"
 check_result "pycodestyle" $?
 
+run_cmd python3 -m pytest -q tests
+check_result "pytest" $?
+
 hrule
 
 if [[ $STATUS -eq 0 ]]; then
@@ -0,0 +1,75 @@
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import os
+import sys
+import threading
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, SRC_DIR)
+
+import alsasim  # noqa: E402
+
+# Tests always run against simulated cards, even if pyalsaaudio is installed.
+alsasim.install()
+
+import backend  # noqa: E402
+import models  # noqa: E402
+
+DUMP_18I20_GEN2 = os.path.join(SRC_DIR, "mixer_control_dumps", "18i20_gen2.json")
+MODEL = models.Scarlett18i20gen2.Scarlett18i20gen2
+
+
+@pytest.fixture
+def card():
+    card = alsasim.SimulatedCard.from_dump(DUMP_18I20_GEN2)
+    alsasim.set_cards([card])
+    yield card
+    alsasim.set_cards([])
+
+
+@pytest.fixture
+def iface(card, tmp_path, monkeypatch):
+    """An Interface to `card`, with the calls made opening it forgotten.
+    Scenes and other configuration are kept in `tmp_path`."""
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    card_index, mixer_elems = backend.find_card_index(MODEL)
+    iface = backend.Interface(card_index, mixer_elems, MODEL)
+    card.reset_calls()
+    yield iface
+    iface.stop()
+
+
+@contextlib.contextmanager
+def held(io_worker: backend.IOWorker):
+    """Keep `io_worker` busy, so nothing submitted to it runs until the end
+    of the context"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        started.set()
+        release.wait()
+
+    io_worker.submit(hold)
+    started.wait()
+    try:
+        yield
+    finally:
+        release.set()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+
+import pytest
+
+import aio
+import backend
+import conftest
+
+
+def test_get_and_set(iface):
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        await aiface.set("Mix A Input 01", -600)
+        await aiface.set("Mixer Input 01", "ADAT 2")
+        assert await aiface.get("Mix A Input 01") == -600
+        assert await aiface.get("Mixer Input 01") == "ADAT 2"
+        with pytest.raises(ValueError):
+            await aiface.set("Mixer Input 01", "Nowhere")
+        with pytest.raises(KeyError):
+            await aiface.get("Nonexistent")
+
+    asyncio.run(main())
+    assert iface.cache.raw_mixer_elems["Mixer Input 01"].getenum()[0] == "ADAT 2"
+
+
+def test_failed_batch_resolves_every_future(iface, monkeypatch):
+    def fail(name=None):
+        raise RuntimeError("Broken")
+
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        monkeypatch.setattr(iface.store, "get", lambda name, units: fail())
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(aiface.get("Mix A Input 01"), 2)
+
+        iface.cache.add_listener(fail)
+        results = await asyncio.wait_for(asyncio.gather(
+            aiface.set("Mix A Input 01", -600), aiface.get("Mix A Input 02"), return_exceptions=True), 2)
+        assert [type(r) for r in results] == [RuntimeError, RuntimeError]
+
+    asyncio.run(main())
+
+
+def test_one_tick_is_one_batch(card, iface, monkeypatch):
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        # Read everything once, so only the writes reach the card
+        await asyncio.gather(*(aiface.get(f"Mix A Input {i:02}") for i in range(1, 9)))
+        jobs = []
+        submit = iface.io_worker.submit
+        monkeypatch.setattr(iface.io_worker, "submit", lambda fn, *args: jobs.append(fn) or submit(fn, *args))
+        card.reset_calls()
+
+        writes = [aiface.set(f"Mix A Input {i:02}", -1000) for i in range(1, 9)]
+        # Superseded by the last write in the same tick
+        writes += [aiface.set("Mix A Input 01", -2000)]
+        await asyncio.gather(*writes, aiface.get("Mix A Input 01"))
+
+        assert len(jobs) == 1
+        assert card.writes() == 8
+        assert await aiface.get("Mix A Input 01") == -2000
+        assert aiface.metrics()["batches"] == 3
+
+    asyncio.run(main())
+
+
+def test_loop_is_not_blocked(card, iface):
+    # The loop carries on while a batch waits for the card
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        gains = iface.model.mixes["Mix A"][:10]
+        with conftest.held(iface.io_worker):
+            writes = asyncio.ensure_future(asyncio.gather(*(aiface.set(name, -600) for name in gains)))
+            while not aiface.metrics()["batches"]:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            assert not writes.done()
+            assert card.writes() == 0
+        await writes
+        assert aiface.metrics()["batches"] == 1
+        assert card.writes() == len(gains)
+
+    asyncio.run(main())
+
+
+def test_flush_with_saturated_worker(card, iface):
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        worker = iface.io_worker
+        with conftest.held(worker):
+            for _ in range(worker.max_queue):
+                worker.submit(lambda: None)
+            first = asyncio.ensure_future(aiface.set("Mix A Input 01", -600))
+            while not aiface.metrics()["batches"]:
+                await asyncio.sleep(0)
+            # The loop still runs, and can queue more batches behind the first
+            second = asyncio.ensure_future(aiface.set("Mix A Input 02", -600))
+            while aiface.metrics()["batches"] < 2:
+                await asyncio.sleep(0)
+            assert worker.metrics()["queue_depth"] == worker.max_queue + 2
+            assert not first.done() and not second.done()
+        await asyncio.gather(first, second)
+        assert card.writes() == 2
+
+    asyncio.run(main())
+
+
+def test_watch(iface):
+    async def main():
+        aiface = aio.AsyncInterface(iface)
+        changes = aiface.watch(["Mixer Input 01", "Mix A Input 01"])
+        first = asyncio.ensure_future(changes.__anext__())
+        await asyncio.sleep(0)
+
+        # Changes made from another thread are seen too
+        other = threading.Thread(target=backend.set_enum_value,
+                                 args=(iface.mixer_elems["Mixer Input 01"], "ADAT 3"))
+        other.start()
+        other.join()
+        assert await asyncio.wait_for(first, 5) == ("Mixer Input 01", "ADAT 3")
+
+        await aiface.set("Mix A Input 01", -1200)
+        assert await asyncio.wait_for(changes.__anext__(), 5) == ("Mix A Input 01", -1200)
+        await changes.aclose()
+
+    subscriptions = len(iface.store.subscriptions["Mixer Input 01"])
+    asyncio.run(main())
+    assert len(iface.store.subscriptions["Mixer Input 01"]) == subscriptions
+    assert iface.store.subscriptions["Mix A Input 01"] == []
@@ -0,0 +1,82 @@
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+import pytest
+
+import alsaaudio
+import alsasim
+import backend
+import models
+
+
+def test_alsaaudio_is_simulated():
+    assert alsaaudio is alsasim
+
+
+def test_card_discovery(card):
+    assert alsaaudio.card_indexes() == [0]
+    assert alsaaudio.card_name(0)[0] == models.Scarlett18i20gen2.Scarlett18i20gen2.name
+    assert "Mixer Input 01" in alsaaudio.mixers(cardindex=0)
+
+
+def test_enum(card):
+    elem = alsaaudio.Mixer("Mixer Input 01", cardindex=0)
+    current, choices = elem.getenum()
+    assert current == "Off"
+    elem.setenum(choices.index("PCM 3"))
+    assert elem.getenum()[0] == "PCM 3"
+    with pytest.raises(alsaaudio.ALSAAudioError):
+        elem.setenum(len(choices))
+    assert alsaaudio.Mixer("Mix A Input 01", cardindex=0).getenum() == ()
+
+
+def test_volume_units(card):
+    elem = alsaaudio.Mixer("Mix A Input 01", cardindex=0)
+    assert elem.getrange(units=alsaaudio.VOLUME_UNITS_RAW) == (0, 172)
+    assert elem.getrange(units=alsaaudio.VOLUME_UNITS_DB) == (-8000, 600)
+    elem.setvolume(0, units=alsaaudio.VOLUME_UNITS_DB)
+    assert elem.getvolume(units=alsaaudio.VOLUME_UNITS_RAW) == [160]
+    assert elem.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [0]
+    elem.setvolume(100)
+    assert elem.getvolume(units=alsaaudio.VOLUME_UNITS_RAW) == [172]
+
+
+def test_missing_control(card):
+    with pytest.raises(alsaaudio.ALSAAudioError):
+        alsaaudio.Mixer("No Such Control", cardindex=0)
+
+
+def test_call_counting_and_latency(card):
+    card.latency = 0.01
+    elem = alsaaudio.Mixer("Mixer Input 01", cardindex=0)
+    card.reset_calls()
+    start = time.monotonic()
+    elem.getenum()
+    elem.setenum(1)
+    assert time.monotonic() - start >= 0.02
+    assert card.reads() == 1
+    assert card.writes() == 1
+
+
+def test_interface_on_simulated_card(card):
+    model = models.Scarlett18i20gen2.Scarlett18i20gen2
+    card_index, mixer_elems = backend.find_card_index(model)
+    iface = backend.Interface(card_index, mixer_elems, model)
+    assert len(iface.get_mixes()) == 5
+    assert iface.mixer_elems["Line Out 01 Volume Control"].getenum()[0] == "HW"
+    assert iface.mixer_elems["PCM 01"].getenum()[0] == "Analogue 1"
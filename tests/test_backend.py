@@ -0,0 +1,512 @@
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import functools
+import time
+import typing
+
+import pytest
+
+import alsaaudio
+import alsasim
+import backend
+import cli
+import conftest
+import fingerprint
+
+
+def test_cache_answers_reads_from_memory(card, iface):
+    fader = iface.get_mixes()[0].mixer_elems[0]
+    fader.getvolume()
+    card.reset_calls()
+    for _ in range(3):
+        iface.mixer_elems["Mixer Input 01"].getenum()
+        fader.getvolume()
+    assert card.reads() == 0
+
+
+def test_cache_remembers_controls_are_not_enums(card, iface):
+    for _ in range(5):
+        assert iface.store.get("Mix A Input 01") == iface.store.get("Mix A Input 01")
+    assert card.calls["getenum"] == 1
+
+    # Invalidating only forgets the volume
+    iface.cache.invalidate()
+    card.reset_calls()
+    iface.store.get("Mix A Input 01")
+    assert dict(card.calls) == {"getvolume": 1}
+
+
+def test_cache_follows_own_writes(card, iface):
+    elem = iface.mixer_elems["Mixer Input 01"]
+    current, choices = elem.getenum()
+    backend.set_enum_value(elem, "ADAT 3")
+    assert elem.getenum()[0] == "ADAT 3"
+
+    gain = iface.mixer_elems["Mix A Input 01"]
+    gain.setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    assert gain.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-600]
+    # Only the volume is read back, in case the driver rounded it
+    assert card.calls["getenum"] == 0 and card.calls["getvolume"] == 1
+
+
+@pytest.mark.parametrize("io_worker", [False, True])
+def test_cache_keeps_rounded_volume(card, iface, io_worker):
+    if io_worker:
+        iface.start_io_worker()
+    calls = []
+    iface.store.subscribe("Mix A Input 01", lambda: calls.append(iface.store.get("Mix A Input 01")))
+    assert cli.set_control(iface, "Mix A Input 01", "-6.3") == {"Mix A Input 01": -6.5}
+    assert calls[-1] == -650
+    assert card.control("Mix A Input 01").volume == card.control("Mix A Input 01").to_raw(
+        -650, alsaaudio.VOLUME_UNITS_DB)
+    iface.stop()
+
+
+def test_cache_invalidate(card, iface):
+    raw = alsaaudio.Mixer("Mixer Input 01", cardindex=0)
+    current, choices = raw.getenum()
+    raw.setenum(choices.index("PCM 7"))
+
+    elem = iface.mixer_elems["Mixer Input 01"]
+    assert elem.getenum()[0] != "PCM 7"
+    iface.cache.invalidate("Mixer Input 01")
+    assert elem.getenum()[0] == "PCM 7"
+
+
+def test_cached_choices_are_not_shared(iface):
+    elem = iface.mixer_elems["Mixer Input 01"]
+    elem.getenum()[1].remove("Off")
+    assert "Off" in elem.getenum()[1]
+
+
+def source(iface, name):
+    return next(s for s in iface.get_inputs() if s.name == name)
+
+
+def test_source_mixer_input_follows_routing(card, iface):
+    assert source(iface, "ADAT 5").mixer_input is None
+
+    backend.set_enum_value(iface.mixer_elems["Mixer Input 03"], "ADAT 5")
+    assert source(iface, "ADAT 5").mixer_input == "Mixer Input 03"
+
+    stereo_input = iface.get_mixer_inputs()[-1].mixer_elem
+    stereo_input.setenum(stereo_input.choices.index("ADAT 5"))
+    assert source(iface, "ADAT 5").mixer_input == "Mixer Input 18"
+
+    backend.set_enum_value(iface.mixer_elems["Mixer Input 03"], "Off")
+    assert iface.source_mixer_inputs["ADAT 5"] == ["Mixer Input 17", "Mixer Input 18"]
+    assert card.reads() == 0
+
+
+def test_routing_change_is_single_write(card, iface):
+    mono_input = iface.mixer_elems["Mixer Input 01"]
+    backend.set_enum_value(mono_input, "Analogue 2")
+    assert (card.reads(), card.writes()) == (0, 1)
+
+    card.reset_calls()
+    stereo_input = iface.get_mixer_inputs()[-1].mixer_elem
+    stereo_input.setenum(stereo_input.index_of("PCM 3 + PCM 4"))
+    assert (card.reads(), card.writes()) == (0, 2)
+    assert stereo_input.getenum()[0] == "PCM 3 + PCM 4"
+    assert iface.mixer_elems["Mixer Input 18"].getenum()[0] == "PCM 4"
+
+
+def test_noop_writes_are_suppressed(card, iface):
+    fader = iface.get_mixes()[0].mixer_elems[-1]
+    assert len(fader.zero) == 2
+    fader.setvolume(50)
+    card.reset_calls()
+    suppressed = iface.cache.suppressed
+
+    fader.setvolume(60)
+    assert card.writes() == 2
+    fader.setvolume(60)
+    assert card.writes() == 2
+    assert iface.cache.suppressed - suppressed == 6
+
+    fader.setvolume(60, force=True)
+    assert card.writes() == 6
+
+
+def test_forced_values_not_rewritten(card):
+    model = conftest.MODEL
+    card_index, mixer_elems = backend.find_card_index(model)
+    backend.Interface(card_index, mixer_elems, model)
+    card.reset_calls()
+    iface = backend.Interface(card_index, backend.get_mixer_elems(card_index), model)
+    assert card.writes() == 0
+
+    card.reset_calls()
+    iface.resync()
+    assert card.writes() == len(model.force_enum_values) + len(model.force_volumes)
+
+
+def test_write_scheduler_coalesces():
+    written = []
+    scheduler = backend.WriteScheduler(max_rate=20.0)
+    for i in range(100):
+        scheduler.submit("fader", functools.partial(written.append, i))
+    time.sleep(0.2)
+    scheduler.stop()
+
+    assert written[-1] == 99
+    assert len(written) <= 3
+    metrics = scheduler.metrics()
+    assert metrics["written"] == len(written)
+    assert metrics["coalesced"] == 100 - len(written)
+    assert metrics["pending"] == 0
+
+
+def test_write_scheduler_rate_is_per_key():
+    written = []
+    scheduler = backend.WriteScheduler(max_rate=1.0)
+    scheduler.submit("a", functools.partial(written.append, "a"))
+    scheduler.submit("b", functools.partial(written.append, "b"))
+    time.sleep(0.1)
+    assert sorted(written) == ["a", "b"]
+    scheduler.submit("a", functools.partial(written.append, "a2"))
+    time.sleep(0.1)
+    assert len(written) == 2
+    scheduler.stop()
+    assert written[-1] == "a2"
+
+
+def test_io_worker_keeps_writes_off_caller(card, iface):
+    fader = iface.get_mixes()[0].mixer_elems[0]
+    fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB)
+    card.latency = 0.05
+    iface.start_io_worker()
+
+    start = time.monotonic()
+    fader.setvolume(-1000, units=alsaaudio.VOLUME_UNITS_DB)
+    assert time.monotonic() - start < card.latency
+    assert fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-1000]
+
+    iface.stop()
+    assert card.writes() == 2
+    raw = alsaaudio.Mixer(fader.L.mixer(), cardindex=0)
+    assert raw.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-1000]
+    assert iface.io_worker.metrics()["jobs"] == 2
+
+
+def test_io_worker_does_not_stall_caller(card, iface):
+    # The caller carries on while its writes wait for the card
+    gains = conftest.MODEL.mixes["Mix A"][:10]
+    iface.start_io_worker()
+    with conftest.held(iface.io_worker):
+        for name in gains:
+            iface.mixer_elems[name].setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+        assert card.writes() == 0
+    iface.stop()
+    assert card.writes() == len(gains)
+
+
+def test_io_worker_submit_never_blocks(caplog):
+    worker = backend.IOWorker(max_queue=2)
+    worker.start()
+    done: typing.List[int] = []
+    with conftest.held(worker):
+        for i in range(10):
+            worker.submit(functools.partial(done.append, i))
+        assert worker.metrics()["max_queue_depth"] == 10
+        assert caplog.text.count("More than 2 ALSA accesses are queued") == 1
+        assert done == []
+    worker.stop()
+    assert done == list(range(10))
+
+
+def test_io_worker_reports_errors(card, iface):
+    errors = []
+    iface.start_io_worker()
+    elem = iface.mixer_elems["Mixer Input 01"]
+    iface.io_worker.submit(functools.partial(iface.cache.raw_mixer_elems["Mixer Input 01"].setenum, 1000),
+                           on_error=errors.append)
+    iface.stop()
+    assert len(errors) == 1
+    assert isinstance(errors[0], alsaaudio.ALSAAudioError)
+    assert elem.getenum()[0] == "Off"
+
+
+def test_stopped_interface_still_works(card, iface):
+    iface.start_io_worker()
+    iface.start_change_monitor()
+    iface.stop()
+    iface.stop()
+    # Without the worker, rather than waiting forever for it
+    gain = iface.mixer_elems["Mix A Input 01"]
+    gain.setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    assert gain.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-600]
+    assert card.control("Mix A Input 01").volume == card.control("Mix A Input 01").to_raw(
+        -600, alsaaudio.VOLUME_UNITS_DB)
+
+
+def test_change_monitor_reports_external_changes(card, iface):
+    gain = iface.mixer_elems["Mix A Input 01"]
+    gain.getvolume()
+    iface.mixer_elems["Mixer Input 01"].getenum()
+
+    changes = []
+    iface.start_io_worker()
+    iface.start_change_monitor(changes.append)
+    time.sleep(0.1)
+
+    # Our own writes shouldn't be reported
+    gain.setvolume(40)
+    time.sleep(0.2)
+    assert changes == []
+
+    other_tool = alsaaudio.Mixer("Mixer Input 01", cardindex=0)
+    other_tool.setenum(other_tool.getenum()[1].index("ADAT 2"))
+    for _ in range(50):
+        if changes:
+            break
+        time.sleep(0.02)
+    iface.stop()
+
+    assert changes == [["Mixer Input 01"]]
+    assert iface.mixer_elems["Mixer Input 01"].getenum()[0] == "ADAT 2"
+    assert iface.source_mixer_inputs["ADAT 2"] == ["Mixer Input 01"]
+
+
+
+def test_change_monitor_without_controls(card, caplog):
+    monitor = backend.ChangeMonitor(0, backend.MixerStateCache({}))
+    monitor.start()
+    monitor.thread.join(5)
+    assert not monitor.thread.is_alive()
+    assert "Card 0 has no controls to monitor" in caplog.text
+    monitor.stop()
+
+def test_mixer_elems_are_opened_lazily(card):
+    card_index, mixer_elems = backend.find_card_index(conftest.MODEL)
+    assert len(mixer_elems) == len(card.controls)
+    assert set(mixer_elems.opened) == set(conftest.MODEL.physical_outputs + conftest.MODEL.mixer_inputs)
+    assert card.calls["open"] == len(mixer_elems.opened)
+
+    iface = backend.Interface(card_index, mixer_elems, conftest.MODEL)
+    assert "Mix A Input 01" not in mixer_elems.opened
+    iface.mixer_elems["Mix A Input 01"].getvolume()
+    iface.mixer_elems["Mix A Input 01"].getvolume(units=alsaaudio.VOLUME_UNITS_DB)
+    assert "Mix A Input 01" in mixer_elems.opened
+    assert card.calls["open"] == len(mixer_elems.opened)
+
+    with pytest.raises(KeyError):
+        mixer_elems["No Such Control"]
+
+
+def test_discover_cards_opens_each_candidate_once(card):
+    other = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, name="Onboard Audio")
+    second = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2)
+    alsasim.set_cards([other, card, second])
+
+    cards = backend.discover_cards(isolate=False)
+    assert [c.card_index for c in cards] == [1, 2]
+    assert all(c.model is conftest.MODEL for c in cards)
+    assert all(c.probe_time > 0 for c in cards)
+    assert other.calls["open"] == 0
+    assert card.calls["open"] == second.calls["open"] == len(cards[0].mixer_elems.opened)
+
+
+def test_cards_are_probed_in_parallel(card, caplog):
+    onboard = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, name="Onboard Audio")
+    racked = [alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, latency=latency)
+              for latency in [0.001, 0.002, 0.004]]
+    alsasim.set_cards([onboard] + racked)
+
+    caplog.set_level("DEBUG")
+    start = time.perf_counter()
+    cards = backend.discover_cards()
+    elapsed = time.perf_counter() - start
+
+    assert [c.card_index for c in cards] == [1, 2, 3]
+    assert all(c.model is conftest.MODEL for c in cards)
+    # Each card is probed in its own process, holding its own GIL, so the
+    # probes overlap
+    assert elapsed < sum(c.probe_time for c in cards) * 0.8
+    assert cards[2].probe_time > cards[0].probe_time
+    # The cards listed and validated by the probes aren't listed again here
+    assert all(c.calls["mixers"] == c.calls["open"] == 0 for c in racked)
+    assert all(c.mixer_elems.names == list(racked[0].controls) for c in cards)
+    model = conftest.MODEL
+    for i in [1, 2, 3]:
+        assert f"Card {i} [{model.name}] is a {model.canonical_name}, probed in" in caplog.text
+    assert "Card 0 [Onboard Audio] is not a supported model" in caplog.text
+
+
+def test_hung_card_does_not_block_discovery(card, caplog):
+    # Stuck in a single call, which a thread couldn't be interrupted in
+    hung = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, latency=60.0)
+    alsasim.set_cards([hung, card])
+
+    start = time.perf_counter()
+    cards = backend.discover_cards(timeout=0.5)
+    assert time.perf_counter() - start < 1.0
+    assert [c.card_index for c in cards] == [1]
+    assert "Card 0 didn't respond within 0.5 s" in caplog.text
+
+
+@pytest.mark.parametrize("isolate", [True, False])
+def test_failed_probe_is_skipped(card, tmp_path, caplog, isolate):
+    broken = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, longname="Broken")
+    alsasim.set_cards([broken, card])
+    # A cache entry with no choices, which the spot check can't use
+    validation_cache = fingerprint.ValidationCache(str(tmp_path / "validated_cards.json"))
+    validation_cache.entries[f"{conftest.MODEL.canonical_name} [Broken]"] = {
+        "controls": fingerprint.digest(sorted(broken.controls)),
+    }
+
+    cards = backend.discover_cards(validation_cache=validation_cache, isolate=isolate)
+    assert [c.card_index for c in cards] == [1]
+    assert "Couldn't probe card 0: " in caplog.text
+
+
+def test_mixer_input_routing_is_shared(card, iface):
+    routing = iface.mixer_input_routing
+    seen = []
+    for _ in range(5):
+        routing.add_observer(lambda index, source: seen.append((index, source)))
+
+    card.reset_calls()
+    routing.select(0, routing.choices(0).index("ADAT 4"))
+    assert card.writes() == 1
+    assert card.reads() == 0
+    assert seen == [(0, "ADAT 4")] * 5
+
+    # External changes reach observers through the store
+    seen.clear()
+    iface.cache.invalidate("Mixer Input 02")
+    assert seen == [(1, routing.get(1))] * 5
+
+
+def test_store_notifies_only_subscribers(card, iface):
+    calls = []
+    mix = iface.get_mixes()[0]
+    iface.store.subscribe(mix.mixer_elems[0], lambda: calls.append("fader 0"))
+    iface.store.subscribe(mix.mixer_elems[1], lambda: calls.append("fader 1"))
+    iface.store.subscribe("Mixer Input 01", lambda: calls.append("input 1"))
+
+    mix.mixer_elems[1].setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    assert set(calls) == {"fader 1"}
+    assert iface.store.get(mix.mixer_elems[1].L.mixer()) == -600
+
+    calls.clear()
+    iface.mixer_elems["Mixer Input 01"].setenum(3)
+    assert calls == ["input 1"]
+    assert iface.store.get("Mixer Input 01") == iface.mixer_elems["Mixer Input 01"].getenum()[1][3]
+
+    calls.clear()
+    iface.cache.invalidate()
+    assert sorted(calls) == ["fader 0", "fader 1", "input 1"]
+
+
+def test_store_dispatch_coalesces(card, iface):
+    queued = []
+    calls = []
+    iface.store.dispatch = lambda fn, *args: queued.append(functools.partial(fn, *args))
+    iface.store.subscribe("Mix A Input 01", lambda: calls.append(1))
+
+    for vol in range(-1000, 0, 100):
+        iface.mixer_elems["Mix A Input 01"].setvolume(vol, units=alsaaudio.VOLUME_UNITS_DB)
+    assert len(queued) == 1
+    queued.pop()()
+    assert calls == [1]
+    iface.mixer_elems["Mix A Input 01"].setvolume(0, units=alsaaudio.VOLUME_UNITS_DB)
+    assert len(queued) == 1
+
+
+def test_transaction_drops_repeated_and_noop_writes(card, iface):
+    gain = iface.mixer_elems["Mix A Input 01"]
+    current = gain.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0]
+    card.reset_calls()
+    with iface.transaction() as transaction:
+        gain.setvolume(-3000, units=alsaaudio.VOLUME_UNITS_DB)
+        gain.setvolume(-2000, units=alsaaudio.VOLUME_UNITS_DB)
+        iface.mixer_elems["Mix B Input 01"].setvolume(current, units=alsaaudio.VOLUME_UNITS_DB)
+        # Nothing is written until the end of the block
+        assert card.writes() == 0
+    assert (transaction.requested, transaction.writes) == (3, 1)
+    assert transaction.changed == ["Mix A Input 01"]
+    assert card.writes() == 1
+    assert gain.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] == -2000
+
+    with pytest.raises(RuntimeError):
+        with iface.transaction():
+            gain.setvolume(0, units=alsaaudio.VOLUME_UNITS_DB)
+            raise RuntimeError()
+    assert card.writes() == 1
+    assert gain.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] == -2000
+
+
+def test_transaction_cuts_gains_around_rerouting(card, iface):
+    stereo_input = iface.get_mixer_inputs()[-1].mixer_elem
+    gains = conftest.MODEL.mixer_input_gains()
+    for mix_gain in gains[stereo_input.L.mixer()][:3]:
+        iface.mixer_elems[mix_gain].setvolume(0, units=alsaaudio.VOLUME_UNITS_DB)
+    level = iface.mixer_elems[gains[stereo_input.L.mixer()][0]]
+    silent = level.getrange(units=alsaaudio.VOLUME_UNITS_DB)[0]
+
+    transaction = backend.Transaction(iface.cache, conftest.MODEL)
+    with transaction.collect():
+        backend.set_enum_value(stereo_input, "PCM 1 + PCM 2")
+        level.setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    plan = [(name, value) for name, value, _, _ in transaction.plan()]
+    assert plan == [(mix_gain, silent) for mix_gain in gains[stereo_input.L.mixer()][:3]] + [
+        (stereo_input.L.mixer(), "PCM 1"),
+        (stereo_input.R.mixer(), "PCM 2"),
+        (level.mixer(), -600),
+    ] + [(mix_gain, 0) for mix_gain in gains[stereo_input.L.mixer()][1:3]]
+
+    card.reset_calls()
+    with iface.transaction() as transaction:
+        backend.set_enum_value(stereo_input, "PCM 1 + PCM 2")
+        level.setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    assert transaction.writes == card.writes() == len(plan)
+    assert stereo_input.getenum()[0] == "PCM 1 + PCM 2"
+    assert level.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] == -600
+
+
+def test_ramp_curves():
+    for curve in backend.CURVES.values():
+        assert round(curve(-4000, 0, 0.0)) == -4000
+        assert round(curve(-4000, 0, 1.0)) == 0
+    assert backend.linear_db(-4000, 0, 0.5) == -2000
+    # Half way through an equal-power fade in, the level is 3 dB down
+    assert round(backend.equal_power(-8000, 0, 0.5)) == -301
+
+
+def test_ramps_share_ticks(card, iface):
+    faders = iface.get_mixes()[0].mixer_elems[:4]
+    iface.start_io_worker()
+    fade = iface.ramps.fade([(fader, -2000) for fader in faders], 0.2)
+    assert fade.wait(5)
+    assert [fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] for fader in faders] == [-2000] * 4
+    metrics = iface.ramps.metrics()
+    assert metrics["active"] == 0
+    # Every tick writes all four faders
+    assert metrics["writes"] == 4 * metrics["ticks"]
+    assert 5 <= metrics["ticks"] <= 0.2 * backend.RampEngine.TICK_RATE + 2
+
+
+def test_ramp_is_cancelled_when_fader_is_grabbed(card, iface):
+    fader, other = iface.get_mixes()[0].mixer_elems[:2]
+    fade = iface.ramps.fade([(fader, 0), (other, 0)], 1.0)
+    time.sleep(0.1)
+    fader.setvolume(-1000, units=alsaaudio.VOLUME_UNITS_DB)
+    assert fade.wait(5)
+    assert fade.cancelled() == [fader.mixer()]
+    assert fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] == -1000
+    assert other.getvolume(units=alsaaudio.VOLUME_UNITS_DB)[0] == 0
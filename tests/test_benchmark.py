@@ -0,0 +1,38 @@
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+import alsasim
+import benchmark
+import models
+
+
+def test_benchmark_results():
+    bench = benchmark.Benchmark(benchmark.DEFAULT_DUMP, latency=0.0)
+    try:
+        bench.run(models.Scarlett18i20gen2.Scarlett18i20gen2, repeat=1)
+    finally:
+        # The benchmark installs cards of its own
+        alsasim.set_cards([])
+    results = json.loads(json.dumps(bench.to_json()))["results"]
+
+    for name in ["discover_cards", "Interface.__init__", "fader_sweep", "routing_change", "command_get"]:
+        assert results[name]["runs"] == 1
+    for phase in benchmark.INTERFACE_INIT_PHASES:
+        assert "Interface." + phase in results
+    assert results["fader_sweep"]["writes"] > 0
+    assert results["routing_change"]["writes"] > 0
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import cli
+import conftest
+import scenes
+
+
+def test_get_and_set(iface):
+    assert cli.get(iface, ["Mixer Input 01"]) == {"Mixer Input 01": "Off"}
+    assert cli.set_control(iface, "Mix A Input 01", "-6.5") == {"Mix A Input 01": -6.5}
+    assert cli.set_control(iface, "Mixer Input 01", "ADAT 3") == {"Mixer Input 01": "ADAT 3"}
+
+    with pytest.raises(cli.CommandError):
+        cli.set_control(iface, "Mix A Input 01", "+100")
+    with pytest.raises(cli.CommandError):
+        cli.set_control(iface, "Mixer Input 01", "Nowhere")
+    with pytest.raises(cli.CommandError):
+        cli.get(iface, ["No Such Control"])
+
+
+def test_route_stereo_pair(iface):
+    result = cli.route(iface, "Mixer Input 17 + Mixer Input 18", "PCM 1 + PCM 2")
+    assert result == {"Mixer Input 17 + Mixer Input 18": "PCM 1 + PCM 2"}
+    assert iface.mixer_elems["Mixer Input 18"].getenum()[0] == "PCM 2"
+
+
+def test_apply_scene(iface):
+    scenes.Scene.capture(iface, "verse").save()
+    cli.set_control(iface, "Mix A Input 01", "0")
+    result = cli.apply(iface, "verse")
+    assert result["writes"] == 1
+    assert result["changed"] == ["Mix A Input 01"]
+
+
+def test_headless_command(tmp_path):
+    # Isolated from any daemon which happens to be running
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmp_path), XDG_CACHE_HOME=str(tmp_path),
+               XDG_RUNTIME_DIR=str(tmp_path))
+    redmixctl = os.path.join(conftest.SRC_DIR, "redmixctl")
+    for _ in range(2):
+        proc = subprocess.run([sys.executable, "-X", "importtime", redmixctl, "--logfile", str(tmp_path / "log"),
+                               "--simulate", conftest.DUMP_18I20_GEN2, "--no-daemon",
+                               "get", "--json", "Mixer Input 01"],
+                              env=env, check=True, capture_output=True, text=True)
+        assert json.loads(proc.stdout) == {"Mixer Input 01": "Off"}
+        imported = [line.split("|")[-1].strip() for line in proc.stderr.splitlines() if "|" in line]
+        # Nothing which a one-off command doesn't use
+        for module in ["gui", "daemon", "instrument", "session", "multiprocessing",
+                       "concurrent.futures", "logging.handlers", "ctypes"]:
+            assert module not in imported
+        assert not [m for m in imported if m == "wx" or m.startswith("wx.")]
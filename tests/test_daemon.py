@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import alsaaudio
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import backend
+import conftest
+import daemon
+
+
+@pytest.fixture
+def server(iface, tmp_path):
+    iface.start_io_worker()
+    iface.start_change_monitor()
+    server = daemon.Server(str(tmp_path / "redmixctl.sock"), iface)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    iface.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = daemon.connect(server.path)
+    yield client
+    client.close()
+
+
+def enum_value(card, name):
+    control = card.control(name)
+    return control.enum_values[control.enum_index]
+
+
+def wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.02)
+
+
+def test_commands(card, client):
+    assert client.request("info")["model"] == conftest.MODEL.canonical_name
+
+    client.request("set", args={"control": "Mix A Input 01", "value": "-12"})
+    assert client.request("get", args={"controls": ["Mix A Input 01"]}) == {"Mix A Input 01": -12.0}
+    client.request("route", args={"sink": "Mixer Input 01", "source": "ADAT 2"})
+    wait_for(lambda: enum_value(card, "Mixer Input 01") == "ADAT 2")
+    assert enum_value(card, "Mixer Input 01") == "ADAT 2"
+
+    with pytest.raises(daemon.DaemonError, match="No such control"):
+        client.request("get", args={"controls": ["Nonexistent"]})
+    with pytest.raises(daemon.DaemonError, match="Unknown op"):
+        client.request("reboot")
+
+
+def test_second_server_refused(server):
+    assert daemon.ping(server.path)
+    with pytest.raises(daemon.DaemonError):
+        daemon.Server(server.path, server.iface)
+    assert daemon.connect(server.path + ".missing") is None
+
+
+def test_socket_of_another_user_refused(server, monkeypatch):
+    uid = os.getuid()
+    with monkeypatch.context() as m:
+        m.setattr(os, "getuid", lambda: uid + 1)
+        assert daemon.connect(server.path) is None
+        with pytest.raises(daemon.DaemonError, match="belongs to another user"):
+            daemon.Server(server.path, server.iface)
+    assert daemon.ping(server.path)
+
+
+def test_client_disconnects_on_invalid_message(tmp_path, caplog):
+    path = str(tmp_path / "redmixctl.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+        listener.bind(path)
+        listener.listen()
+        client = daemon.connect(path)
+        conn, _ = listener.accept()
+        with conn:
+            conn.sendall(b"not json\n")
+            client.reader.join(2)
+            assert not client.reader.is_alive()
+            assert "Invalid message from daemon" in caplog.text
+            with pytest.raises(daemon.DaemonError):
+                client.request("info", timeout=2)
+            client.close()
+    assert not client.event_thread.is_alive()
+
+
+def test_subscribers_see_changes_from_other_clients(server, client):
+    changes = []
+    client.subscribe(["Mixer Input 01"], changes.extend)
+
+    other = daemon.connect(server.path)
+    other.request("route", args={"sink": "Mixer Input 02", "source": "ADAT 3"})
+    other.request("route", args={"sink": "Mixer Input 01", "source": "ADAT 2"})
+    other.close()
+    wait_for(lambda: changes)
+    assert changes == ["Mixer Input 01"]
+
+    # Changes made by anything else are reported too
+    other_tool = alsaaudio.Mixer("Mixer Input 01", cardindex=0)
+    other_tool.setenum(other_tool.getenum()[1].index("ADAT 4"))
+    wait_for(lambda: len(changes) > 1)
+    assert changes == ["Mixer Input 01", "Mixer Input 01"]
+
+
+def test_remote_interface(card, server, client):
+    iface = daemon.RemoteInterface(client)
+    assert [mi.name for mi in iface.get_mixer_inputs()] == [mi.name for mi in server.iface.get_mixer_inputs()]
+    card.reset_calls()
+
+    mixer_input = iface.get_mixer_inputs()[0].mixer_elem
+    backend.set_enum_value(mixer_input, "ADAT 2")
+    wait_for(lambda: enum_value(card, mixer_input.name) == "ADAT 2")
+    assert enum_value(card, mixer_input.name) == "ADAT 2"
+    assert card.writes() == 1
+
+    # The remote cache follows changes made through the daemon
+    iface.start_change_monitor()
+    server.iface.mixer_elems["Mix A Input 01"].setvolume(-600, units=alsaaudio.VOLUME_UNITS_DB)
+    wait_for(lambda: iface.mixer_elems["Mix A Input 01"].getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-600])
+    assert iface.mixer_elems["Mix A Input 01"].getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-600]
+
+
+def test_request_timeout(client, monkeypatch):
+    def slow_info(server, connection, request):
+        time.sleep(0.5)
+        return None
+
+    monkeypatch.setattr(daemon.Server, "handle_request_op", slow_info)
+    with pytest.raises(daemon.DaemonError, match="No reply"):
+        client.request("info", timeout=0.1)
+    assert client.request("info", timeout=2) is None
+
+
+def test_remote_cache_keeps_own_writes(server, client, monkeypatch):
+    iface = daemon.RemoteInterface(client)
+    iface.start_change_monitor()
+    fader = iface.mixer_elems["Mix A Input 01"]
+    fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB)
+
+    requests = []
+    request = client.request
+    monkeypatch.setattr(client, "request", lambda op, **kwargs: requests.append(op) or request(op, **kwargs))
+    misses = iface.cache.misses
+    for i in range(20):
+        fader.setvolume(-100 * i, units=alsaaudio.VOLUME_UNITS_DB)
+        assert fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-100 * i]
+    # Any change events would have arrived by now
+    client.request("info")
+    time.sleep(0.1)
+    assert fader.getvolume(units=alsaaudio.VOLUME_UNITS_DB) == [-1900]
+    assert requests == ["setvolume"] * 20 + ["info"]
+    assert iface.cache.misses == misses
+
+
+def test_bad_requests_get_error_replies(server, client, monkeypatch):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(server.path)
+        replies = sock.makefile("rb")
+        for line in [b"not json\n", b"[1, 2]\n", b"\"info\"\n"]:
+            sock.sendall(line)
+            assert json.loads(replies.readline()) == {"error": "Malformed request"}
+        sock.sendall(b'{"op": "info", "id": 1}\n')
+        assert json.loads(replies.readline())["id"] == 1
+
+    def broken(server, connection, request):
+        raise RuntimeError("Broken")
+
+    monkeypatch.setattr(daemon.Server, "handle_request_op", broken)
+    with pytest.raises(daemon.DaemonError, match="RuntimeError: Broken"):
+        client.request("info", timeout=2)
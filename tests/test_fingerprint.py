@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import alsasim
+import backend
+import conftest
+import fingerprint
+
+
+def discover(path, isolate=False):
+    # Probe in this process by default, so the simulated cards' call counts
+    # include the probe's calls
+    cards = backend.discover_cards(validation_cache=fingerprint.ValidationCache(str(path)), isolate=isolate)
+    return [c.model for c in cards]
+
+
+def test_fingerprint_match_skips_validation(card, tmp_path):
+    path = tmp_path / "validated_cards.json"
+    assert discover(path) == [conftest.MODEL]
+    full_reads = card.reads()
+    assert full_reads == len(conftest.MODEL.routing_controls())
+    assert path.exists()
+
+    card.reset_calls()
+    assert discover(path) == [conftest.MODEL]
+    assert card.reads() == fingerprint.ValidationCache.SPOT_CHECKS
+
+
+def test_changed_choices_fail_spot_check(card, tmp_path):
+    path = tmp_path / "validated_cards.json"
+    assert discover(path) == [conftest.MODEL]
+
+    spot_checked = fingerprint.ValidationCache.spot_check_controls(conftest.MODEL)[0]
+    card.controls[spot_checked].enum_values.append("S/PDIF 3")
+    assert discover(path) == []
+    assert fingerprint.ValidationCache(str(path)).entries == {}
+
+
+def test_changed_control_set_revalidates(card, tmp_path):
+    path = tmp_path / "validated_cards.json"
+    assert discover(path) == [conftest.MODEL]
+
+    del card.controls["Mix A Input 01"]
+    card.reset_calls()
+    assert discover(path) == [conftest.MODEL]
+    assert card.reads() == len(conftest.MODEL.routing_controls())
+
+
+def test_unreadable_cache_is_ignored(card, tmp_path):
+    path = tmp_path / "validated_cards.json"
+    path.write_text("{not json")
+    assert discover(path) == [conftest.MODEL]
+    assert discover(path) == [conftest.MODEL]
+
+
+def test_probe_processes_update_the_cache(card, tmp_path):
+    path = tmp_path / "validated_cards.json"
+    second = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, longname="Second 18i20")
+    alsasim.set_cards([card, second])
+    assert discover(path, isolate=True) == [conftest.MODEL, conftest.MODEL]
+    assert len(fingerprint.ValidationCache(str(path)).entries) == 2
+
+    # Both cards' entries were saved, though each was made in a different
+    # process
+    card.reset_calls()
+    second.reset_calls()
+    assert discover(path) == [conftest.MODEL, conftest.MODEL]
+    assert card.reads() == second.reads() == fingerprint.ValidationCache.SPOT_CHECKS
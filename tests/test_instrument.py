@@ -0,0 +1,68 @@
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import signal
+
+import backend
+import instrument
+import models
+
+
+def test_percentile():
+    stats = instrument.OpStats()
+    for _ in range(99):
+        stats.record(0.0003)
+    stats.record(0.2)
+    assert stats.count == 100
+    assert stats.percentile(50) == 500 / 1e6
+    assert stats.percentile(100) == 0.2
+
+
+def test_instrumented_interface(card, tmp_path):
+    stats = instrument.CallStats()
+    model = models.Scarlett18i20gen2.Scarlett18i20gen2
+    card_index, mixer_elems = backend.find_card_index(model, stats)
+    backend.Interface(card_index, mixer_elems, model, stats=stats)
+
+    totals = stats.totals()
+    assert totals["getenum"].count == card.calls["getenum"]
+    assert totals["setenum"].count == card.calls["setenum"]
+    assert totals["setvolume"].count == card.calls["setvolume"]
+
+    path = os.path.join(tmp_path, "stats.json")
+    stats.dump(path)
+    with open(path) as f:
+        dumped = json.load(f)
+    assert dumped["controls"]["Mixer Input 01"]["getenum"]["count"] > 0
+
+
+def test_dump_on_signal_while_recording(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrument.atexit, "register", lambda *args: None)
+    stats = instrument.CallStats()
+    stats.record("Mixer Input 01", "getenum", 0.001)
+    path = os.path.join(tmp_path, "stats.json")
+    handler = signal.getsignal(signal.SIGUSR1)
+    instrument.install_dump_handlers(stats, path)
+    try:
+        # As if the signal arrived while the main thread was recording a call
+        with stats.lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+    finally:
+        signal.signal(signal.SIGUSR1, handler)
+    with open(path) as f:
+        assert json.load(f)["controls"]["Mixer Input 01"]["getenum"]["count"] == 1
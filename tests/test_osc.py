@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import time
+
+import pytest
+
+import osc
+
+
+@pytest.fixture
+def iface(iface):
+    iface.start_io_worker()
+    return iface
+
+
+@pytest.fixture
+def server(iface):
+    server = osc.Server(iface, port=0)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def sock(server):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(server.address)
+    sock.settimeout(5)
+    yield sock
+    sock.close()
+
+
+def wait_for_messages(server, n):
+    for _ in range(250):
+        if server.metrics()["messages"] + server.metrics()["invalid"] >= n:
+            break
+        time.sleep(0.02)
+    # Let the I/O worker make the writes
+    server.iface.io_worker.call(lambda: None)
+
+
+def test_codec():
+    data = osc.encode_message("/mix/1/fader/2", -6.5, "ADAT 1", 3, True)
+    assert len(data) % 4 == 0
+    message = osc.decode_message(data)
+    assert message.address == "/mix/1/fader/2"
+    assert message.args == [-6.5, "ADAT 1", 3, True]
+
+    bundle = osc.encode_bundle([osc.encode_message("/a", 1), osc.encode_bundle([osc.encode_message("/b")])])
+    assert [m.address for m in osc.decode_packet(bundle)] == ["/a", "/b"]
+    with pytest.raises(osc.OSCError):
+        osc.decode_packet(bundle[:-3])
+
+
+def test_fader_and_routing(card, server, sock):
+    fader = server.iface.get_mixes()[0].mixer_elems[0]
+    sock.send(osc.encode_message("/mix/1/fader/1", -12.0))
+    sock.send(osc.encode_message("/mixer_input/1/source", "ADAT 2"))
+    sock.send(osc.encode_message("/output/1/source", 0))
+    wait_for_messages(server, 3)
+
+    assert card.control(fader.L.mixer()).from_raw(card.control(fader.L.mixer()).volume, osc.VOLUME_UNITS) == -1200
+    mixer_input = server.iface.get_mixer_inputs()[0].mixer_elem
+    assert mixer_input.getenum()[0] == "ADAT 2"
+
+    sock.send(osc.encode_message("/mix/1/fader/1"))
+    reply = osc.decode_message(sock.recv(1024))
+    assert (reply.address, reply.args) == ("/mix/1/fader/1", [-12.0])
+
+
+def test_bundles_are_all_or_nothing(server, sock):
+    faders = server.iface.get_mixes()[1].mixer_elems
+    sock.send(osc.encode_bundle([osc.encode_message("/mix/2/fader/1", -3.0),
+                                 osc.encode_message("/mix/2/fader/2", "loud")]))
+    sock.send(osc.encode_bundle([osc.encode_message("/mix/2/fader/1", -6.0),
+                                 osc.encode_message("/mix/2/fader/2", -6.0)]))
+    # The invalid bundle counts once, and none of its messages do
+    wait_for_messages(server, 3)
+    assert server.metrics()["invalid"] == 1
+    assert server.metrics()["messages"] == 2
+    assert [f.getvolume(units=osc.VOLUME_UNITS)[0] for f in faders[:2]] == [-600, -600]
+
+
+def test_bursts_are_coalesced(card, iface):
+    server = osc.Server(iface, port=0)
+    card.reset_calls()
+    # Send the whole burst before the server starts reading
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for i in range(200):
+            sock.sendto(osc.encode_message("/mix/1/fader/1", -40.0 + i * 0.1), server.address)
+    server.start()
+    wait_for_messages(server, 200)
+    server.stop()
+
+    metrics = server.metrics()
+    assert metrics["writes"] == 1
+    assert metrics["coalesced"] == 199
+    assert metrics["latency"]["count"] == 200
+    fader = iface.get_mixes()[0].mixer_elems[0]
+    # -20.1 dB, rounded by the driver to its 0.5 dB steps
+    assert fader.getvolume(units=osc.VOLUME_UNITS) == [-2000]
+    # Both channels, and zeroing nothing for a mono fader
+    assert card.writes() == 2
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+import backend
+import conftest
+import scenes
+
+
+def test_save_and_load(iface):
+    scene = scenes.Scene.capture(iface, "verse")
+    assert len(scene.volumes) == sum(len(c) for c in conftest.MODEL.mixes.values())
+    assert scene.enums["Clock Source Clock Source"] == iface.mixer_elems["Clock Source Clock Source"].getenum()[0]
+    scene.save()
+
+    assert scenes.list_scenes() == ["verse"]
+    loaded = scenes.Scene.load("verse")
+    assert loaded.to_json() == scene.to_json()
+
+    with pytest.raises(ValueError):
+        scenes.scene_path("../verse")
+
+
+def test_recall_writes_only_differences(card, iface):
+    scene = scenes.Scene.capture(iface, "verse")
+    card.reset_calls()
+    result = scenes.recall(iface, scene)
+    assert result.writes == 0
+    assert card.writes() == 0
+
+    iface.mixer_elems["Mix B Input 03"].setvolume(-1000, units=scenes.GAIN_UNITS)
+    iface.mixer_elems["Mixer Input 05"].getenum()
+    backend.set_enum_value(iface.mixer_elems["Mixer Input 05"], "PCM 7")
+    card.reset_calls()
+    result = scenes.recall(iface, scene)
+    assert result.changed == ["Mix B Input 03", "Mixer Input 05"]
+    assert card.writes() == result.writes == 2
+    assert card.controls["Mixer Input 05"].enum_values[card.controls["Mixer Input 05"].enum_index] \
+        == scene.enums["Mixer Input 05"]
+
+
+def test_gains_are_cut_around_rerouting(iface):
+    gain = iface.mixer_elems["Mix A Input 02"]
+    gain.setvolume(0, units=scenes.GAIN_UNITS)
+    scene = scenes.Scene.capture(iface, "chorus")
+    scene.enums["Mixer Input 02"] = "ADAT 1"
+    scene.volumes["Mix C Input 07"] = 300
+
+    silent = gain.getrange(units=scenes.GAIN_UNITS)[0]
+    plan = scenes.plan_recall(iface, scene)
+    assert plan == [
+        ("Mix A Input 02", silent),
+        ("Mixer Input 02", "ADAT 1"),
+        ("Mix A Input 02", 0),
+        ("Mix C Input 07", 300),
+    ]
+
+    scenes.recall(iface, scene)
+    assert gain.getvolume(units=scenes.GAIN_UNITS)[0] == 0
+    assert iface.mixer_elems["Mixer Input 02"].getenum()[0] == "ADAT 1"
+    assert scenes.plan_recall(iface, scene) == []
+
+
+def test_scene_for_another_model_is_rejected(iface):
+    scene = scenes.Scene.capture(iface, "verse")
+    scene.model = "Some Other Interface"
+    with pytest.raises(ValueError):
+        scenes.recall(iface, scene)
+
+
+def test_crossfade(iface):
+    scene = scenes.Scene.capture(iface, "chorus")
+    scene.enums["Mixer Input 02"] = "ADAT 1"
+    scene.volumes["Mix A Input 02"] = 0
+    scene.volumes["Mix C Input 07"] = -600
+    iface.mixer_elems["Mix A Input 02"].setvolume(-1000, units=scenes.GAIN_UNITS)
+
+    levels = []
+    iface.store.subscribe("Mix A Input 02", lambda: levels.append(
+        (iface.mixer_elems["Mixer Input 02"].getenum()[0],
+         iface.mixer_elems["Mix A Input 02"].getvolume(units=scenes.GAIN_UNITS)[0])))
+    result = scenes.crossfade(iface, scene, 0.2)
+
+    assert scenes.plan_recall(iface, scene) == []
+    assert set(result.changed) == {"Mix A Input 02", "Mix C Input 07", "Mixer Input 02"}
+    # The gain was faded out before the source changed, and back in after
+    silent = iface.mixer_elems["Mix A Input 02"].getrange(units=scenes.GAIN_UNITS)[0]
+    switch = next(i for i, (source, _) in enumerate(levels) if source == "ADAT 1")
+    assert levels[switch - 1][1] == silent
+    assert levels[switch][1] <= levels[-1][1] == 0
+    assert len(levels) > 5
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Chris Diamand
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import alsaaudio
+import alsasim
+import backend
+import conftest
+import scenes
+import session
+
+
+@pytest.fixture
+def rack(tmp_path, monkeypatch):
+    """Two 18i20s, the second much slower than the first"""
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path))
+    fast = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, latency=0.0005)
+    slow = alsasim.SimulatedCard.from_dump(conftest.DUMP_18I20_GEN2, latency=0.005)
+    alsasim.set_cards([fast, slow])
+    cards = session.Session.open(backend.discover_cards())
+    yield cards, fast, slow
+    cards.stop()
+    alsasim.set_cards([])
+
+
+def test_each_card_has_its_own_worker(rack):
+    cards, fast, slow = rack
+    assert len(cards) == 2
+    cards.start_io_workers()
+    assert cards[0].io_worker is not cards[1].io_worker
+
+    # Queue a long run of writes on the slow card, then one on the fast card,
+    # which mustn't have to wait for them
+    for i, name in enumerate(cards[1].model.mixes["Mix A"]):
+        cards[1].mixer_elems[name].setvolume(-100 * (i + 1), units=alsaaudio.VOLUME_UNITS_DB)
+    start = time.monotonic()
+    cards[0].io_worker.call(lambda: cards[0].cache.raw_mixer_elems["Mix A Input 01"].setvolume(
+        -600, units=alsaaudio.VOLUME_UNITS_DB))
+    assert time.monotonic() - start < 0.05
+    assert fast.control("Mix A Input 01").volume != slow.control("Mix A Input 01").volume
+
+    cards.stop()
+    metrics = cards.metrics()
+    assert set(metrics) == {0, 1}
+    assert metrics[1]["io"]["jobs"] > metrics[0]["io"]["jobs"]
+    assert metrics[1]["io"]["latency_max_ms"] > metrics[0]["io"]["latency_max_ms"]
+
+
+def test_global_recall_runs_on_every_card_at_once(rack):
+    cards, fast, slow = rack
+    cards.start_io_workers()
+    scene = scenes.Scene.capture(cards[0], "loud")
+    scene.volumes = {control: 0 for control in scene.volumes}
+
+    start = time.perf_counter()
+    results = cards.recall({0: scene, 1: scene})
+    elapsed = time.perf_counter() - start
+
+    assert set(results) == {0, 1}
+    assert results[0].writes == results[1].writes == len(scene.volumes)
+    # Transfers hold the GIL, so the cards' writes are interleaved rather
+    # than overlapped, but the fast card needn't wait for the slow one
+    assert results[0].elapsed < results[1].elapsed / 2
+    assert elapsed < results[1].elapsed * 1.5
+    assert fast.control("Mix A Input 01").volume == slow.control("Mix A Input 01").volume
+
+
+def test_each_reports_failed_cards(rack):
+    cards, _, _ = rack
+
+    def fail_on_card_1(iface: backend.Interface) -> int:
+        if iface.card_index == 1:
+            raise ValueError("Card 1 is broken")
+        return iface.card_index
+
+    with pytest.raises(session.SessionError) as e:
+        cards.each(fail_on_card_1)
+    assert e.value.results == {0: 0}
+    assert list(e.value.errors) == [1]
+
+
+def test_all_cards_command(tmp_path):
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmp_path), XDG_CACHE_HOME=str(tmp_path))
+    command = [sys.executable, os.path.join(conftest.SRC_DIR, "redmixctl"), "--logfile", str(tmp_path / "log"),
+               "--simulate", conftest.DUMP_18I20_GEN2, "--simulate", conftest.DUMP_18I20_GEN2, "--no-daemon"]
+
+    proc = subprocess.run(command + ["set", "Mixer Input 01", "ADAT 3"], env=env, capture_output=True, text=True)
+    assert proc.returncode == 1
+    assert "--all-cards" in proc.stderr
+
+    proc = subprocess.run(command + ["--card-index", "1", "get", "--json", "Mixer Input 01"],
+                          env=env, check=True, capture_output=True, text=True)
+    assert json.loads(proc.stdout) == {"Mixer Input 01": "Off"}
+
+    proc = subprocess.run(command + ["--all-cards", "set", "--json", "Mixer Input 01", "ADAT 3"],
+                          env=env, check=True, capture_output=True, text=True)
+    assert json.loads(proc.stdout) == {"0": {"Mixer Input 01": "ADAT 3"}, "1": {"Mixer Input 01": "ADAT 3"}}